@@ -0,0 +1,279 @@
+"""
+Microbenchmarks for the conjoin graph engine.
+
+Generates synthetic topologies (star hubs, full meshes, chains and random
+graphs), times the ConjoinTracker operations on each, and records the
+best wall-clock time and the peak memory allocated by each operation as
+JSON.  Given a baseline recorded earlier, exits with status 1 if any
+operation became slower, or allocated more memory at its peak, than the
+baseline allows.
+
+Timings depend on the machine, so no baseline is shipped: record one on
+the machine the comparison runs on, from the revision to compare against.
+
+    python3 benchmarks/bench_conjoin.py --save-baseline baseline.json
+    python3 benchmarks/bench_conjoin.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+import typing
+
+
+from qubesarbitrarynetworktopology.conjoin import (
+    ConjoinTracker,
+    Parameters,
+    parse_feature,
+)
+
+
+VmTable = dict[str, str | None]
+
+
+def _mac(n: int) -> str:
+    return ":".join("%02x" % ((n >> (8 * i)) & 0xFF) for i in range(5, -1, -1))
+
+
+def _table(edges: typing.Iterable[tuple[int, int]], vms: int) -> VmTable:
+    lines: dict[str, list[str]] = {"vm%d" % n: [] for n in range(vms)}
+    for n, (backend, frontend) in enumerate(edges):
+        line = "vm%d" % frontend
+        if n % 2:
+            line += " frontend_mac=%s" % _mac(n)
+        lines["vm%d" % backend].append(line)
+    return {vm: "\n".join(fe) for vm, fe in lines.items()}
+
+
+def star(vms: int) -> VmTable:
+    """One hub backing every other VM."""
+    return _table(((0, n) for n in range(1, vms)), vms)
+
+
+def mesh(vms: int) -> VmTable:
+    """Every VM backing every VM with a higher number."""
+    return _table(
+        ((b, f) for b in range(vms) for f in range(b + 1, vms)),
+        vms,
+    )
+
+
+def chain(vms: int) -> VmTable:
+    """Each VM backing the next one."""
+    return _table(((n, n + 1) for n in range(vms - 1)), vms)
+
+
+def random_graph(vms: int, degree: int = 4, seed: int = 0) -> VmTable:
+    """Each VM backing degree random other VMs."""
+    r = random.Random(seed)
+    edges = {
+        (b, f)
+        for b in range(vms)
+        for f in r.sample(range(vms), min(degree + 1, vms))
+        if f != b
+    }
+    return _table(sorted(edges), vms)
+
+
+# name -> (generator, VM count), with edge counts of up to about 10,000.
+TOPOLOGIES: dict[str, tuple[typing.Callable[[int], VmTable], int]] = {
+    "star-1000": (star, 1000),
+    "star-10000": (star, 10000),
+    "mesh-50": (mesh, 50),
+    "mesh-142": (mesh, 142),
+    "chain-1000": (chain, 1000),
+    "chain-10000": (chain, 10000),
+    "random-500": (random_graph, 500),
+    "random-2500": (random_graph, 2500),
+}
+
+QUICK = ["star-1000", "mesh-50", "chain-1000", "random-500"]
+
+
+def _operations(
+    table: VmTable,
+) -> dict[str, typing.Callable[[], typing.Any]]:
+    tracker = ConjoinTracker.from_vm_table(table)
+    # The active graph lags the configuration by a tenth of its edges,
+    # and has a different config on another tenth.
+    active = ConjoinTracker.from_vm_table(table)
+    for n, (backend, frontend) in enumerate(list(active)):
+        if n % 10 == 0:
+            active.disjoin(backend, frontend)
+        elif n % 10 == 1:
+            active.conjoin(backend, frontend, Parameters(), "0")
+    serialized = tracker.to_serializable()
+    busiest = max(table, key=lambda vm: len(tracker.connections(vm)))
+    vms = list(table)
+    paramstrings = [str(v.config) for v in tracker.values()]
+
+    def from_vm_table_cold() -> None:
+        parse_feature.cache_clear()
+        ConjoinTracker.from_vm_table(table)
+
+    return {
+        "from_vm_table_cold": from_vm_table_cold,
+        "from_vm_table_warm": lambda: ConjoinTracker.from_vm_table(table),
+        "diff": lambda: tracker.diff(active),
+        "diff_limit_to_busiest_vm": lambda: tracker.diff(active, limit_to_vm=busiest),
+        "connections_all_vms": lambda: [tracker.connections(vm) for vm in vms],
+        "to_serializable": tracker.to_serializable,
+        "from_deserializable": lambda: ConjoinTracker.from_deserializable(serialized),
+        "parameters_from_string": lambda: [
+            Parameters.from_string(p) for p in paramstrings
+        ],
+    }
+
+
+def measure(f: typing.Callable[[], typing.Any], repeats: int) -> dict[str, float | int]:
+    times: list[float] = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_bytes": peak}
+
+
+def run(topologies: list[str], repeats: int) -> dict[str, typing.Any]:
+    results: dict[str, typing.Any] = {}
+    for name in topologies:
+        generator, vms = TOPOLOGIES[name]
+        table = generator(vms)
+        edges = sum(len(parse_feature(f or "")) for f in table.values())
+        ops = {op: measure(f, repeats) for op, f in _operations(table).items()}
+        results[name] = {"vms": vms, "edges": edges, "operations": ops}
+        print(
+            "%-12s %6d VMs %6d edges  %s"
+            % (
+                name,
+                vms,
+                edges,
+                "  ".join(
+                    "%s=%.2fms" % (op, r["seconds"] * 1000) for op, r in ops.items()
+                ),
+            ),
+            file=sys.stderr,
+        )
+    return results
+
+
+def regressions(
+    results: dict[str, typing.Any],
+    baseline: dict[str, typing.Any],
+    tolerance: float,
+    floor: float,
+    memory_tolerance: float,
+    memory_floor: int,
+) -> list[str]:
+    """
+    Returns a description of each operation whose time exceeds its
+    baseline by more than tolerance (a fraction of the baseline) plus
+    floor (in seconds, to absorb jitter on very fast operations), and of
+    each whose peak memory exceeds its baseline by more than
+    memory_tolerance plus memory_floor (in bytes).
+    """
+    ret: list[str] = []
+    for name, result in results.items():
+        for op, r in result["operations"].items():
+            try:
+                base = baseline[name]["operations"][op]
+            except KeyError:
+                continue
+            if r["seconds"] > base["seconds"] * (1 + tolerance) + floor:
+                ret.append(
+                    "%s %s: %.2fms, baseline %.2fms"
+                    % (name, op, r["seconds"] * 1000, base["seconds"] * 1000)
+                )
+            peak = base.get("peak_bytes")
+            if peak is None:
+                continue
+            if r["peak_bytes"] > peak * (1 + memory_tolerance) + memory_floor:
+                ret.append(
+                    "%s %s: peak %.1fKiB, baseline %.1fKiB"
+                    % (name, op, r["peak_bytes"] / 1024, peak / 1024)
+                )
+    return ret
+
+
+def main(argv: list[str] | None = None) -> int:
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument(
+        "topologies",
+        nargs="*",
+        help="topologies to benchmark, among %s (default: all)"
+        % ", ".join(TOPOLOGIES),
+    )
+    p.add_argument("--quick", action="store_true", help="only small topologies")
+    p.add_argument("--repeats", type=int, default=5)
+    p.add_argument("--output", help="write results as JSON to this file")
+    p.add_argument("--save-baseline", help="write results as a baseline file")
+    p.add_argument("--baseline", help="fail on regressions against this file")
+    p.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.5,
+        help="allowed slowdown, as a fraction of the baseline (default: 0.5)",
+    )
+    p.add_argument(
+        "--floor",
+        type=float,
+        default=0.001,
+        help="allowed slowdown in seconds on top of tolerance (default: 0.001)",
+    )
+    p.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.1,
+        help="allowed growth of peak memory, as a fraction of the baseline"
+        " (default: 0.1)",
+    )
+    p.add_argument(
+        "--memory-floor",
+        type=int,
+        default=16384,
+        help="allowed growth of peak memory in bytes on top of memory"
+        " tolerance (default: 16384)",
+    )
+    args = p.parse_args(argv)
+    for t in args.topologies:
+        if t not in TOPOLOGIES:
+            p.error("unknown topology %s" % t)
+
+    topologies = args.topologies or (QUICK if args.quick else list(TOPOLOGIES))
+    results = run(topologies, args.repeats)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                f.write(text + "\n")
+    if not args.output and not args.save_baseline:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(
+                results,
+                json.load(f),
+                args.tolerance,
+                args.floor,
+                args.memory_tolerance,
+                args.memory_floor,
+            )
+        for r in found:
+            print("Regression: %s" % r, file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
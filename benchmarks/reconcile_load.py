@@ -0,0 +1,344 @@
+"""
+End-to-end load harness for the topology extension.
+
+Replays an event trace (VMs starting, stopping, pausing and having their
+attach-network-to feature changed) through
+QubesArbitraryNetworkTopologyExtension, with local stand-ins for the
+Qubes domain collection, qubesdb and the Xen device backend, and reports
+event-to-link-up latency percentiles, the number of xl processes the
+real device backend would have spawned, and qubesdb write volume, with
+the first publish of the desired topology, made as qubesd starts, apart.
+
+Traces are JSON lines.  The first line describes the initial state of
+every VM, as {"vms": {"name": {"feature": "...", "running": false}}},
+and every other line is an event, as {"t": seconds since the start of
+the trace, "event": "...", "vm": "...", "value": "..."}, where event is
+one of domain-start, domain-pre-shutdown, domain-shutdown, domain-paused,
+domain-unpaused, feature-set (value is the new attach-network-to feature) and
+feature-delete.  Traces can be generated:
+
+    python3 benchmarks/reconcile_load.py --generate mass-start \\
+        --topology star-1000 > trace.jsonl
+    python3 benchmarks/reconcile_load.py trace.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import typing
+
+
+from bench_conjoin import TOPOLOGIES
+from qubesarbitrarynetworktopology import (
+    DESIRED_PATH,
+    QubesArbitraryNetworkTopologyExtension,
+)
+from qubesarbitrarynetworktopology.conjoin import ConjoinTracker, MacAddress
+from qubesarbitrarynetworktopology.devices import FakeDeviceBackend
+from qubesarbitrarynetworktopology.persistence import ConjoinStore
+from qubesarbitrarynetworktopology.states import DomainStates
+from qubesarbitrarynetworktopology.testing import FakeApp, FakeQubesDB, FakeVM
+
+
+# xl processes spawned per operation by each real device backend.
+SPAWNS = {
+    "xl": {"attach": 2, "detach": 1},
+    "xenstore": {"attach": 1, "detach": 1},
+}
+
+
+class TimedDeviceBackend(FakeDeviceBackend):
+    """
+    A FakeDeviceBackend that calls on_link_up with each link it brings up.
+    """
+
+    def __init__(
+        self, latency: float, on_link_up: typing.Callable[[tuple[str, str]], None]
+    ) -> None:
+        super().__init__(latency=latency)
+        self.on_link_up = on_link_up
+
+    async def attach(
+        self, backend: str, frontend: str, frontend_mac: MacAddress | None = None
+    ) -> str:
+        vifid = await super().attach(backend, frontend, frontend_mac)
+        self.on_link_up((backend, frontend))
+        return vifid
+
+
+def _percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Harness(object):
+    def __init__(self, initial: dict[str, typing.Any], latency: float) -> None:
+        self.app = FakeApp({})
+        for qid, (name, state) in enumerate(initial["vms"].items(), 1):
+            self.app.domains[name] = FakeVM(
+                self.app,
+                name,
+                qid,
+                state.get("feature") or None,
+                state.get("running", False),
+            )
+        self.db = FakeQubesDB()
+        self.devices = TimedDeviceBackend(latency, self._link_up)
+        self.ext = QubesArbitraryNetworkTopologyExtension()
+        self.ext.devices = self.devices
+        self.ext.store = ConjoinStore(self.db)
+        self.ext.states = DomainStates(self._power_states)
+        # The harness' own view of the desired graph, and when each edge
+        # last became eligible to come up according to the events.
+        self.desired = ConjoinTracker.from_vm_table(
+            {
+                vm.name: vm.features.get("attach-network-to", "")
+                for vm in self.app.domains
+            }
+        )
+        self.requested: dict[tuple[str, str], float] = {}
+        self.latencies: list[float] = []
+        self.links_up = 0
+        # The first publish of the whole desired tree, made while settling.
+        self.desired_publish = {"writes": 0, "bytes_written": 0}
+
+    def _request(self, name: str) -> None:
+        now = time.monotonic()
+        domains = self.app.domains
+        for edge in self.desired.connections(name):
+            if all(domains[x].running and not domains[x].paused for x in edge):
+                self.requested.setdefault(edge, now)
+
+    def _power_states(self, app: "FakeApp") -> dict[str, bool]:
+        # Stands for the two bulk libvirt queries.
+        app.state_queries += 2
+        return {vm.name: vm.paused for vm in app.domains if vm.running}
+
+    def _link_up(self, edge: tuple[str, str]) -> None:
+        self.links_up += 1
+        if edge in self.requested:
+            self.latencies.append(time.monotonic() - self.requested.pop(edge))
+
+    def _set_feature(self, name: str, value: str | None) -> None:
+        for frontend in self.desired.frontends(name):
+            self.requested.pop((name, frontend), None)
+        self.desired.replace_frontends(name, value)
+
+    def replay_event(self, e: dict[str, typing.Any]) -> None:
+        vm = self.app.domains[e["vm"]]
+        event = e["event"]
+        if event == "domain-start":
+            vm.running, vm.paused = True, False
+            self._request(vm.name)
+            self.ext.on_domain_started(vm, event)
+        elif event == "domain-pre-shutdown":
+            self.ext.on_domain_pre_shutdown(vm, event)
+        elif event == "domain-shutdown":
+            vm.running, vm.paused = False, False
+            self.ext.on_domain_shutdown(vm, event)
+        elif event == "domain-paused":
+            vm.paused = True
+            self.ext.on_domain_paused(vm, event)
+        elif event == "domain-unpaused":
+            vm.paused = False
+            self._request(vm.name)
+            self.ext.on_domain_unpaused(vm, event)
+        elif event == "feature-set":
+            self.ext.on_attach_network_to_before_change(
+                vm,
+                "domain-feature-pre-set:attach-network-to",
+                "attach-network-to",
+                e["value"],
+            )
+            vm.features["attach-network-to"] = e["value"]
+            self._set_feature(vm.name, e["value"])
+            self._request(vm.name)
+            self.ext.on_attach_network_to_changed(
+                vm,
+                "domain-feature-set:attach-network-to",
+                feature="attach-network-to",
+                value=e["value"],
+            )
+        elif event == "feature-delete":
+            vm.features.pop("attach-network-to", None)
+            self._set_feature(vm.name, None)
+            self.ext.on_attach_network_to_changed(
+                vm,
+                "domain-feature-delete:attach-network-to",
+                feature="attach-network-to",
+            )
+        else:
+            raise ValueError("unknown event %s" % event)
+
+    async def settle(self) -> None:
+        """
+        Brings up the links among VMs initially running, then resets the
+        counters, so the report only covers the trace itself.  What the
+        first publish of the desired tree took is kept apart, since it is
+        made once, whatever the trace.
+        """
+        # As when qubesd starts.
+        self.ext.on_domain_loaded(self.app.domains["dom0"], "domain-load")
+        await self.ext.scheduler.drain()
+        desired = [k for k in self.db.writes if k.startswith(DESIRED_PATH + "/")]
+        self.desired_publish = {
+            "writes": len(desired),
+            "bytes_written": sum(len(k) + len(self.db.data[k]) for k in desired),
+        }
+        self.latencies.clear()
+        self.requested.clear()
+        self.links_up = 0
+        self.devices.calls = {op: 0 for op in self.devices.calls}
+        self.db.writes.clear()
+        self.db.removals.clear()
+        self.db.bytes_written = 0
+        self.app.state_queries = 0
+
+    async def replay(self, events: list[dict[str, typing.Any]], speed: float) -> None:
+        await self.settle()
+        start = time.monotonic()
+        for e in events:
+            if speed > 0:
+                delay = start + e.get("t", 0) / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.replay_event(e)
+            # Let handlers and the tasks they schedule run, as in qubesd.
+            await asyncio.sleep(0)
+        await self.ext.scheduler.drain()
+
+    def report(self, model: str, wall: float, events: int) -> dict[str, typing.Any]:
+        latencies = self.latencies
+        spawns = SPAWNS[model]
+        calls = self.devices.calls
+        return {
+            "events": events,
+            "wall_seconds": wall,
+            "links_up": self.links_up,
+            "link_up_latency_seconds": {
+                "p50": _percentile(latencies, 50),
+                "p90": _percentile(latencies, 90),
+                "p99": _percentile(latencies, 99),
+                "max": max(latencies, default=None),
+            },
+            "device_operations": dict(calls),
+            "subprocesses": sum(calls[op] * spawns[op] for op in spawns),
+            "domain_state_queries": self.app.state_queries,
+            "qubesdb": {
+                "connections": self.db.connections,
+                "writes": len(self.db.writes),
+                "removals": len(self.db.removals),
+                "bytes_written": self.db.bytes_written,
+                "first_desired_publish": self.desired_publish,
+            },
+        }
+
+
+def generate(
+    kind: str, topology: str, interval: float, seed: int
+) -> typing.Iterator[dict[str, typing.Any]]:
+    generator, vms = TOPOLOGIES[topology]
+    table = generator(vms)
+    r = random.Random(seed)
+    running = kind != "mass-start"
+    yield {"vms": {vm: {"feature": f, "running": running} for vm, f in table.items()}}
+    names = list(table)
+    if kind == "mass-start":
+        for n, vm in enumerate(names):
+            yield {"t": n * interval, "event": "domain-start", "vm": vm}
+    elif kind == "shutdown-storm":
+        # As with qvm-shutdown --all, every VM is asked to shut down at once,
+        # and they go down one after the other.
+        for vm in names:
+            yield {"t": 0, "event": "domain-pre-shutdown", "vm": vm}
+        for n, vm in enumerate(names):
+            yield {"t": n * interval, "event": "domain-shutdown", "vm": vm}
+    elif kind == "feature-churn":
+        # Random VMs get their first link dropped, then restored.
+        backends = [vm for vm in names if table[vm]]
+        for n in range(len(backends)):
+            vm = r.choice(backends)
+            feature = table[vm] or ""
+            dropped = "\n".join(feature.splitlines()[1:])
+            for m, value in enumerate([dropped, feature]):
+                yield {
+                    "t": (2 * n + m) * interval,
+                    "event": "feature-set",
+                    "vm": vm,
+                    "value": value,
+                }
+    elif kind == "pause-churn":
+        # Random VMs get paused, then unpaused, with nothing else changing.
+        for n in range(len(names)):
+            vm = r.choice(names)
+            for m, event in enumerate(["domain-paused", "domain-unpaused"]):
+                yield {"t": (2 * n + m) * interval, "event": event, "vm": vm}
+    else:
+        raise ValueError("unknown trace kind %s" % kind)
+
+
+def main(argv: list[str] | None = None) -> int:
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("trace", nargs="?", help="trace to replay (default: stdin)")
+    p.add_argument(
+        "--generate",
+        choices=["mass-start", "shutdown-storm", "feature-churn", "pause-churn"],
+        help="print a generated trace instead of replaying one",
+    )
+    p.add_argument("--topology", default="star-1000", help="for --generate")
+    p.add_argument(
+        "--interval",
+        type=float,
+        default=0.001,
+        help="seconds between generated events (default: 0.001)",
+    )
+    p.add_argument("--seed", type=int, default=0, help="for --generate")
+    p.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed factor; 0 replays as fast as possible (default: 1)",
+    )
+    p.add_argument(
+        "--device-latency",
+        type=float,
+        default=0.05,
+        help="simulated seconds per attach or detach (default: 0.05)",
+    )
+    p.add_argument(
+        "--model",
+        choices=list(SPAWNS),
+        default="xenstore",
+        help="device backend whose process spawns to count (default: xenstore)",
+    )
+    args = p.parse_args(argv)
+
+    if args.generate:
+        if args.topology not in TOPOLOGIES:
+            p.error("unknown topology %s" % args.topology)
+        for line in generate(args.generate, args.topology, args.interval, args.seed):
+            print(json.dumps(line))
+        return 0
+
+    f = open(args.trace) if args.trace else sys.stdin
+    with f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    harness = Harness(lines[0], args.device_latency)
+    start = time.monotonic()
+    asyncio.run(harness.replay(lines[1:], args.speed))
+    wall = time.monotonic() - start
+    print(
+        json.dumps(
+            harness.report(args.model, wall, len(lines) - 1), indent=2, sort_keys=True
+        )
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -52,6 +52,7 @@ BuildRequires:  systemd-rpm-macros
 
 Requires:       python3
 Requires:       qubes-core-dom0 >= 4.2
+Requires:       qubes-core-admin-client
 
 %description -n qubes-core-admin-addon-arbitrary-network-topology
 This package lets you create arbitrary network topologies in your
@@ -82,6 +83,7 @@ find $RPM_BUILD_ROOT
 %files -n       qubes-core-admin-addon-arbitrary-network-topology
 %attr(0644, root, root) %{python3_sitelib}/qubesarbitrarynetworktopology/*
 %{python3_sitelib}/qubesarbitrarynetworktopology-*.egg-info
+%attr(0755, root, root) %{_bindir}/qvm-network-topology
 
 %post -n         qubes-core-admin-addon-arbitrary-network-topology
 # Restart qubesd after initial install.
@@ -1,8 +1,10 @@
+import asyncio
 import contextlib
+import functools
 import logging
-import subprocess
 import qubes
 import qubes.ext
+import time
 import typing
 
 
@@ -10,17 +12,84 @@ from qubesarbitrarynetworktopology.conjoin import (
     ConjoinTracker,
     ACTION_ADD,
     ACTION_REMOVE,
+    Edge,
     MacAddress,
+    Parameters,
+    VifAttachment,
+)
+from qubesarbitrarynetworktopology.devices import (
+    DeviceBackend,
+    DeviceError,
+    Vif,
+    default_device_backend,
+)
+from qubesarbitrarynetworktopology.executor import EdgeExecutor
+from qubesarbitrarynetworktopology.metrics import (
+    ATTACHES,
+    DETACHES,
+    PENDING_EDGES,
+    PHASE_SECONDS,
+    REGISTRY,
+    SKIPPED_VMS,
 )
 from qubesarbitrarynetworktopology.persistence import ConjoinStore
+from qubesarbitrarynetworktopology.retry import RetryEntry, RetryQueue
+from qubesarbitrarynetworktopology.scheduler import (
+    DEFAULT_DELAY,
+    ReconcileBatch,
+    ReconcileScheduler,
+)
+from qubesarbitrarynetworktopology.states import DomainStates
 
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
+# Settings read from features of dom0.
+RECONCILE_DELAY_FEATURE = "arbitrary-network-topology-reconcile-delay"
+METRICS_FEATURE = "arbitrary-network-topology-metrics"
+METRICS_PATH = "/qubes-arbitrary-network-topology-metrics"
+HOLD_FEATURE = "arbitrary-network-topology-hold"
+# Short, for the keys of ConjoinStore.publish_tree() under it to fit.
+RETRIES_PATH = "/qubes-network-topology-retries"
+SETTINGS = (RECONCILE_DELAY_FEATURE, METRICS_FEATURE, HOLD_FEATURE)
+
+# Where vif-route-nexus finds the addressing of each VIF, in the qubesdb of
+# the backend, by interface name (which is the name of the frontend).
+ADDRESSING_PATH = "/arbitrary-network-topology/"
+
+# Where dom0 tools find the configured topology, and the changes pending to
+# bring the active one (kept by ConjoinStore) in line with it, one key per
+# edge as written by ConjoinStore.publish_tree().  They are short, for the
+# keys to fit in qubesdb.
+DESIRED_PATH = "/qubes-network-topology-desired"
+PENDING_PATH = "/qubes-network-topology-pending"
+
+# How long a VM that is shutting down has to do so, unless it says otherwise,
+# before the detaches deferred because of its shutdown are carried out.
+DEFAULT_SHUTDOWN_GRACE = 60.0
+
+# Fired on the backend when a link comes up or goes away, with the frontend,
+# the VIF ID in the frontend, and the parameters of the link.
+LINK_ATTACHED = "topology-link-attached"
+LINK_DETACHED = "topology-link-detached"
+
+
 @contextlib.contextmanager
-def with_qubes() -> typing.Generator[qubes.Qubes, None, None]:
+def with_qubes(
+    app: qubes.Qubes | None = None,
+) -> typing.Generator[qubes.Qubes, None, None]:
+    """
+    Yields the Qubes collection to work against.
+
+    Within qubesd, event handlers pass the live `vm.app` they were handed,
+    which is yielded as-is and never closed.  Out-of-process callers pass
+    nothing and get a freshly-loaded `qubes.Qubes()` that is closed on exit.
+    """
+    if app is not None:
+        yield app
+        return
     log.debug("Opening Qubes connection")
     q = qubes.Qubes()
     try:
@@ -30,50 +99,339 @@ def with_qubes() -> typing.Generator[qubes.Qubes, None, None]:
         log.debug("Closed Qubes connection")
 
 
-def attach(backend: str, frontend: str, frontend_mac: MacAddress | None = None) -> str:
-    """Returns the network VIF ID as a string."""
-    cmd = (
-        ["xl", "network-attach", frontend]
-        + (["mac=%s" % frontend_mac] if frontend_mac else [])
-        + [
-            "backend=%s" % backend,
-            "vifname=%s" % frontend,
-            "script=%s" % "vif-route-nexus",
-        ]
-    )
-    _ = subprocess.run(
-        cmd,
-        check=True,
-    )
-    p = subprocess.run(
-        ["xl", "network-list", frontend],
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
-        check=True,
-    )
-    vifid = [x for x in p.stdout.splitlines() if x.strip()][-1].split()[0]
-    return vifid
-
-
-def detach(frontend: str, vifid: str) -> None:
-    subprocess.run(["xl", "network-detach", frontend, vifid], check=True)
-
-
 class QubesArbitraryNetworkTopologyExtension(qubes.ext.Extension):  # type:ignore
     config: ConjoinTracker = None  # type: ignore
     active: ConjoinTracker = None  # type: ignore
 
     def __init__(self) -> None:
         super().__init__()
+        self.devices: DeviceBackend = default_device_backend()
+        # Serializes reconciliation passes, since they all mutate self.active.
+        self._reconcile_lock = asyncio.Lock()
+        self._executor = EdgeExecutor()
+        self.store = ConjoinStore()
+        self.scheduler = ReconcileScheduler(self._reconcile_batch)
+        self._app: qubes.Qubes | None = None
+        # Where to export metrics after each pass: "qubesdb", a file path
+        # for the node exporter textfile collector, or None.
+        self.metrics_target: str | None = None
+        # Whether self.active has been checked against the actual VIFs, or
+        # recovered from the journal.
+        self._resynced = False
+        # Whether the journal has intents to clear once self.active is saved,
+        # and the edges whose outcome is unknown, whose intents are kept for
+        # recover() to look into.
+        self._journaled = False
+        self._unconfirmed: set[Edge] = set()
+        self.retries = RetryQueue(self._retry, self._persist_retries)
+        self._retry_tasks: set[asyncio.Task[None]] = set()
+        # Power states of the domains, kept current by domain events.
+        self.states = DomainStates()
+        # VMs being shut down, with the time.monotonic() by which they should
+        # be down, and the VIFs in each that are left for Xen to clean up
+        # when it goes down, as (backend, VIF ID).
+        self._stopping: dict[str, float] = {}
+        self._deferred: dict[str, list[tuple[str, str]]] = {}
+        self._deferred_timers: dict[str, asyncio.TimerHandle] = {}
+        # The generations (of self.config and self.active) at which each VM
+        # was last found to have all of its links as configured, and that
+        # at which self.active was last saved.
+        self._converged: dict[str, tuple[int, int]] = {}
+        self._saved: int | None = None
+        # What the topology was last published from: self.config,
+        # self.active and self.states, then their generations.
+        self._published: tuple[typing.Any, ...] | None = None
+
+    async def _reconcile_batch(self, batch: ReconcileBatch) -> None:
+        """
+        Reconciles a batch collected by the scheduler, then fires
+        topology-reconciled on each VM in it.
+        """
+        async with self._reconcile_lock:
+            if batch.resync or not self._resynced:
+                await self.recover(app=self._app)
+            await self.reconcile(
+                disjoin=batch.disjoin, conjoin=batch.conjoin, app=self._app
+            )
+        self._export_metrics()
+        self._publish_topology()
+        if self._app is None:
+            return
+        domains = self._app.domains
+        for name in batch.vms():
+            if name in domains:
+                domains[name].fire_event("topology-reconciled")
+
+    def _export_metrics(self) -> None:
+        if not self.metrics_target:
+            return
+        try:
+            if self.metrics_target == "qubesdb":
+                self.store.publish_text(METRICS_PATH, REGISTRY.render())
+            else:
+                REGISTRY.write_textfile(self.metrics_target)
+        except Exception:
+            log.exception("Could not export metrics to %s", self.metrics_target)
+
+    def desired_graph(self) -> list[dict[str, str]]:
+        """
+        Returns the edges of the configured topology, with their parameters.
+        """
+        if self.config is None:
+            return []
+        return [
+            {"backend": b, "frontend": f, "config": str(v.config)}
+            for (b, f), v in sorted(self.config.items())
+        ]
+
+    def active_graph(self) -> list[dict[str, str | None]]:
+        """
+        Returns the edges that are attached, with their parameters and the
+        ID of their VIF in the frontend.
+        """
+        if self.active is None:
+            return []
+        return [
+            {
+                "backend": b,
+                "frontend": f,
+                "config": str(v.config),
+                "vifid": v.frontend_network_id,
+            }
+            for (b, f), v in sorted(self.active.items())
+        ]
+
+    def pending(self) -> list[dict[str, str]]:
+        """
+        Returns the changes that would bring the active topology in line
+        with the configured one: an attach, detach or replace of each edge,
+        with the parameters it would end up with, or had if detached.
+        Edges between VMs that are not both running and unpaused are not
+        pending, since they cannot be attached until they are.
+        """
+        if self.config is None or self.active is None:
+            return []
+        changes = []
+        for b, f in sorted(set(self.config) | set(self.active)):
+            fields = self._pending_fields(b, f)
+            if fields is not None:
+                action, config = fields
+                changes.append(
+                    {"backend": b, "frontend": f, "action": action, "config": config}
+                )
+        return changes
+
+    def _desired_fields(self, backend: str, frontend: str) -> list[str] | None:
+        if (backend, frontend) not in self.config:
+            return None
+        return [str(self.config.config(backend, frontend))]
+
+    def _pending_fields(self, backend: str, frontend: str) -> list[str] | None:
+        # The change pending on the edge, as [action, config], if any.
+        mine = self.config.get((backend, frontend))
+        theirs = self.active.get((backend, frontend))
+        if theirs is None:
+            if mine is None:
+                return None
+            fields = ["attach", str(mine.config)]
+        elif mine is None:
+            return ["detach", str(theirs.config)]
+        elif mine.config != theirs.config:
+            fields = ["replace", str(mine.config)]
+        else:
+            return None
+        if self._app is not None and not self.states.actionable(
+            self._app, [(backend, frontend)]
+        ):
+            return None
+        return fields
+
+    def _publish_topology(self) -> None:
+        # Only the edges that changed since the last publish, or whose VMs
+        # did, are looked at again, so that publishing costs what changed
+        # rather than what the whole topology takes.
+        if self.config is None or self.active is None:
+            return
+        config, active, states = self.config, self.active, self.states
+        last = self._published
+        desired: list[Edge] | None = None
+        pending: list[Edge] | None = None
+        if last is not None and all(
+            a is b for a, b in zip(last, (config, active, states))
+        ):
+            desired = config.changed_since(last[3])
+            edges = active.changed_since(last[4])
+            changed = states.changed_since(last[5])
+            if desired is not None and edges is not None and changed is not None:
+                pending = desired + edges
+                for vm in changed:
+                    pending += config.connections(vm) + active.connections(vm)
+        else:
+            config.track_changes()
+            active.track_changes()
+        try:
+            self._publish_tree(DESIRED_PATH, desired, self._desired_fields)
+            self._publish_tree(PENDING_PATH, pending, self._pending_fields)
+        except Exception:
+            log.exception("Could not publish topology")
+            self._published = None
+            return
+        self._published = (
+            config,
+            active,
+            states,
+            config.generation,
+            active.generation,
+            states.generation,
+        )
+
+    def _publish_tree(
+        self,
+        path: str,
+        edges: list[Edge] | None,
+        fields: typing.Callable[[str, str], list[str] | None],
+    ) -> None:
+        """
+        Publishes under path the fields of edges, or of all edges if None.
+        """
+        if edges is None:
+            tree: dict[Edge, list[typing.Any]] = {}
+            for b, f in set(self.config) | set(self.active):
+                value = fields(b, f)
+                if value is not None:
+                    tree[(b, f)] = value
+            self.store.publish_tree(path, tree)
+        elif edges:
+            self.store.update_tree(path, {(b, f): fields(b, f) for b, f in edges})
+
+    def _fire_link_event(
+        self,
+        domains: typing.Any,
+        event: str,
+        backend: str,
+        frontend: str,
+        vifid: str | None,
+        config: Parameters,
+    ) -> None:
+        if backend not in domains:
+            return
+        try:
+            domains[backend].fire_event(
+                event, frontend=frontend, vifid=vifid, config=str(config)
+            )
+        except Exception:
+            log.exception("Could not fire %s on %s", event, backend)
+
+    def _persist_retries(self, entries: list[RetryEntry]) -> None:
+        # One key per edge, holding the entries of the edge, so that the
+        # values stay small however many entries there are.
+        edges: dict[Edge, list[typing.Any]] = {}
+        for e in entries:
+            edges.setdefault((e.backend, e.frontend), []).append(e.to_serializable())
+        self.store.publish_tree(RETRIES_PATH, edges)
+
+    def _restore_retries(self) -> None:
+        try:
+            tree = self.store.read_tree(RETRIES_PATH)
+        except Exception:
+            log.exception("Could not restore retries")
+            return
+        entries = [e for fields in tree.values() for e in fields]
+        # Failed detaches need not be restored: resync() finds VIFs that
+        # are still attached.
+        self.retries.restore([e for e in entries if e["vifid"] is None])
+
+    def retry_status(self) -> list[dict[str, typing.Any]]:
+        """
+        Returns the failed attaches and detaches being retried.
+        """
+        return self.retries.status()
+
+    def _retry(self, entry: RetryEntry) -> None:
+        backend, frontend = entry.backend, entry.frontend
+        running = self._app is not None and bool(
+            self.states.actionable(self._app, [(backend, frontend)])
+        )
+        if entry.vifid is not None:
+            # Do not detach a VIF that got reused for another link.
+            reused = any(
+                self.active.frontend_network_id(b, frontend) == entry.vifid
+                for b in self.active.backends(frontend)
+            )
+            if reused or not running:
+                self.retries.discard(*entry.key)
+                return
+            task = asyncio.ensure_future(self._retry_detach(entry))
+            self._retry_tasks.add(task)
+            task.add_done_callback(self._retry_tasks.discard)
+            return
+        edge = (backend, frontend)
+        if (
+            not running
+            or edge not in self.config
+            or (
+                edge in self.active
+                and self.active.config(*edge) == self.config.config(*edge)
+            )
+        ):
+            self.retries.discard(*entry.key)
+            return
+        self.scheduler.conjoin(backend)
+
+    async def _retry_detach(self, entry: RetryEntry) -> None:
+        assert entry.vifid is not None
+        async with self._reconcile_lock:
+            try:
+                await self.devices.detach(entry.frontend, entry.vifid)
+            except DeviceError:
+                DETACHES.inc(result="failure")
+                log.exception("Could not retry %s", entry)
+                return
+            DETACHES.inc(result="success")
+            log.info(
+                "Detached backend %s from frontend %s VIF %s on retry",
+                entry.backend,
+                entry.frontend,
+                entry.vifid,
+            )
+            self.retries.discard(*entry.key)
+
+    def _apply_setting(self, feature: str, value: str | None) -> None:
+        if feature == RECONCILE_DELAY_FEATURE:
+            try:
+                delay = float(value) if value else DEFAULT_DELAY
+            except ValueError:
+                log.warning("Ignoring invalid reconcile delay %r", value)
+                return
+            self.scheduler.delay = max(delay, 0.0)
+        elif feature == METRICS_FEATURE:
+            self.metrics_target = value or None
+        elif feature == HOLD_FEATURE:
+            # Reconciliation is held while tools such as qvm-network-topology
+            # make many changes that should be reconciled in one pass.  The
+            # value is the time the hold lapses at, so that a hold left over
+            # by a tool that died does not hold reconciliation for good.
+            try:
+                lapse = float(value) - time.time() if value else None
+            except ValueError:
+                log.warning("Ignoring invalid hold %r", value)
+                lapse = None
+            if lapse is not None and lapse <= 0:
+                log.warning("Ignoring hold that lapsed %.0f seconds ago", -lapse)
+                lapse = None
+            if lapse is None:
+                self.scheduler.release()
+            else:
+                self.scheduler.hold(lapse)
 
     def _delayed_graphs_loader(
         self,
         force_feature: str | None = None,
-        for_vm: qubes.vm.BaseVM | None = None,
-        apply: bool = True,
+        for_vm: str | None = None,
+        app: qubes.Qubes | None = None,
     ) -> None:
-        with with_qubes() as q:
-            if self.config is None or for_vm is not None:
+        if self.config is None:
+            with PHASE_SECONDS.time(phase="read_features"), with_qubes(app) as q:
                 vm_table: dict[str, str | None] = {
                     backend.name: (
                         (force_feature)
@@ -82,129 +440,544 @@ class QubesArbitraryNetworkTopologyExtension(qubes.ext.Extension):  # type:ignor
                     )
                     for backend in q.domains
                 }
-                config = ConjoinTracker.from_vm_table(vm_table)
-                if not apply:
-                    return
-                self.config = config
-                log.info("Loaded configuration: %s", self.config)
+                for feature in SETTINGS:
+                    self._apply_setting(
+                        feature, q.domains["dom0"].features.get(feature)
+                    )
+            with PHASE_SECONDS.time(phase="from_vm_table"):
+                self.config = ConjoinTracker.from_vm_table(vm_table)
+            log.info("Loaded configuration: %s", self.config)
+        elif for_vm is not None:
+            # Only the edges going out of for_vm can have changed.
+            with PHASE_SECONDS.time(phase="replace_frontends"):
+                self.config.replace_frontends(for_vm, force_feature)
+            log.info(
+                "Updated configuration of %s: %s",
+                for_vm,
+                self.config.frontends(for_vm),
+            )
         if self.active is None:
-            self.active = ConjoinStore().load()
-        log.info("Active configuration: %s", self.active)
+            with PHASE_SECONDS.time(phase="load_active"):
+                self.active = self.store.load()
+            log.info("Active configuration: %s", self.active)
 
-    def conjoin_vm_with_peers(self, vm: str) -> None:
-        with with_qubes() as q:
-            domains = q.domains
-            for action, backend, frontend, config in self.config.diff(
-                self.active, limit_to_vm=vm
-            ):
-                if backend not in domains or frontend not in domains:
-                    continue
-                if not all(
-                    [
-                        domains[backend].is_running(),
-                        not domains[backend].is_paused(),
-                        domains[frontend].is_running(),
-                        not domains[frontend].is_paused(),
-                    ]
-                ):
-                    continue
-                if action == ACTION_ADD:
-                    try:
-                        attached_vifid = attach(
-                            backend, frontend, frontend_mac=config.frontend_mac
-                        )
-                        self.active.conjoin(
-                            backend,
-                            frontend,
-                            config=config,
-                            frontend_network_id=attached_vifid,
-                        )
-                        log.info(
-                            "Attached backend %s to frontend %s with frontend VIF %s config %s",
-                            backend,
-                            frontend,
-                            attached_vifid,
-                            config,
-                        )
-                    except subprocess.CalledProcessError:
-                        log.exception(
-                            "Could not attach backend %s to frontend %s",
-                            backend,
-                            frontend,
-                        )
-                elif action == ACTION_REMOVE:
-                    vifid_to_detach = self.active.frontend_network_id(backend, frontend)
-                    try:
-                        if vifid_to_detach is not None:
-                            detach(frontend, vifid_to_detach)
-                            log.info(
-                                "Detached backend %s from frontend %s VIF %s config %s",
-                                backend,
-                                frontend,
-                                vifid_to_detach,
-                                config,
-                            )
-                        else:
-                            log.info(
-                                "No need to detach backend %s from frontend %s since VIF is %s",
-                                backend,
-                                frontend,
-                                vifid_to_detach,
-                            )
-                    except subprocess.CalledProcessError:
-                        log.exception(
-                            "Could not detach backend %s from frontend",
-                            backend,
-                            frontend,
-                        )
-                    self.active.disjoin(backend, frontend)
-            ConjoinStore().save(self.active)
+    async def _reconcile_edge(
+        self,
+        backend: str,
+        frontend: str,
+        steps: list[tuple[str, Parameters]],
+        vifid: str | None,
+    ) -> list[tuple[str, Parameters, str | None]]:
+        """
+        Carries out the steps (as produced by ConjoinTracker.diff) for one
+        edge, and returns those whose outcome must be recorded as
+        (action, config, VIF ID).  This does not touch self.active, so that
+        many edges can be reconciled concurrently.  The outcome is journaled
+        as soon as it is known.
+        """
+        try:
+            done = await self._reconcile_edge_steps(backend, frontend, steps, vifid)
+        finally:
+            PENDING_EDGES.inc(-1)
+        try:
+            self.store.confirm_intent(backend, frontend, done)
+        except Exception:
+            # The edge will look in flight to recover(), which is safe.
+            log.exception("Could not journal outcome for %s %s", backend, frontend)
+        return done
 
-    def disjoin_vm_from_peers(self, vm: qubes.vm.BaseVM) -> None:
-        with with_qubes() as q:
-            domains = q.domains
-            combos = self.active.connections(vm)
-            for backend, frontend in combos:
-                if backend not in domains or frontend not in domains:
-                    continue
-                vifid_to_detach = self.active.frontend_network_id(backend, frontend)
-                if vm == frontend:
-                    # This VM was a frontend; the VIF is cleaned up by Xen
-                    # from tke backend automatically so we cannot detach it
-                    # even if we wanted to; hence we only deregister.
-                    log.info(
-                        "Unlinked already-detached backend %s from frontend %s VIF %s",
+    async def _reconcile_edge_steps(
+        self,
+        backend: str,
+        frontend: str,
+        steps: list[tuple[str, Parameters]],
+        vifid: str | None,
+    ) -> list[tuple[str, Parameters, str | None]]:
+        done: list[tuple[str, Parameters, str | None]] = []
+        for action, config in steps:
+            if action == ACTION_ADD:
+                try:
+                    vifid = await self.devices.attach(
+                        backend, frontend, frontend_mac=config.frontend_mac
+                    )
+                except DeviceError:
+                    ATTACHES.inc(result="failure")
+                    log.exception(
+                        "Could not attach backend %s to frontend %s",
                         backend,
                         frontend,
-                        vifid_to_detach,
                     )
-                    self.active.disjoin(backend, frontend)
-                    continue
+                    self.retries.add(backend, frontend)
+                    break
+                ATTACHES.inc(result="success")
+                self.retries.discard(backend, frontend)
+                log.info(
+                    "Attached backend %s to frontend %s with frontend VIF %s config %s",
+                    backend,
+                    frontend,
+                    vifid,
+                    config,
+                )
+                done.append((action, config, vifid))
+            elif action == ACTION_REMOVE:
                 try:
-                    if vifid_to_detach is not None:
-                        detach(frontend, vifid_to_detach)
+                    if vifid is not None:
+                        await self.devices.detach(frontend, vifid)
+                        DETACHES.inc(result="success")
                         log.info(
-                            "Detached backend %s from frontend %s VIF %s",
+                            "Detached backend %s from frontend %s VIF %s config %s",
                             backend,
                             frontend,
-                            vifid_to_detach,
+                            vifid,
+                            config,
                         )
                     else:
                         log.info(
                             "No need to detach backend %s from frontend %s since VIF is %s",
                             backend,
                             frontend,
-                            vifid_to_detach,
+                            vifid,
                         )
-                except subprocess.CalledProcessError:
+                except DeviceError:
+                    DETACHES.inc(result="failure")
                     log.exception(
                         "Could not detach backend %s from frontend %s VIF %s",
                         backend,
                         frontend,
-                        vifid_to_detach,
+                        vifid,
                     )
+                    assert vifid is not None
+                    self.retries.add(backend, frontend, vifid)
+                done.append((action, config, vifid))
+                vifid = None
+        return done
+
+    async def _execute(
+        self,
+        work: dict[tuple[str, str], list[tuple[str, Parameters]]],
+        domains: typing.Any,
+    ) -> None:
+        """
+        Journals the intents for all edges in work, reconciles them
+        concurrently, then records the outcome in self.active, firing the
+        link events for it.  Persisting it is up to the caller.
+        """
+        edges = list(work)
+        if not edges:
+            return
+        self.store.record_intents(
+            {
+                (backend, frontend): (
+                    work[(backend, frontend)],
+                    self.active.frontend_network_id(backend, frontend),
+                )
+                for backend, frontend in edges
+            }
+        )
+        self._journaled = True
+        PENDING_EDGES.inc(len(edges))
+        results = await self._executor.run(
+            [
+                (
+                    backend,
+                    frontend,
+                    functools.partial(
+                        self._reconcile_edge,
+                        backend,
+                        frontend,
+                        work[(backend, frontend)],
+                        self.active.frontend_network_id(backend, frontend),
+                    ),
+                )
+                for backend, frontend in edges
+            ]
+        )
+        for (backend, frontend), result in zip(edges, results):
+            if isinstance(result, BaseException):
+                log.error(
+                    "Unexpected failure reconciling backend %s with frontend %s",
+                    backend,
+                    frontend,
+                    exc_info=result,
+                )
+                # Whether its VIF got attached or detached is unknown, until
+                # the next pass recovers it from the journal.
+                self._unconfirmed.add((backend, frontend))
+                self._resynced = False
+                continue
+            self._unconfirmed.discard((backend, frontend))
+            self._record_outcome(domains, backend, frontend, result)
+
+    def _record_outcome(
+        self,
+        domains: typing.Any,
+        backend: str,
+        frontend: str,
+        done: list[tuple[str, Parameters, str | None]],
+    ) -> None:
+        # Recording an outcome twice, as recover() may, changes nothing.
+        edge = (backend, frontend)
+        for action, config, vifid in done:
+            if action == ACTION_ADD:
+                if self.active.get(edge) == VifAttachment(config, vifid):
+                    continue
+                self.active.conjoin(
+                    backend,
+                    frontend,
+                    config=config,
+                    frontend_network_id=vifid,
+                )
+                event = LINK_ATTACHED
+            elif action == ACTION_REMOVE:
+                if edge not in self.active:
+                    continue
                 self.active.disjoin(backend, frontend)
-            ConjoinStore().save(self.active)
+                event = LINK_DETACHED
+            else:
+                continue
+            self._fire_link_event(domains, event, backend, frontend, vifid, config)
+
+    def _conjoin_work(
+        self, vms: typing.Iterable[str], app: qubes.Qubes
+    ) -> dict[tuple[str, str], list[tuple[str, Parameters]]]:
+        steps: dict[tuple[str, str], list[tuple[str, Parameters]]] = {}
+        for vm in vms:
+            generations = (
+                self.config.vm_generation(vm),
+                self.active.vm_generation(vm),
+            )
+            if self._converged.get(vm) == generations:
+                # Its links were as configured, and none changed since.
+                SKIPPED_VMS.inc()
+                continue
+            seen = set(steps)
+            diff = self.config.diff(self.active, limit_to_vm=vm)
+            if not diff:
+                self._converged[vm] = generations
+            for action, backend, frontend, config in diff:
+                if (backend, frontend) in seen:
+                    # Already planned while looking at its other end.
+                    continue
+                steps.setdefault((backend, frontend), []).append((action, config))
+        domains = app.domains
+        work: dict[tuple[str, str], list[tuple[str, Parameters]]] = {}
+        # Only edges between running, unpaused domains can be worked on.
+        for backend, frontend in self.states.actionable(app, steps):
+            if backend not in domains or frontend not in domains:
+                continue
+            edge_steps = work[(backend, frontend)] = steps[(backend, frontend)]
+            action, config = edge_steps[-1]
+            self._publish_addressing(
+                domains[backend], frontend, config if action == ACTION_ADD else None
+            )
+        return work
+
+    def _publish_addressing(
+        self, backend: qubes.vm.BaseVM, frontend: str, config: Parameters | None
+    ) -> None:
+        """
+        Publishes in the qubesdb of backend the addressing of its VIF for
+        frontend, before it is attached, as "<backend IP> <routes>", with
+        routes separated by commas and - standing for none.
+        """
+        path = ADDRESSING_PATH + frontend
+        try:
+            if config is None or not (config.backend_ip or config.routes):
+                backend.untrusted_qdb.rm(path)
+            else:
+                backend.untrusted_qdb.write(
+                    path,
+                    "%s %s"
+                    % (config.backend_ip or "-", ",".join(config.routes) or "-"),
+                )
+        except Exception:
+            log.exception(
+                "Could not publish addressing of frontend %s in backend %s",
+                frontend,
+                backend.name,
+            )
+
+    def _unlink(self, domains: typing.Any, backend: str, frontend: str) -> str | None:
+        vifid = self.active.frontend_network_id(backend, frontend)
+        config = self.active.config(backend, frontend)
+        self.active.disjoin(backend, frontend)
+        self._fire_link_event(domains, LINK_DETACHED, backend, frontend, vifid, config)
+        return vifid
+
+    def _disjoin_work(
+        self, vms: typing.Iterable[str], domains: typing.Any
+    ) -> dict[tuple[str, str], list[tuple[str, Parameters]]]:
+        vms = list(vms)
+        going = set(vms)
+        work: dict[tuple[str, str], list[tuple[str, Parameters]]] = {}
+        for vm in vms:
+            for backend, frontend in self.active.connections(vm):
+                if backend not in domains or frontend not in domains:
+                    continue
+                if frontend in going:
+                    # The frontend went down; the VIF is cleaned up by Xen
+                    # from the backend automatically so we cannot detach it
+                    # even if we wanted to; hence we only deregister.
+                    log.info(
+                        "Unlinked already-detached backend %s from frontend %s VIF %s",
+                        backend,
+                        frontend,
+                        self._unlink(domains, backend, frontend),
+                    )
+                    continue
+                if self._is_stopping(frontend):
+                    # The frontend is going down too, and will take the VIF
+                    # with it, so detaching it is only worth the trouble if
+                    # it stays up after all.
+                    self._defer_detach(domains, backend, frontend)
+                    continue
+                work[(backend, frontend)] = [
+                    (ACTION_REMOVE, self.active.config(backend, frontend))
+                ]
+        return work
+
+    def _is_stopping(self, vm: str) -> bool:
+        # A VM still up when it should have been down, as when its shutdown
+        # was vetoed, is taken as staying up.
+        deadline = self._stopping.get(vm)
+        if deadline is None:
+            return False
+        if deadline > time.monotonic():
+            return True
+        del self._stopping[vm]
+        return False
+
+    def _defer_detach(self, domains: typing.Any, backend: str, frontend: str) -> None:
+        vifid = self._unlink(domains, backend, frontend)
+        log.info(
+            "Left VIF %s of backend %s for frontend %s to go away with it",
+            vifid,
+            backend,
+            frontend,
+        )
+        if vifid is None:
+            return
+        self._deferred.setdefault(frontend, []).append((backend, vifid))
+        if frontend not in self._deferred_timers:
+            grace = getattr(domains[frontend], "shutdown_timeout", None)
+            self._deferred_timers[frontend] = asyncio.get_event_loop().call_later(
+                float(grace or DEFAULT_SHUTDOWN_GRACE),
+                self._detach_deferred,
+                frontend,
+            )
+
+    def _forget_deferred(self, frontend: str) -> None:
+        timer = self._deferred_timers.pop(frontend, None)
+        if timer is not None:
+            timer.cancel()
+        self._deferred.pop(frontend, None)
+
+    def _detach_deferred(self, frontend: str) -> None:
+        # The frontend did not go down in time, so its VIFs whose backends
+        # did must be detached after all.
+        self._deferred_timers.pop(frontend, None)
+        self._stopping.pop(frontend, None)
+        for backend, vifid in self._deferred.pop(frontend, []):
+            log.warning(
+                "Frontend %s did not shut down, detaching VIF %s of backend %s",
+                frontend,
+                vifid,
+                backend,
+            )
+            task = asyncio.ensure_future(
+                self._retry_detach(RetryEntry(backend, frontend, vifid))
+            )
+            self._retry_tasks.add(task)
+            task.add_done_callback(self._retry_tasks.discard)
+
+    async def reconcile(
+        self,
+        disjoin: typing.Iterable[str] = (),
+        conjoin: typing.Iterable[str] = (),
+        app: qubes.Qubes | None = None,
+    ) -> None:
+        """
+        Tears down the links of the VMs in disjoin, then brings the links
+        of the VMs in conjoin in line with the configuration, and persists
+        the outcome once.
+        """
+        with with_qubes(app) as q:
+            domains = q.domains
+            with PHASE_SECONDS.time(phase="plan_disjoin"):
+                work = self._disjoin_work(disjoin, domains)
+            with PHASE_SECONDS.time(phase="execute"):
+                await self._execute(work, domains)
+            with PHASE_SECONDS.time(phase="plan_conjoin"):
+                work = self._conjoin_work(conjoin, q)
+            with PHASE_SECONDS.time(phase="execute"):
+                await self._execute(work, domains)
+            with PHASE_SECONDS.time(phase="save"):
+                if self.active.generation != self._saved:
+                    self.store.save(self.active)
+                    self._saved = self.active.generation
+                if self._journaled:
+                    self.store.clear_intents(keep=self._unconfirmed)
+                    self._journaled = False
+
+    def _actual_config(
+        self, backend: str, frontend: str, mac: MacAddress | None
+    ) -> Parameters:
+        # The configuration of a VIF found attached, as far as it can be told
+        # from its MAC address.
+        if (backend, frontend) in self.config:
+            config = self.config.config(backend, frontend)
+            if config.frontend_mac in (None, mac):
+                return config
+        return Parameters(frontend_mac=mac)
+
+    async def recover(self, app: qubes.Qubes | None = None) -> None:
+        """
+        Brings self.active up to date when qubesd starts, from the journal:
+        the outcome of steps that completed is recorded, and only the VIFs
+        of the frontends of edges still in flight are looked at, as by
+        resync().  Should the journal be unreadable, all VIFs are.
+        """
+        self._delayed_graphs_loader(app=app)
+        # Edges of unknown outcome are among those looked into now.
+        self._unconfirmed.clear()
+        try:
+            intents = self.store.intents()
+        except Exception:
+            log.exception("Could not read the journal, looking at all VIFs")
+            # It is of no use any more, once all VIFs have been looked at.
+            self._journaled = True
+            await self.resync(app=app)
+            return
+        in_flight = {f for (_, f), done in intents.items() if done is None}
+        if intents:
+            log.info(
+                "Recovering %s journaled edges, of which %s in flight",
+                len(intents),
+                sum(1 for done in intents.values() if done is None),
+            )
+            self._journaled = True
+        with with_qubes(app) as q:
+            for (backend, frontend), done in intents.items():
+                if done:
+                    self._record_outcome(q.domains, backend, frontend, done)
+        await self.resync(app=app, frontends=in_flight)
+
+    async def resync(
+        self,
+        app: qubes.Qubes | None = None,
+        frontends: typing.Collection[str] | None = None,
+    ) -> None:
+        """
+        Rebuilds self.active from the VIFs actually attached to the running
+        domains, as found in one bulk query, detaching any duplicates.  If
+        frontends is given, only the links to those are rebuilt.  Then
+        brings the links of all running VMs in line with the configuration,
+        and drops those of VMs no longer running, in a single pass.
+        """
+        self._delayed_graphs_loader(app=app)
+        self._resynced = True
+        # Domains may have changed state unnoticed, as VIFs may have.
+        self.states.invalidate()
+        self._restore_retries()
+        if frontends is None or frontends:
+            try:
+                with PHASE_SECONDS.time(phase="inventory"):
+                    vifs = await self.devices.inventory(frontends)
+            except (DeviceError, NotImplementedError):
+                log.exception("Could not list attached VIFs, trusting the store")
+                return
+            await self._adopt(vifs, frontends, app)
+        with with_qubes(app) as q:
+            running = self.states.running(q)
+        up = set(running)
+        stale = sorted({vm for edge in self.active for vm in edge if vm not in up})
+        await self.reconcile(disjoin=stale, conjoin=running, app=app)
+
+    async def _adopt(
+        self,
+        vifs: list[Vif],
+        frontends: typing.Collection[str] | None,
+        app: qubes.Qubes | None,
+    ) -> None:
+        # Makes self.active match vifs, as far as the links to frontends (or
+        # all links) go, detaching duplicate VIFs.
+        found: dict[Edge, list[tuple[str, MacAddress | None]]] = {}
+        for backend, frontend, vifid, mac in vifs:
+            found.setdefault((backend, frontend), []).append((vifid, mac))
+        active = ConjoinTracker()
+        if frontends is not None:
+            for (backend, frontend), v in self.active.items():
+                if frontend not in frontends:
+                    active[(backend, frontend)] = v
+        duplicates: list[tuple[str, str, str]] = []
+        for (backend, frontend), candidates in found.items():
+            known = self.active.get((backend, frontend))
+            known_vifid = known.frontend_network_id if known else None
+            # Keep the VIF on record if it is still attached.
+            candidates.sort(key=lambda c: c[0] != known_vifid)
+            (vifid, mac), rest = candidates[0], candidates[1:]
+            duplicates.extend((backend, frontend, x) for x, _ in rest)
+            if known is not None and vifid == known_vifid:
+                config = known.config
+            else:
+                config = self._actual_config(backend, frontend, mac)
+            active.conjoin(backend, frontend, config, vifid)
+        drift = active.plan(self.active)
+        if drift or duplicates:
+            log.warning(
+                "Active configuration drifted from attached VIFs: %s duplicates %s",
+                drift,
+                duplicates,
+            )
+        old, self.active = self.active, active
+        results = await self._executor.run(
+            [
+                (
+                    backend,
+                    frontend,
+                    functools.partial(self.devices.detach, frontend, vifid),
+                )
+                for backend, frontend, vifid in duplicates
+            ]
+        )
+        for (backend, frontend, vifid), result in zip(duplicates, results):
+            if isinstance(result, BaseException):
+                log.error(
+                    "Could not detach duplicate VIF %s of backend %s in frontend %s",
+                    vifid,
+                    backend,
+                    frontend,
+                    exc_info=result,
+                )
+        with with_qubes(app) as q:
+            for backend, frontend, config in drift.removes:
+                self._fire_link_event(
+                    q.domains,
+                    LINK_DETACHED,
+                    backend,
+                    frontend,
+                    old.frontend_network_id(backend, frontend),
+                    config,
+                )
+            for backend, frontend, config in drift.adds:
+                self._fire_link_event(
+                    q.domains,
+                    LINK_ATTACHED,
+                    backend,
+                    frontend,
+                    active.frontend_network_id(backend, frontend),
+                    config,
+                )
+
+    async def conjoin_vm_with_peers(
+        self, vm: str, app: qubes.Qubes | None = None
+    ) -> None:
+        await self.reconcile(conjoin=[vm], app=app)
+
+    async def disjoin_vm_from_peers(
+        self, vm: str, app: qubes.Qubes | None = None
+    ) -> None:
+        await self.reconcile(disjoin=[vm], app=app)
 
     @qubes.ext.handler(
         "domain-feature-pre-set:attach-network-to",  # type: ignore
@@ -217,8 +990,13 @@ class QubesArbitraryNetworkTopologyExtension(qubes.ext.Extension):  # type:ignor
         value: str,
         oldvalue: str | None = None,
     ) -> None:
-        # Attempt to load configuration with new value, but do not apply it.
-        self._delayed_graphs_loader(value, subject.name, apply=False)
+        # Check the new value against the indexes of the configuration, which
+        # is only loaded in full the first time.
+        self._delayed_graphs_loader(app=subject.app)
+        with PHASE_SECONDS.time(phase="validate"):
+            self.config.validate_frontends(
+                subject.name, value, lambda vm: vm in subject.app.domains
+            )
 
     @qubes.ext.handler(
         "domain-feature-set:attach-network-to",  # type: ignore
@@ -227,26 +1005,121 @@ class QubesArbitraryNetworkTopologyExtension(qubes.ext.Extension):  # type:ignor
     def on_attach_network_to_changed(
         self, vm: qubes.vm.BaseVM, unused_event: typing.Any, **kwargs: typing.Any
     ) -> None:
-        self._delayed_graphs_loader(kwargs.get("value", None), vm.name)
-        self.conjoin_vm_with_peers(vm.name)
+        self._app = vm.app
+        before = self._frontend_configs(vm.name)
+        self._delayed_graphs_loader(kwargs.get("value", None), vm.name, app=vm.app)
+        after = self._frontend_configs(vm.name)
+        # Operations given up on edges configured anew may succeed now.
+        for frontend in before.keys() | after.keys():
+            if before.get(frontend) != after.get(frontend):
+                self.retries.reset(vm.name, frontend)
+        self.scheduler.conjoin(vm.name)
+
+    def _frontend_configs(self, backend: str) -> dict[str, Parameters]:
+        if self.config is None:
+            return {}
+        return {
+            f: self.config.config(backend, f) for f in self.config.frontends(backend)
+        }
+
+    @qubes.ext.handler("domain-delete", system=True)  # type: ignore
+    def on_domain_deleted(
+        self,
+        unused_app: qubes.Qubes,
+        unused_event: typing.Any,
+        vm: qubes.vm.BaseVM,
+        **unused_kwargs: typing.Any,
+    ) -> None:
+        self.states.stopped(vm.name)
+        if self.config is not None:
+            self.config.replace_frontends(vm.name, None)
+            # Other VMs may still name it in their feature.
+            for backend in self.config.backends(vm.name):
+                self.config.disjoin(backend, vm.name)
+
+    @qubes.ext.handler("domain-load")  # type: ignore
+    def on_domain_loaded(
+        self, vm: qubes.vm.BaseVM, unused_event: typing.Any, **unused_kwargs: typing.Any
+    ) -> None:
+        if vm.qid == 0:
+            # qubesd is starting, and the VIFs may have changed while it was
+            # not running.
+            self._app = vm.app
+            self.scheduler.resync()
 
     @qubes.ext.handler("domain-start")  # type: ignore
     def on_domain_started(
         self, vm: qubes.vm.BaseVM, unused_event: typing.Any, **unused_kwargs: typing.Any
     ) -> None:
-        self._delayed_graphs_loader()
-        self.conjoin_vm_with_peers(vm.name)
+        self._app = vm.app
+        self.states.started(vm.name)
+        self.retries.reset(vm.name)
+        self._stopping.pop(vm.name, None)
+        self._delayed_graphs_loader(app=vm.app)
+        self.scheduler.conjoin(vm.name)
+
+    @qubes.ext.handler("domain-paused")  # type: ignore
+    def on_domain_paused(
+        self, vm: qubes.vm.BaseVM, unused_event: typing.Any, **unused_kwargs: typing.Any
+    ) -> None:
+        self.states.paused(vm.name)
+        self.retries.reset(vm.name)
 
     @qubes.ext.handler("domain-unpaused")  # type: ignore
     def on_domain_unpaused(
         self, vm: qubes.vm.BaseVM, unused_event: typing.Any, **unused_kwargs: typing.Any
     ) -> None:
-        self._delayed_graphs_loader()
-        self.conjoin_vm_with_peers(vm.name)
+        self._app = vm.app
+        self.states.unpaused(vm.name)
+        self.retries.reset(vm.name)
+        self._stopping.pop(vm.name, None)
+        self._delayed_graphs_loader(app=vm.app)
+        self.scheduler.conjoin(vm.name)
+
+    @qubes.ext.handler("domain-pre-shutdown")  # type: ignore
+    def on_domain_pre_shutdown(
+        self, vm: qubes.vm.BaseVM, unused_event: typing.Any, **unused_kwargs: typing.Any
+    ) -> None:
+        # Links for which this VM is the frontend need not be detached when
+        # their backends go down before it does.
+        grace = getattr(vm, "shutdown_timeout", None)
+        self._stopping[vm.name] = time.monotonic() + float(
+            grace or DEFAULT_SHUTDOWN_GRACE
+        )
+
+    @qubes.ext.handler("domain-shutdown-failed")  # type: ignore
+    def on_domain_shutdown_failed(
+        self, vm: qubes.vm.BaseVM, unused_event: typing.Any, **unused_kwargs: typing.Any
+    ) -> None:
+        # The VM stays up, so the VIFs left to go away with it are detached
+        # now rather than once its shutdown timeout is over.
+        timer = self._deferred_timers.get(vm.name)
+        if timer is not None:
+            timer.cancel()
+        self._detach_deferred(vm.name)
 
     @qubes.ext.handler("domain-shutdown")  # type: ignore
     def on_domain_shutdown(
         self, vm: qubes.vm.BaseVM, unused_event: typing.Any, **kwargs: typing.Any
     ) -> None:
-        self._delayed_graphs_loader()
-        self.disjoin_vm_from_peers(vm.name)
+        self._app = vm.app
+        self.states.stopped(vm.name)
+        self.retries.reset(vm.name)
+        self._stopping.pop(vm.name, None)
+        self._forget_deferred(vm.name)
+        self._delayed_graphs_loader(app=vm.app)
+        self.scheduler.disjoin(vm.name)
+
+    @qubes.ext.handler(
+        "domain-feature-set:" + RECONCILE_DELAY_FEATURE,  # type: ignore
+        "domain-feature-delete:" + RECONCILE_DELAY_FEATURE,
+        "domain-feature-set:" + METRICS_FEATURE,
+        "domain-feature-delete:" + METRICS_FEATURE,
+        "domain-feature-set:" + HOLD_FEATURE,
+        "domain-feature-delete:" + HOLD_FEATURE,
+    )
+    def on_setting_changed(
+        self, vm: qubes.vm.BaseVM, event: str, **kwargs: typing.Any
+    ) -> None:
+        if vm.qid == 0:
+            self._apply_setting(event.split(":", 1)[1], kwargs.get("value", None))
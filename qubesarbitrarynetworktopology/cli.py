@@ -0,0 +1,445 @@
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import sys
+import time
+import typing
+
+
+from qubesarbitrarynetworktopology import (
+    DESIRED_PATH,
+    HOLD_FEATURE,
+    LINK_ATTACHED,
+    LINK_DETACHED,
+    PENDING_PATH,
+    RETRIES_PATH,
+)
+from qubesarbitrarynetworktopology.conjoin import ConjoinTracker
+from qubesarbitrarynetworktopology.persistence import ConjoinStore, read_tree
+
+
+FEATURE = "attach-network-to"
+# How long a hold lasts at most, in seconds, should whoever placed it die
+# before releasing it.
+HOLD_LEASE = 600.0
+
+
+@contextlib.contextmanager
+def held(
+    app: typing.Any, lease: float = HOLD_LEASE
+) -> typing.Generator[None, None, None]:
+    """
+    Holds reconciliation in qubesd while the body runs, so that all links
+    touched meanwhile are brought up in a single pass afterwards.  The hold
+    lapses after lease seconds regardless.  A hold placed by someone else
+    is left for them to release, unless it lapsed already.
+    """
+    features = app.domains["dom0"].features
+    current = features.get(HOLD_FEATURE)
+    if current:
+        try:
+            until = float(current)
+        except ValueError:
+            until = 0.0
+        if until > time.time():
+            print(
+                "Reconciliation is already held until %s.  Should whoever"
+                " holds it be gone, clear it with: qvm-features --unset dom0 %s"
+                % (time.strftime("%H:%M:%S", time.localtime(until)), HOLD_FEATURE),
+                file=sys.stderr,
+            )
+            yield
+            return
+        print("Replacing a lapsed hold on reconciliation", file=sys.stderr)
+    value = features[HOLD_FEATURE] = "%.0f" % (time.time() + lease)
+    try:
+        yield
+    finally:
+        # Unless it lapsed meanwhile, and someone else placed theirs.
+        if features.get(HOLD_FEATURE) == value:
+            del features[HOLD_FEATURE]
+
+
+def _tracker(app: typing.Any, vms: typing.Iterable[str]) -> ConjoinTracker:
+    return ConjoinTracker.from_vm_table(
+        {vm: app.domains[vm].features.get(FEATURE) for vm in vms}
+    )
+
+
+def parse_topology(text: str) -> ConjoinTracker:
+    """
+    Parses a topology description: one edge per line, made of the name
+    of the backend, followed by the name of the frontend and its parameters
+    as they would appear in the attach-network-to feature of the backend.
+    Blank lines and lines starting with # are ignored.  Raises ValueError
+    if the description is malformed.
+    """
+    table: dict[str, list[str]] = {}
+    for line in text.splitlines():
+        words = line.split()
+        if not words or words[0].startswith("#"):
+            continue
+        if len(words) < 2:
+            raise ValueError("edge without frontend: %r" % line)
+        table.setdefault(words[0], []).append(" ".join(words[1:]))
+    return ConjoinTracker.from_vm_table(
+        {backend: "\n".join(lines) for backend, lines in table.items()}
+    )
+
+
+def feature_value(tracker: ConjoinTracker, backend: str) -> str:
+    """
+    Returns the attach-network-to feature that describes the edges going
+    out of backend in tracker.
+    """
+    return "\n".join(
+        ("%s %s" % (frontend, tracker.config(backend, frontend))).rstrip()
+        for frontend in tracker.frontends(backend)
+    )
+
+
+def apply(
+    app: typing.Any,
+    desired: ConjoinTracker,
+    dry_run: bool = False,
+    out: typing.TextIO = sys.stdout,
+) -> list[str]:
+    """
+    Changes the attach-network-to features of VMs so that the topology
+    becomes desired, printing each edge that changes.  Only the features
+    of backends whose edges change are written, and reconciliation is held
+    until all of them are, so the links are reconciled in one pass.
+    Returns the names of the VMs whose features (would) change.  Raises
+    ValueError, before writing anything, if qubesd would refuse any of
+    them.
+    """
+    current = _tracker(app, [vm.name for vm in app.domains])
+    plan = desired.plan(current)
+    for backend, frontend, _ in plan.removes:
+        print("- %s %s" % (backend, frontend), file=out)
+    for backend, frontend, _, config in plan.replaces:
+        print(("~ %s %s %s" % (backend, frontend, config)).rstrip(), file=out)
+    for backend, frontend, config in plan.adds:
+        print(("+ %s %s %s" % (backend, frontend, config)).rstrip(), file=out)
+    backends = sorted(
+        {b for b, _, _ in plan.removes}
+        | {b for b, _, _, _ in plan.replaces}
+        | {b for b, _, _ in plan.adds}
+    )
+    for backend in backends:
+        desired.validate_frontends(
+            backend, feature_value(desired, backend), lambda vm: vm in app.domains
+        )
+    if dry_run or not backends:
+        return backends
+    # The links that go away or change are dropped first, for the MAC
+    # addresses they free to be free by the time another link takes them.
+    kept: dict[str, str] = {}
+    for backend in sorted(
+        {b for b, _, _ in plan.removes} | {b for b, _, _, _ in plan.replaces}
+    ):
+        kept[backend] = "\n".join(
+            ("%s %s" % (f, current.config(backend, f))).rstrip()
+            for f in current.frontends(backend)
+            if (backend, f) in desired
+            and desired.config(backend, f) == current.config(backend, f)
+        )
+    with held(app):
+        for backend, value in kept.items():
+            _set_feature(app, backend, value)
+        for backend in backends:
+            value = feature_value(desired, backend)
+            if kept.get(backend) != value:
+                _set_feature(app, backend, value)
+    return backends
+
+
+def _set_feature(app: typing.Any, vm: str, value: str) -> None:
+    features = app.domains[vm].features
+    if value:
+        features[FEATURE] = value
+    elif FEATURE in features:
+        del features[FEATURE]
+
+
+def start(
+    app: typing.Any,
+    vms: list[str],
+    max_parallel: int = 8,
+    dry_run: bool = False,
+    out: typing.TextIO = sys.stdout,
+) -> int:
+    """
+    Starts vms in waves, so that each VM starts after the VMs that back
+    it.  The VMs of a wave start in parallel, and reconciliation is held
+    until the whole wave is up, so the links of each wave are attached in
+    one batch.  Returns the number of VMs that failed to start.
+    """
+    waves = _tracker(app, vms).start_waves(vms)
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_parallel) as pool:
+        for n, wave in enumerate(waves, 1):
+            print("Wave %s: %s" % (n, " ".join(wave)), file=out)
+            if dry_run:
+                continue
+            domains = [app.domains[vm] for vm in wave]
+            with held(app):
+                futures = {
+                    pool.submit(domain.start): domain.name
+                    for domain in domains
+                    if not domain.is_running()
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed += 1
+                        print(
+                            "Could not start %s: %s" % (futures[future], e),
+                            file=sys.stderr,
+                        )
+    return failed
+
+
+def format_retries(entries: list[dict[str, typing.Any]], now: float) -> str:
+    """
+    Formats retries, as persisted by the extension, as a table.
+    """
+    lines = ["BACKEND FRONTEND KIND ATTEMPTS NEXT"]
+    for e in entries:
+        if e["gave_up"]:
+            when = "gave-up"
+        else:
+            when = "%ds" % max(0, round((e["not_before"] or now) - now))
+        lines.append(
+            "%s %s %s %s %s"
+            % (
+                e["backend"],
+                e["frontend"],
+                "attach" if e["vifid"] is None else "detach:%s" % e["vifid"],
+                e["attempts"],
+                when,
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def read_topology(db: typing.Any) -> dict[str, list[dict[str, typing.Any]]]:
+    """
+    Reads the topology as published by the extension in the qubesdb of
+    dom0, in the form returned by its desired_graph(), active_graph() and
+    pending() methods.
+    """
+    desired = read_tree(db, DESIRED_PATH)
+    active = read_tree(db, ConjoinStore.PATH)
+    pending = read_tree(db, PENDING_PATH)
+    return {
+        "desired": [
+            {"backend": b, "frontend": f, "config": c}
+            for (b, f), (c,) in sorted(desired.items())
+        ],
+        "active": [
+            {"backend": b, "frontend": f, "config": c, "vifid": vifid}
+            for (b, f), (c, vifid) in sorted(active.items())
+        ],
+        "pending": [
+            {"backend": b, "frontend": f, "action": action, "config": c}
+            for (b, f), (action, c) in sorted(pending.items())
+        ],
+    }
+
+
+def format_topology(topology: dict[str, list[dict[str, typing.Any]]]) -> str:
+    """
+    Formats a topology, as returned by read_topology, as a table of all
+    edges either configured or attached.
+    """
+    edges: dict[tuple[str, str], list[typing.Any]] = {}
+    for e in topology["active"]:
+        edges[(e["backend"], e["frontend"])] = ["attached", e["vifid"], e["config"]]
+    for e in topology["desired"]:
+        edge = edges.setdefault((e["backend"], e["frontend"]), ["-", None, ""])
+        edge[2] = e["config"]
+    for e in topology["pending"]:
+        edge = edges.setdefault((e["backend"], e["frontend"]), ["-", None, ""])
+        edge[0] = "pending-%s" % e["action"]
+    lines = ["BACKEND FRONTEND STATE VIF CONFIG"]
+    for (backend, frontend), (state, vifid, config) in sorted(edges.items()):
+        lines.append(
+            (
+                "%s %s %s %s %s"
+                % (backend, frontend, state, "-" if vifid is None else vifid, config)
+            ).rstrip()
+        )
+    return "\n".join(lines) + "\n"
+
+
+def format_link_event(subject: typing.Any, event: str, **kwargs: typing.Any) -> str:
+    """
+    Formats a link event as "+" or "-", then backend, frontend, VIF ID and
+    parameters.
+    """
+    return (
+        "%s %s %s %s %s"
+        % (
+            "+" if event == LINK_ATTACHED else "-",
+            subject,
+            kwargs.get("frontend"),
+            kwargs.get("vifid"),
+            kwargs.get("config") or "",
+        )
+    ).rstrip()
+
+
+def watch(app: typing.Any, out: typing.TextIO = sys.stdout) -> None:
+    """
+    Prints each link that comes up or goes away, as qubesd reports it.
+    """
+    import asyncio
+    import qubesadmin.events
+
+    dispatcher = qubesadmin.events.EventsDispatcher(app)
+
+    def handler(subject: typing.Any, event: str, **kwargs: typing.Any) -> None:
+        print(format_link_event(subject, event, **kwargs), file=out, flush=True)
+
+    dispatcher.add_handler(LINK_ATTACHED, handler)
+    dispatcher.add_handler(LINK_DETACHED, handler)
+    asyncio.run(dispatcher.listen_for_events())
+
+
+def main(argv: list[str] | None = None) -> int:
+    p = argparse.ArgumentParser(
+        prog="qvm-network-topology",
+        description="Manage the arbitrary network topology of this system.",
+    )
+    commands = p.add_subparsers(dest="command", required=True)
+
+    s = commands.add_parser(
+        "start",
+        help="start VMs in the order given by the topology",
+        description="Start VMs in waves, backends before their frontends,"
+        " each wave in parallel.",
+    )
+    s.add_argument("vms", nargs="+", metavar="VMNAME")
+    s.add_argument(
+        "--max-parallel",
+        type=int,
+        default=8,
+        help="maximum number of VMs starting at once (default: 8)",
+    )
+    s.add_argument("--dry-run", action="store_true", help="only print the waves")
+
+    a = commands.add_parser(
+        "apply",
+        help="make the topology match a description",
+        description="Change the attach-network-to features of VMs so that the"
+        " topology matches the description in FILE, which has one edge per line:"
+        " backend, frontend, and parameters such as frontend_mac=...  Edges not"
+        " in FILE are removed.",
+    )
+    a.add_argument("file", metavar="FILE", help="topology description, or -")
+    a.add_argument("--dry-run", action="store_true", help="only print the changes")
+
+    commands.add_parser(
+        "retries",
+        help="show failed attaches and detaches being retried",
+        description="Show the failed attaches and detaches that qubesd is"
+        " retrying, with the number of attempts so far and the time left until"
+        " the next one.",
+    )
+
+    o = commands.add_parser(
+        "show",
+        help="show the configured and active topology",
+        description="Show every link either configured or attached, with its"
+        " state, the ID of its VIF in the frontend, and its parameters.",
+    )
+    o.add_argument(
+        "--json",
+        action="store_true",
+        help="print the configured links, the attached links and the pending"
+        " changes as JSON",
+    )
+
+    commands.add_parser(
+        "watch",
+        help="print links as they come up or go away",
+        description="Print a line for each link that comes up (+) or goes away"
+        " (-): backend, frontend, VIF ID and parameters.",
+    )
+
+    args = p.parse_args(argv)
+
+    if args.command == "retries":
+        import qubesdb
+
+        tree = read_tree(qubesdb.QubesDB(), RETRIES_PATH)
+        entries = sorted(
+            (e for fields in tree.values() for e in fields),
+            key=lambda e: (e["backend"], e["frontend"], e["vifid"] or ""),
+        )
+        sys.stdout.write(format_retries(entries, time.time()))
+        return 0
+
+    if args.command == "show":
+        import qubesdb
+
+        topology = read_topology(qubesdb.QubesDB())
+        if args.json:
+            json.dump(topology, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            sys.stdout.write(format_topology(topology))
+        return 0
+
+    if args.command == "watch":
+        import qubesadmin
+
+        try:
+            watch(qubesadmin.Qubes())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command == "apply":
+        try:
+            if args.file == "-":
+                desired = parse_topology(sys.stdin.read())
+            else:
+                with open(args.file) as f:
+                    desired = parse_topology(f.read())
+        except (OSError, ValueError) as e:
+            p.error("cannot read topology: %s" % e)
+        vms = sorted({vm for edge in desired for vm in edge})
+    else:
+        vms = args.vms
+
+    import qubesadmin
+
+    app = qubesadmin.Qubes()
+    for vm in vms:
+        if vm not in app.domains:
+            p.error("no such VM: %s" % vm)
+    if args.command == "start":
+        return 1 if start(app, args.vms, args.max_parallel, args.dry_run) else 0
+    if args.command == "apply":
+        try:
+            changed = apply(app, desired, args.dry_run)
+        except ValueError as e:
+            p.error("cannot apply topology: %s" % e)
+        print(
+            "%s %s VM(s): %s"
+            % (
+                "Would change" if args.dry_run else "Changed",
+                len(changed),
+                " ".join(changed) or "none",
+            ),
+            file=sys.stderr,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,69 +1,166 @@
-import collections
+import collections.abc
+import functools
+import ipaddress
+import itertools
 import re
 import typing
+import weakref
 
 
 ACTION_ADD = "+"
 ACTION_REMOVE = "-"
 
 
-class MacAddress(str):
+MAC_ADDRESS = re.compile("^[0-9a-f]{2}(:[0-9a-f]{2}){5}$")
+
+
+class MacAddress(int):
+    """
+    MacAddress is a 48-bit MAC address, kept as an integer, that formats
+    as six colon-separated pairs of lowercase hex digits.
+    """
+
+    __slots__ = ()
+
+    def __new__(klass, value: int) -> "MacAddress":
+        if not 0 <= value < 1 << 48:
+            raise ValueError(value)
+        return super().__new__(klass, value)
+
     @classmethod
     def from_string(klass, s: str) -> "MacAddress":
-        if not re.match(
-            "^[0-9a-f][0-9a-f]:[0-9a-f][0-9a-f]:[0-9a-f][0-9a-f]:[0-9a-f][0-9a-f]:[0-9a-f][0-9a-f]:[0-9a-f][0-9a-f]$",
-            s,
-        ):
+        if not MAC_ADDRESS.match(s):
             raise ValueError(s)
-        return MacAddress(s)
+        return klass(int(s.replace(":", ""), 16))
+
+    def __str__(self) -> str:
+        return ":".join("%02x" % b for b in self.to_bytes(6, "big"))
+
+    def __repr__(self) -> str:
+        return self.__str__()
 
 
 class Parameters(object):
-    def __init__(self) -> None:
-        self.frontend_mac: MacAddress | None = None
+    """
+    Parameters is the immutable configuration of an edge.  Instances are
+    interned, so that all edges configured alike share one instance, and
+    comparing equal instances is an identity check.
+    """
+
+    __slots__ = (
+        "frontend_mac",
+        "backend_ip",
+        "routes",
+        "_hash",
+        "_str",
+        "__weakref__",
+    )
+
+    frontend_mac: MacAddress | None
+    # Address of the backend end of the VIF, and networks routed through
+    # the VIF, set up by vif-route-nexus in the backend.
+    backend_ip: str | None
+    routes: tuple[str, ...]
+    _hash: int
+    _str: str
+
+    _interned: typing.ClassVar[
+        "weakref.WeakValueDictionary[tuple[typing.Any, ...], Parameters]"
+    ] = weakref.WeakValueDictionary()
+
+    def __new__(
+        klass,
+        frontend_mac: MacAddress | None = None,
+        backend_ip: str | None = None,
+        routes: tuple[str, ...] = (),
+    ) -> "Parameters":
+        key = (frontend_mac, backend_ip, routes)
+        obj = klass._interned.get(key)
+        if obj is None:
+            obj = super().__new__(klass)
+            object.__setattr__(obj, "frontend_mac", frontend_mac)
+            object.__setattr__(obj, "backend_ip", backend_ip)
+            object.__setattr__(obj, "routes", routes)
+            object.__setattr__(obj, "_hash", hash(key))
+            object.__setattr__(obj, "_str", obj._format())
+            klass._interned[key] = obj
+        return obj
+
+    def __setattr__(self, name: str, value: typing.Any) -> None:
+        raise AttributeError("Parameters are immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("Parameters are immutable")
+
+    def _key(self) -> tuple[typing.Any, ...]:
+        return (self.frontend_mac, self.backend_ip, self.routes)
 
     def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
         if not isinstance(other, self.__class__):
             return False
-        return repr(self) == repr(other)
+        return self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return self._hash
 
     @classmethod
     def from_string(klass, s: str) -> "Parameters":
-        obj = klass()
         keypairs = s.split(" ")
         if not keypairs:
-            return obj
+            return klass()
         if len(keypairs) == 1 and keypairs[0] == "":
-            return obj
+            return klass()
 
+        frontend_mac = None
+        backend_ip = None
+        routes: tuple[str, ...] = ()
         for k in keypairs:
             k, sep, v = k.partition("=")
             if sep != "=":
                 raise ValueError("key without value in %r" % s)
             if k == "frontend_mac":
                 if v != "None":
-                    obj.frontend_mac = MacAddress.from_string(v)
+                    frontend_mac = MacAddress.from_string(v)
+            elif k == "backend_ip":
+                if v != "None":
+                    backend_ip = str(ipaddress.ip_address(v))
+            elif k == "routes":
+                routes = tuple(
+                    str(ipaddress.ip_network(r, strict=False))
+                    for r in v.split(",")
+                    if r
+                )
 
-        return obj
+        return klass(frontend_mac, backend_ip, routes)
 
     def __str__(self) -> str:
+        return self._str
+
+    def _format(self) -> str:
         setparms = []
-        if self.frontend_mac:
+        if self.frontend_mac is not None:
             setparms.append(f"frontend_mac={self.frontend_mac}")
+        if self.backend_ip:
+            setparms.append(f"backend_ip={self.backend_ip}")
+        if self.routes:
+            setparms.append("routes=" + ",".join(self.routes))
         return " ".join(setparms)
 
     def __repr__(self) -> str:
         return self.__str__()
 
 
-class VifAttachment:
+class VifAttachment(typing.NamedTuple):
+    """
+    VifAttachment is the state of an edge: its configuration, and the ID
+    of its VIF in the frontend if attached.
+    """
+
     config: Parameters
     frontend_network_id: str | None
 
-    def __init__(self, config: Parameters, frontend_network_id: str | None):
-        self.config = config
-        self.frontend_network_id = frontend_network_id
-
     def __str__(self) -> str:
         return (
             f"<VifAttachment ID {self.frontend_network_id} with config {self.config}>"
@@ -73,7 +170,148 @@ class VifAttachment:
         return self.__str__()
 
 
-class ConjoinTracker(dict[str, VifAttachment]):
+@functools.lru_cache(maxsize=1024)
+def parse_feature(feature: str) -> tuple[tuple[str, Parameters], ...]:
+    """
+    parse_feature parses the value of an attach-network-to feature into
+    a tuple of (frontend, config).  Results are memoized by the content
+    of the feature, so unchanged features are never parsed twice.
+    """
+    ret = []
+    for fe in feature.splitlines():
+        if not fe.strip():
+            continue
+        cfg = Parameters()
+        if len(fe.split(" ")) > 1:
+            fe, cfgstr = fe.split(" ", 1)
+            cfg = Parameters.from_string(cfgstr)
+        ret.append((fe, cfg))
+    return tuple(ret)
+
+
+Edge = tuple[str, str]
+
+# Generations are drawn from a single sequence shared by all trackers, so
+# that generations of different trackers never compare equal.
+_generations = itertools.count(1)
+
+
+class ConjoinTracker(collections.abc.MutableMapping[Edge, VifAttachment]):
+    """
+    ConjoinTracker maps (backend, frontend) edges to their VIF attachment.
+
+    Forward (backend to frontends) and reverse (frontend to backends)
+    adjacency indexes are maintained alongside the edges, so that
+    queries about a single VM cost O(its degree) rather than O(edges).
+    So is an index of the edges using each frontend MAC address.
+
+    generation changes whenever an edge changes, and vm_generation() of
+    a VM whenever one of its edges does, so that whoever has looked at the
+    tracker can tell whether it needs to look again.  Once asked to with
+    track_changes(), it can also tell which edges to look at with
+    changed_since().
+    """
+
+    def __init__(self) -> None:
+        self._edges: dict[Edge, VifAttachment] = {}
+        self._frontends: dict[str, dict[str, None]] = {}
+        self._backends: dict[str, dict[str, None]] = {}
+        self._macs: dict[MacAddress, dict[Edge, None]] = {}
+        self.generation = self._born = next(_generations)
+        self._vm_generations: dict[str, int] = {}
+        # Once changes are tracked, the generation at which each edge last
+        # changed, in that order, including edges since removed.
+        self._edge_generations: dict[Edge, int] | None = None
+        self._tracked_since = 0
+
+    def __getitem__(self, edge: Edge) -> VifAttachment:
+        return self._edges[edge]
+
+    def __setitem__(self, edge: Edge, attachment: VifAttachment) -> None:
+        backend, frontend = edge
+        if edge in self._edges:
+            if self._edges[edge] == attachment:
+                return
+            self._unindex_mac(edge)
+        self._bump(edge)
+        self._edges[edge] = attachment
+        self._frontends.setdefault(backend, {})[frontend] = None
+        self._backends.setdefault(frontend, {})[backend] = None
+        mac = attachment.config.frontend_mac
+        if mac is not None:
+            self._macs.setdefault(mac, {})[edge] = None
+
+    def __delitem__(self, edge: Edge) -> None:
+        backend, frontend = edge
+        self._unindex_mac(edge)
+        del self._edges[edge]
+        self._bump(edge)
+        for index, vm, other in (
+            (self._frontends, backend, frontend),
+            (self._backends, frontend, backend),
+        ):
+            del index[vm][other]
+            if not index[vm]:
+                del index[vm]
+
+    def _bump(self, edge: Edge) -> None:
+        self.generation = next(_generations)
+        for vm in edge:
+            self._vm_generations[vm] = self.generation
+        if self._edge_generations is not None:
+            # Moved to the end, for the edges to stay in generation order.
+            self._edge_generations.pop(edge, None)
+            self._edge_generations[edge] = self.generation
+
+    def vm_generation(self, vm: str) -> int:
+        return self._vm_generations.get(vm, self._born)
+
+    def track_changes(self) -> None:
+        """
+        track_changes has the edges that change from now on kept track of,
+        for changed_since().  This takes memory for each edge.
+        """
+        if self._edge_generations is None:
+            self._edge_generations = {}
+            self._tracked_since = self.generation
+
+    def changed_since(self, generation: int) -> list[Edge] | None:
+        """
+        changed_since returns the edges added, changed or removed after the
+        given generation, at a cost proportional to their number, or None
+        if changes were not tracked back then.
+        """
+        if self._edge_generations is None or generation < self._tracked_since:
+            return None
+        changed: list[Edge] = []
+        for edge, g in reversed(self._edge_generations.items()):
+            if g <= generation:
+                break
+            changed.append(edge)
+        return changed
+
+    def _unindex_mac(self, edge: Edge) -> None:
+        mac = self._edges[edge].config.frontend_mac
+        if mac is not None:
+            del self._macs[mac][edge]
+            if not self._macs[mac]:
+                del self._macs[mac]
+
+    def __contains__(self, edge: object) -> bool:
+        return edge in self._edges
+
+    def __iter__(self) -> typing.Iterator[Edge]:
+        return iter(self._edges)
+
+    def __len__(self) -> int:
+        return len(self._edges)
+
+    def __str__(self) -> str:
+        return str(self._edges)
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
     def conjoin(
         self,
         backend: str,
@@ -81,40 +319,30 @@ class ConjoinTracker(dict[str, VifAttachment]):
         config: Parameters,
         frontend_network_id: str | None,
     ) -> None:
-        self["%s %s" % (backend, frontend)] = VifAttachment(
+        self[(backend, frontend)] = VifAttachment(
             config=config,
             frontend_network_id=frontend_network_id,
         )
 
     def disjoin(self, backend: str, frontend: str) -> None:
-        del self["%s %s" % (backend, frontend)]
+        del self[(backend, frontend)]
 
     def frontend_network_id(
         self, backend: str, frontend: str
     ) -> typing.Union[str, None]:
         try:
-            return self["%s %s" % (backend, frontend)].frontend_network_id
+            return self[(backend, frontend)].frontend_network_id
         except KeyError:
             return None
 
     def config(self, backend: str, frontend: str) -> Parameters:
-        return self["%s %s" % (backend, frontend)].config
-
-    def _others(
-        self, me: str, compare_column: int, return_column: int
-    ) -> typing.List[str]:
-        ret = []
-        for k in self.keys():
-            cols = k.split(" ", 1)
-            if cols[compare_column] == me:
-                ret.append(cols[return_column])
-        return ret
+        return self[(backend, frontend)].config
 
     def frontends(self, backend: str) -> list[str]:
-        return self._others(backend, 0, 1)
+        return list(self._frontends.get(backend, ()))
 
     def backends(self, frontend: str) -> list[str]:
-        return self._others(frontend, 1, 0)
+        return list(self._backends.get(frontend, ()))
 
     def connections(self, vm: str) -> list[tuple[str, str]]:
         """
@@ -125,6 +353,94 @@ class ConjoinTracker(dict[str, VifAttachment]):
             (vm, x) for x in self.frontends(vm)
         ]
 
+    def start_waves(self, vms: typing.Iterable[str]) -> list[list[str]]:
+        """
+        start_waves orders vms into waves to be started one after the
+        other, the VMs of each wave in parallel, so that every VM starts
+        after those among vms that back it.  VMs that cannot be ordered,
+        because they are on or behind a cycle, make up the last wave.
+        """
+        # vm -> number of its backends among vms not yet placed in a wave.
+        waiting = {vm: 0 for vm in vms}
+        for vm in waiting:
+            for backend in self.backends(vm):
+                if backend in waiting and backend != vm:
+                    waiting[vm] += 1
+        waves: list[list[str]] = []
+        wave = sorted(vm for vm, n in waiting.items() if n == 0)
+        while wave:
+            waves.append(wave)
+            for vm in wave:
+                del waiting[vm]
+            ready: list[str] = []
+            for vm in wave:
+                for frontend in self.frontends(vm):
+                    if frontend in waiting and frontend != vm:
+                        waiting[frontend] -= 1
+                        if waiting[frontend] == 0:
+                            ready.append(frontend)
+            wave = sorted(ready)
+        if waiting:
+            waves.append(sorted(waiting))
+        return waves
+
+    def using_mac(self, mac: MacAddress) -> list[Edge]:
+        """
+        using_mac returns the edges whose frontend uses MAC address mac.
+        """
+        return list(self._macs.get(mac, ()))
+
+    def validate_frontends(
+        self,
+        backend: str,
+        feature: str | None,
+        exists: typing.Callable[[str], bool],
+    ) -> None:
+        """
+        validate_frontends raises ValueError unless feature may become the
+        attach-network-to feature of backend: every frontend must exist
+        (according to exists), differ from backend and be listed once, and
+        no frontend MAC address may end up used by two edges.  This costs
+        O(edges in feature), whatever the size of the topology.
+        """
+        frontends: dict[str, None] = {}
+        macs: dict[MacAddress, str] = {}
+        for frontend, cfg in parse_feature(feature or ""):
+            if frontend == backend:
+                raise ValueError("%s cannot be attached to itself" % backend)
+            if frontend in frontends:
+                raise ValueError("%s is listed more than once" % frontend)
+            frontends[frontend] = None
+            if not exists(frontend):
+                raise ValueError("%s does not exist" % frontend)
+            mac = cfg.frontend_mac
+            if mac is None:
+                continue
+            if mac in macs:
+                raise ValueError(
+                    "frontend_mac %s is given to both %s and %s"
+                    % (mac, macs[mac], frontend)
+                )
+            macs[mac] = frontend
+            for b, f in self.using_mac(mac):
+                # Edges going out of backend are about to be replaced.
+                if b != backend:
+                    raise ValueError(
+                        "frontend_mac %s is already used by the link from %s to %s"
+                        % (mac, b, f)
+                    )
+
+    def replace_frontends(self, backend: str, feature: str | None) -> None:
+        """
+        replace_frontends replaces the edges going out of backend with
+        those described by feature, leaving all other edges untouched.
+        """
+        frontends_and_configs = parse_feature(feature or "")
+        for frontend in self.frontends(backend):
+            self.disjoin(backend, frontend)
+        for frontend, cfg in frontends_and_configs:
+            self.conjoin(backend, frontend, config=cfg, frontend_network_id=None)
+
     @classmethod
     def from_vm_table(klass, vm_table: dict[str, str | None]) -> "ConjoinTracker":
         # vm_table is a dictionary vm_name -> feature config string.
@@ -132,23 +448,17 @@ class ConjoinTracker(dict[str, VifAttachment]):
         for backend, feature in vm_table.items():
             if not feature:
                 continue
-            frontends_and_configs = [f for f in feature.splitlines() if f.strip()]
-            if not frontends_and_configs:
-                continue
-            for fe in frontends_and_configs:
-                cfg = Parameters()
-                if len(fe.split(" ")) == 1:
-                    pass
-                else:
-                    fe, cfgstr = fe.split(" ", 1)
-                    cfg = Parameters.from_string(cfgstr)
+            for fe, cfg in parse_feature(feature):
                 me.conjoin(backend, fe, config=cfg, frontend_network_id=None)
         return me
 
     def to_serializable(self) -> dict[str, tuple[str, str | None]]:
         to_be_saved: dict[str, tuple[str, str | None]] = {}
-        for k, v in self.items():
-            to_be_saved[k] = str(v.config), v.frontend_network_id
+        for (backend, frontend), v in self.items():
+            to_be_saved["%s %s" % (backend, frontend)] = (
+                str(v.config),
+                v.frontend_network_id,
+            )
         return to_be_saved
 
     @classmethod
@@ -157,9 +467,41 @@ class ConjoinTracker(dict[str, VifAttachment]):
     ) -> "ConjoinTracker":
         o = klass()
         for k, (cfgstr, frontend_network_id) in d.items():
-            o[k] = VifAttachment(Parameters.from_string(cfgstr), frontend_network_id)
+            backend, frontend = k.split(" ", 1)
+            o[(backend, frontend)] = VifAttachment(
+                Parameters.from_string(cfgstr), frontend_network_id
+            )
         return o
 
+    def plan(
+        self, other: "ConjoinTracker", limit_to_vm: typing.Union[str, None] = None
+    ) -> "DiffPlan":
+        """
+        plan returns the DiffPlan that brings the second conjoiner in line
+        with the first.  If limit_to_vm is given, only the edges involving
+        that VM are examined, so the cost is proportional to its degree
+        rather than to the size of either graph.
+        """
+        if limit_to_vm is None:
+            edges: typing.Iterable[Edge] = set(self) | set(other)
+        else:
+            edges = set(self.connections(limit_to_vm)) | set(
+                other.connections(limit_to_vm)
+            )
+        adds: list[tuple[str, str, Parameters]] = []
+        removes: list[tuple[str, str, Parameters]] = []
+        replaces: list[tuple[str, str, Parameters, Parameters]] = []
+        for edge in sorted(edges):
+            mine, theirs = self.get(edge), other.get(edge)
+            if theirs is None:
+                assert mine is not None
+                adds.append((edge[0], edge[1], mine.config))
+            elif mine is None:
+                removes.append((edge[0], edge[1], theirs.config))
+            elif mine.config != theirs.config:
+                replaces.append((edge[0], edge[1], theirs.config, mine.config))
+        return DiffPlan(adds=adds, removes=removes, replaces=replaces)
+
     def diff(
         self, other: "ConjoinTracker", limit_to_vm: typing.Union[str, None] = None
     ) -> list[tuple[str, str, str, Parameters]]:
@@ -168,30 +510,52 @@ class ConjoinTracker(dict[str, VifAttachment]):
         the second conjoiner in line with the first, encoded as
         a list of (action, backend, frontend, config).
         """
-        diffs = []
-        common = collections.OrderedDict()
-        for item in self:
-            if item not in other:
-                first, second = item.split(" ", 1)
-                t = (ACTION_ADD, first, second, self[item].config)
-                diffs.append(t)
-            else:
-                common[item] = True
-        for item in other:
-            if item not in self:
-                first, second = item.split(" ", 1)
-                t = (ACTION_REMOVE, first, second, other[item].config)
-                diffs.append(t)
-                common[item] = True
-        for item in common:
-            if item not in self or item not in other:
-                continue
-            if str(self[item].config) != str(other[item].config):
-                first, second = item.split(" ", 1)
-                t = (ACTION_REMOVE, first, second, other[item].config)
-                diffs.append(t)
-                t = (ACTION_ADD, first, second, self[item].config)
-                diffs.append(t)
-        if limit_to_vm is not None:
-            diffs = [d for d in diffs if d[1] == limit_to_vm or d[2] == limit_to_vm]
-        return diffs
+        return self.plan(other, limit_to_vm=limit_to_vm).actions()
+
+
+class DiffPlan(object):
+    """
+    DiffPlan holds the changes that bring one conjoiner in line with
+    another, each list sorted by (backend, frontend):
+
+    * adds: (backend, frontend, config) of edges to attach,
+    * removes: (backend, frontend, config) of edges to detach,
+    * replaces: (backend, frontend, old config, new config) of edges
+      that must be detached and attached again with a new config.
+    """
+
+    def __init__(
+        self,
+        adds: list[tuple[str, str, Parameters]],
+        removes: list[tuple[str, str, Parameters]],
+        replaces: list[tuple[str, str, Parameters, Parameters]],
+    ) -> None:
+        self.adds = adds
+        self.removes = removes
+        self.replaces = replaces
+
+    def __bool__(self) -> bool:
+        return bool(self.adds or self.removes or self.replaces)
+
+    def __str__(self) -> str:
+        return (
+            f"<DiffPlan adds {self.adds} removes {self.removes}"
+            f" replaces {self.replaces}>"
+        )
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def actions(self) -> list[tuple[str, str, str, Parameters]]:
+        """
+        actions returns the plan as a list of (action, backend, frontend,
+        config).  Removals come first so that resources such as MAC
+        addresses are freed before they may be reused, then replacements
+        (as a removal followed by an addition), then additions.
+        """
+        ret = [(ACTION_REMOVE, b, f, cfg) for b, f, cfg in self.removes]
+        for b, f, old, new in self.replaces:
+            ret.append((ACTION_REMOVE, b, f, old))
+            ret.append((ACTION_ADD, b, f, new))
+        ret.extend((ACTION_ADD, b, f, cfg) for b, f, cfg in self.adds)
+        return ret
@@ -0,0 +1,305 @@
+import asyncio
+import codecs
+import logging
+import os
+import typing
+
+
+from qubesarbitrarynetworktopology.conjoin import MacAddress
+from qubesarbitrarynetworktopology.metrics import XL_SECONDS
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+VIF_SCRIPT = "vif-route-nexus"
+
+# (backend, frontend, VIF ID, MAC address) of a VIF.
+Vif = tuple[str, str, str, MacAddress | None]
+
+
+class DeviceError(Exception):
+    pass
+
+
+class DeviceBackend(object):
+    """
+    DeviceBackend attaches and detaches the VIFs that make up the links
+    of the topology.  Reconciliation only ever talks to this interface.
+    """
+
+    async def attach(
+        self, backend: str, frontend: str, frontend_mac: MacAddress | None = None
+    ) -> str:
+        """
+        attach creates a VIF in frontend served by backend, and returns
+        its ID as a string.  Raises DeviceError on failure.
+        """
+        raise NotImplementedError
+
+    async def detach(self, frontend: str, vifid: str) -> None:
+        """
+        detach removes VIF vifid from frontend.  Raises DeviceError on failure.
+        """
+        raise NotImplementedError
+
+    async def inventory(
+        self, frontends: typing.Collection[str] | None = None
+    ) -> list[Vif]:
+        """
+        inventory returns, in a single query, every VIF of the topology
+        (as opposed to those Qubes itself attaches) present in the running
+        domains, or only in frontends if given.  Raises DeviceError on
+        failure.
+        """
+        raise NotImplementedError
+
+
+async def _run(cmd: list[str], capture: bool = False) -> str:
+    """
+    Runs cmd without blocking the event loop, raising DeviceError if it
+    fails.  Returns its standard output if capture is set.
+    """
+    with XL_SECONDS.time(command=cmd[1] if cmd[0] == "xl" else cmd[0]):
+        p = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE if capture else None,
+        )
+        stdout, _ = await p.communicate()
+    output = stdout.decode("utf-8") if stdout else ""
+    if p.returncode != 0:
+        raise DeviceError("%s exited with status %s" % (" ".join(cmd), p.returncode))
+    return output
+
+
+def _str(s: str | bytes) -> str:
+    return s.decode("utf-8") if isinstance(s, bytes) else s
+
+
+def _inventory(
+    ls: typing.Callable[[str], list[str]],
+    read: typing.Callable[[str], str | None],
+    frontends: typing.Collection[str] | None = None,
+) -> list[Vif]:
+    """
+    Lists the VIFs set up with VIF_SCRIPT, given functions that list and
+    read xenstore paths.  If frontends is given, only the VIFs of those
+    are looked at, found through the frontend side of the tree.
+    """
+    names: dict[str, str] = {}
+    for domid in ls("/local/domain"):
+        name = read("/local/domain/%s/name" % domid)
+        if name:
+            names[domid] = "dom0" if name == "Domain-0" else name
+    # (backend domid, frontend domid, VIF ID) of the VIFs to look at.
+    candidates: list[tuple[str, str, str]] = []
+    if frontends is None:
+        for backend_domid in names:
+            path = "/local/domain/%s/backend/vif" % backend_domid
+            for frontend_domid in ls(path):
+                for vifid in ls("%s/%s" % (path, frontend_domid)):
+                    candidates.append((backend_domid, frontend_domid, vifid))
+    else:
+        for frontend_domid, frontend in names.items():
+            if frontend not in frontends:
+                continue
+            path = "/local/domain/%s/device/vif" % frontend_domid
+            for vifid in ls(path):
+                backend_id = read("%s/%s/backend-id" % (path, vifid))
+                if backend_id is not None:
+                    candidates.append((backend_id, frontend_domid, vifid))
+    vifs: list[Vif] = []
+    for backend_domid, frontend_domid, vifid in candidates:
+        if backend_domid not in names or frontend_domid not in names:
+            continue
+        vif = "/local/domain/%s/backend/vif/%s/%s" % (
+            backend_domid,
+            frontend_domid,
+            vifid,
+        )
+        if os.path.basename(read(vif + "/script") or "") != VIF_SCRIPT:
+            continue
+        try:
+            mac = MacAddress.from_string((read(vif + "/mac") or "").lower())
+        except ValueError:
+            mac = None
+        vifs.append((names[backend_domid], names[frontend_domid], vifid, mac))
+    return sorted(vifs)
+
+
+def _attach_command(
+    backend: str,
+    frontend: str,
+    frontend_mac: MacAddress | None,
+    devid: int | None = None,
+) -> list[str]:
+    return (
+        ["xl", "network-attach", frontend]
+        + (["mac=%s" % frontend_mac] if frontend_mac else [])
+        + (["devid=%s" % devid] if devid is not None else [])
+        + [
+            "backend=%s" % backend,
+            "vifname=%s" % frontend,
+            "script=%s" % VIF_SCRIPT,
+        ]
+    )
+
+
+class XlDeviceBackend(DeviceBackend):
+    """
+    XlDeviceBackend drives the xl command.  Each attach costs two process
+    spawns, and guesses the new VIF ID from the last line of
+    xl network-list.  Attaches and detaches in this process are serialized
+    per frontend, so the guess is only wrong if something else attached a
+    VIF to the same frontend in the meantime.
+    """
+
+    def __init__(self) -> None:
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    def _lock(self, frontend: str) -> asyncio.Lock:
+        return self._locks.setdefault(frontend, asyncio.Lock())
+
+    async def attach(
+        self, backend: str, frontend: str, frontend_mac: MacAddress | None = None
+    ) -> str:
+        async with self._lock(frontend):
+            await _run(_attach_command(backend, frontend, frontend_mac))
+            stdout = await _run(["xl", "network-list", frontend], capture=True)
+        vifid = [x for x in stdout.splitlines() if x.strip()][-1].split()[0]
+        return vifid
+
+    async def detach(self, frontend: str, vifid: str) -> None:
+        async with self._lock(frontend):
+            await _run(["xl", "network-detach", frontend, vifid])
+
+    async def inventory(
+        self, frontends: typing.Collection[str] | None = None
+    ) -> list[Vif]:
+        # One xenstore-ls dumps the whole tree.
+        stdout = await _run(["xenstore-ls", "-f", "/local/domain"], capture=True)
+        values: dict[str, str] = {}
+        children: dict[str, list[str]] = {}
+        for line in stdout.splitlines():
+            path, sep, value = line.partition(" = ")
+            if not sep:
+                continue
+            values[path] = codecs.decode(value.strip()[1:-1], "unicode_escape")
+            parent, _, child = path.rpartition("/")
+            children.setdefault(parent, []).append(child)
+        return _inventory(lambda p: children.get(p, []), values.get, frontends)
+
+
+class XenstoreDeviceBackend(XlDeviceBackend):
+    """
+    XenstoreDeviceBackend reads xenstore in-process to pick the ID of each
+    new VIF itself, and asks xl to create the VIF with exactly that ID.
+    Attaching costs one process spawn, and the ID returned is always the
+    one of the VIF that was created: allocations in this process are
+    serialized per frontend, and should anything else claim the same ID
+    first, the attach fails rather than returning someone else's VIF.
+
+    There is no maintained Python binding for libxl, so the device is
+    still created through xl.
+    """
+
+    def __init__(self, xs: typing.Any = None) -> None:
+        super().__init__()
+        if xs is None:
+            import xen.lowlevel.xs
+
+            xs = xen.lowlevel.xs.xs()
+        self.xs = xs
+
+    def _ls(self, path: str) -> list[str]:
+        return [_str(x) for x in self.xs.ls("", path) or []]
+
+    def _read(self, path: str) -> str | None:
+        value = self.xs.read("", path)
+        return None if value is None else _str(value)
+
+    def _domid(self, name: str) -> str:
+        for domid in self._ls("/local/domain"):
+            if self._read("/local/domain/%s/name" % domid) == name:
+                return domid
+        raise DeviceError("domain %s is not running" % name)
+
+    def _vifids(self, frontend: str) -> list[int]:
+        return [
+            int(x)
+            for x in self._ls("/local/domain/%s/device/vif" % self._domid(frontend))
+        ]
+
+    async def inventory(
+        self, frontends: typing.Collection[str] | None = None
+    ) -> list[Vif]:
+        try:
+            return _inventory(self._ls, self._read, frontends)
+        except Exception as e:
+            raise DeviceError("cannot read xenstore: %s" % e) from e
+
+    async def attach(
+        self, backend: str, frontend: str, frontend_mac: MacAddress | None = None
+    ) -> str:
+        async with self._lock(frontend):
+            devid = max(self._vifids(frontend), default=-1) + 1
+            await _run(_attach_command(backend, frontend, frontend_mac, devid))
+        return str(devid)
+
+
+class FakeDeviceBackend(DeviceBackend):
+    """
+    FakeDeviceBackend keeps VIFs in memory, for tests and load harnesses.
+    vifs maps frontend to a map of VIF ID to (backend, MAC address), and
+    calls counts the operations carried out.  Edges listed in fail make
+    attach raise DeviceError.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.vifs: dict[str, dict[str, tuple[str, MacAddress | None]]] = {}
+        self.calls: dict[str, int] = {"attach": 0, "detach": 0}
+        self.fail: set[tuple[str, str]] = set()
+
+    async def attach(
+        self, backend: str, frontend: str, frontend_mac: MacAddress | None = None
+    ) -> str:
+        self.calls["attach"] += 1
+        await asyncio.sleep(self.latency)
+        if (backend, frontend) in self.fail:
+            raise DeviceError("cannot attach %s to %s" % (backend, frontend))
+        vifs = self.vifs.setdefault(frontend, {})
+        vifid = str(max([int(x) for x in vifs], default=-1) + 1)
+        vifs[vifid] = (backend, frontend_mac)
+        return vifid
+
+    async def detach(self, frontend: str, vifid: str) -> None:
+        self.calls["detach"] += 1
+        await asyncio.sleep(self.latency)
+        try:
+            del self.vifs[frontend][vifid]
+        except KeyError:
+            raise DeviceError("no VIF %s in %s" % (vifid, frontend))
+
+    async def inventory(
+        self, frontends: typing.Collection[str] | None = None
+    ) -> list[Vif]:
+        return sorted(
+            (backend, frontend, vifid, mac)
+            for frontend, vifs in self.vifs.items()
+            if frontends is None or frontend in frontends
+            for vifid, (backend, mac) in vifs.items()
+        )
+
+
+def default_device_backend() -> DeviceBackend:
+    """
+    Returns a XenstoreDeviceBackend if the Xen Python bindings are
+    available, and a XlDeviceBackend otherwise.
+    """
+    try:
+        return XenstoreDeviceBackend()
+    except Exception as e:
+        log.info("Using xl device backend since xenstore is unavailable: %s", e)
+        return XlDeviceBackend()
@@ -0,0 +1,57 @@
+import asyncio
+import collections
+import typing
+
+
+T = typing.TypeVar("T")
+
+
+class EdgeExecutor(object):
+    """
+    Runs per-edge jobs concurrently, with at most max_concurrency jobs
+    in flight overall and at most max_per_backend of them against any
+    single backend domain, so that its netback is not overwhelmed.  Jobs
+    against the same frontend domain run one at a time, since they pick
+    and tear down device IDs in it.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_per_backend: int = 4) -> None:
+        if max_concurrency < 1 or max_per_backend < 1:
+            raise ValueError("concurrency limits must be at least 1")
+        self.max_concurrency = max_concurrency
+        self.max_per_backend = max_per_backend
+
+    async def run(
+        self,
+        jobs: list[tuple[str, str, typing.Callable[[], typing.Awaitable[T]]]],
+    ) -> list[T | BaseException]:
+        """
+        run takes a list of (backend, frontend, job) and returns the result of each
+        job, in the same order as the jobs were passed.  A job that raises
+        has its exception returned in place of its result.
+        """
+        overall = asyncio.Semaphore(self.max_concurrency)
+        per_backend: collections.defaultdict[str, asyncio.Semaphore] = (
+            collections.defaultdict(lambda: asyncio.Semaphore(self.max_per_backend))
+        )
+        per_frontend: collections.defaultdict[str, asyncio.Lock] = (
+            collections.defaultdict(asyncio.Lock)
+        )
+
+        async def limited(
+            backend: str,
+            frontend: str,
+            job: typing.Callable[[], typing.Awaitable[T]],
+        ) -> T:
+            # Frontend, then backend slot first, so that jobs queued behind
+            # a busy frontend or backend do not hold slots that other jobs
+            # could use.
+            async with per_frontend[frontend]:
+                async with per_backend[backend]:
+                    async with overall:
+                        return await job()
+
+        return await asyncio.gather(
+            *[limited(backend, frontend, job) for backend, frontend, job in jobs],
+            return_exceptions=True,
+        )
@@ -0,0 +1,155 @@
+import contextlib
+import os
+import time
+import typing
+
+
+PREFIX = "qubes_arbitrary_network_topology_"
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (k, v) for k, v in labels)
+    return "%s %s" % (name, repr(float(value)))
+
+
+class Metric(object):
+    kind = ""
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = PREFIX + name
+        self.help = help
+
+    def samples(self) -> typing.Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> typing.Iterator[str]:
+        for labels, value in sorted(self.values.items()):
+            yield _format(self.name, labels, value)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[_labels(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, help)
+        self.buckets = buckets
+        # labels -> (count per bucket plus +Inf, sum)
+        self.values: dict[Labels, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[n] += 1
+        counts[-1] += 1
+        self.values[key] = counts, total + value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> typing.Generator[None, None, None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self) -> typing.Iterator[str]:
+        for labels, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip([repr(b) for b in self.buckets] + ["+Inf"], counts):
+                yield _format(self.name + "_bucket", labels + (("le", bound),), count)
+            yield _format(self.name + "_sum", labels, total)
+            yield _format(self.name + "_count", labels, counts[-1])
+
+
+class Registry(object):
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> None:
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        render returns all metrics in the Prometheus text exposition format.
+        """
+        return "".join(m.render() for m in self.metrics)
+
+    def write_textfile(self, path: str) -> None:
+        """
+        write_textfile atomically replaces path with the rendered metrics,
+        for the node exporter textfile collector to pick up.
+        """
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+
+M = typing.TypeVar("M", bound=Metric)
+
+
+def _registered(metric: M) -> M:
+    REGISTRY.register(metric)
+    return metric
+
+
+PHASE_SECONDS = _registered(
+    Histogram("phase_seconds", "Time spent in each phase of reconciliation.")
+)
+XL_SECONDS = _registered(
+    Histogram("xl_seconds", "Time spent running each xl or xenstore command.")
+)
+ATTACHES = _registered(Counter("attaches_total", "VIF attachments, by result."))
+DETACHES = _registered(Counter("detaches_total", "VIF detachments, by result."))
+PENDING_EDGES = _registered(
+    Gauge("pending_edges", "Edges queued for reconciliation and not yet done.")
+)
+RETRIES = _registered(
+    Counter("retries_total", "Retries of failed attaches and detaches, by kind.")
+)
+SKIPPED_VMS = _registered(
+    Counter(
+        "skipped_vms_total",
+        "VMs not diffed during reconciliation since nothing changed for them.",
+    )
+)
@@ -1,10 +1,12 @@
+import functools
+import hashlib
 import json
 import logging
 import qubesdb
 import typing
 
 
-from qubesarbitrarynetworktopology.conjoin import ConjoinTracker
+from qubesarbitrarynetworktopology.conjoin import ConjoinTracker, Edge, Parameters
 
 
 log = logging.getLogger(__name__)
@@ -16,41 +18,394 @@ class OldConfig(typing.TypedDict):
     frontend_network_id: str | None
 
 
+# (action, config, VIF ID) of a step carried out on an edge.
+Outcome = list[tuple[str, Parameters, str | None]]
+
+# The most bytes qubesdb keeps in a value.
+QDB_MAX_DATA = 3072
+
+
+@functools.lru_cache(maxsize=1024)
+def _digest(name: str) -> str:
+    return hashlib.blake2b(name.encode("utf-8"), digest_size=6).hexdigest()
+
+
+def edge_key(path: str, backend: str, frontend: str) -> str:
+    """
+    edge_key returns the qubesdb key of an edge under path.  Keys are at
+    most 63 bytes long, while VM names can be 31 characters each, so the
+    key is made of a short digest of each name, and the value of the key
+    holds the names themselves.
+    """
+    return "%s/%s/%s" % (path, _digest(backend), _digest(frontend))
+
+
+def read_tree(db: typing.Any, path: str) -> dict[Edge, list[typing.Any]]:
+    """
+    read_tree reads the edges under path from the qubesdb db, each held
+    as a JSON-encoded [backend, frontend, fields...], into the fields of
+    each edge.  Malformed keys are skipped.
+    """
+    tree: dict[Edge, list[typing.Any]] = {}
+    for value in db.multiread(path + "/").values():
+        try:
+            backend, frontend, *fields = json.loads(value)
+        except (ValueError, TypeError):
+            continue
+        tree[(backend, frontend)] = fields
+    return tree
+
+
+def read_list(db: typing.Any, path: str) -> list[str]:
+    """
+    read_list reads the values under path/<index> from the qubesdb db, as
+    written by ConjoinStore.publish_list(), in order.
+    """
+    values: dict[int, str] = {}
+    for key, value in db.multiread(path + "/").items():
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        try:
+            index = int(key[len(path) + 1 :])
+        except ValueError:
+            continue
+        values[index] = value.decode("utf-8") if isinstance(value, bytes) else value
+    return [values[index] for index in sorted(values)]
+
+
 class ConjoinStore(object):
+    """
+    ConjoinStore persists a ConjoinTracker into qubesdb, one key per edge
+    under PATH as given by edge_key(), each holding a JSON-encoded
+    [backend, frontend, config, frontend_network_id].
+
+    The store keeps a single connection open, and remembers what it last
+    persisted, so that save() only writes edges that changed and removes
+    edges that went away.  Older releases kept the whole topology as one
+    JSON blob under PATH itself; load() migrates that to the current
+    layout.
+
+    The store also keeps a journal of the steps being carried out on each
+    edge, under JOURNAL_PATH as given by edge_key(), so that what happened
+    to edges in flight when qubesd died can be recovered without looking
+    at every VIF.  Each entry is written as {"backend": ..., "frontend":
+    ..., "steps": ..., "vifid": ...} before the steps start, rewritten with
+    "done" in place of "steps" and "vifid" once they are over, and the
+    journal is cleared once the outcome is saved.
+    """
+
     PATH = "/qubes-active-network-topology"
+    JOURNAL_PATH = "/qubes-network-topology-intents"
+
+    def __init__(
+        self, connect: typing.Callable[[], typing.Any] = qubesdb.QubesDB
+    ) -> None:
+        self._connect = connect
+        self._db: typing.Any = None
+        # What is known to be in qubesdb right now, or None if unknown.
+        self._persisted: dict[str, str] | None = None
+        # Likewise for each tree published with publish_tree() and such.
+        self._published: dict[str, dict[str, str]] = {}
+
+    def _connection(self) -> typing.Any:
+        if self._db is None:
+            self._db = self._connect()
+        return self._db
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _disconnect(self) -> None:
+        try:
+            self.close()
+        except BaseException:
+            self._db = None
+
+    def _reset(self) -> None:
+        # After a failure, neither the connection nor what we believe is
+        # persisted can be trusted.
+        self._disconnect()
+        self._persisted = None
+        self._published = {}
+
+    def _read_edges(self, path: str | None = None) -> dict[str, str]:
+        edges: dict[str, str] = {}
+        prefix = (path or self.PATH) + "/"
+        for key, value in self._connection().multiread(prefix).items():
+            if isinstance(key, bytes):
+                key = key.decode("utf-8")
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            edges[key] = value
+        return edges
+
+    def _read_legacy(self) -> dict[str, tuple[str, str | None]]:
+        d = self._connection().read(self.PATH) or "{}"
+        try:
+            if isinstance(d, bytes):
+                d = d.decode("utf-8")
+            loadedd: dict[str, tuple[str, str | None] | OldConfig] = json.loads(d)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            loadedd = {}
+        final: dict[str, tuple[str, str | None]] = {}
+        for k, v in loadedd.items():
+            if isinstance(v, tuple) or isinstance(v, list):
+                cfg = (v[0], v[1])
+            else:
+                cfg = ("", v.get("frontend_network_id"))
+            final[k] = cfg
+        return final
 
     def load(self) -> ConjoinTracker:
-        q = qubesdb.QubesDB()
         try:
-            d = q.read(self.PATH) or "{}"
-            try:
-                if isinstance(d, bytes):
-                    d = d.decode("utf-8")
-                loadedd: dict[str, tuple[str, str | None] | OldConfig] = json.loads(d)
-            except (FileNotFoundError, json.decoder.JSONDecodeError):
-                loadedd = {}
             final: dict[str, tuple[str, str | None]] = {}
-            for k, v in loadedd.items():
-                if isinstance(v, tuple) or isinstance(v, list):
-                    cfg = (v[0], v[1])
-                else:
-                    cfg = ("", v.get("frontend_network_id"))
-                final[k] = cfg
-            return ConjoinTracker.from_deserializable(final)
+            persisted: dict[str, str] = {}
+            for key, value in self._read_edges().items():
+                try:
+                    backend, frontend, cfgstr, frontend_network_id = json.loads(value)
+                except (ValueError, TypeError):
+                    log.warning("Ignoring malformed conjoin store key %s", key)
+                    continue
+                final["%s %s" % (backend, frontend)] = (cfgstr, frontend_network_id)
+                persisted[key] = value
+            self._persisted = persisted
+            legacy = self._read_legacy()
+            tracker = ConjoinTracker.from_deserializable({**legacy, **final})
+            if legacy:
+                log.info("Migrating conjoin store to one key per edge")
+                self.save(tracker)
+                self._connection().rm(self.PATH)
+            return tracker
         except BaseException:
             log.exception("Failure loading conjoin store")
+            self._reset()
+            raise
+
+    def read_tree(self, path: str) -> dict[Edge, list[typing.Any]]:
+        """
+        read_tree reads a tree written by publish_tree(), as read_tree()
+        does, over the store's connection.
+        """
+        try:
+            return read_tree(self._connection(), path)
+        except BaseException:
+            log.exception("Failure reading %s", path)
+            self._disconnect()
+            raise
+
+    def publish_tree(self, path: str, values: dict[Edge, list[typing.Any]]) -> None:
+        """
+        publish_tree makes the keys under path hold the fields of each edge
+        in values, as read by read_tree(), writing only those that changed,
+        and removing the rest.
+        """
+        self._publish_keys(
+            path,
+            {
+                edge_key(path, b, f): json.dumps([b, f, *fields])
+                for (b, f), fields in values.items()
+            },
+        )
+
+    def update_tree(
+        self, path: str, values: dict[Edge, list[typing.Any] | None]
+    ) -> None:
+        """
+        update_tree makes the keys under path of the edges in values hold
+        their fields, as publish_tree() does, or removes those of edges
+        mapped to None, leaving the keys of other edges alone.
+        """
+        try:
+            published = self._published.get(path)
+            if published is None:
+                published = self._read_edges(path)
+            q = self._connection()
+            for (b, f), fields in values.items():
+                key = edge_key(path, b, f)
+                if fields is None:
+                    if key in published:
+                        q.rm(key)
+                        del published[key]
+                    continue
+                value = json.dumps([b, f, *fields])
+                if published.get(key) != value:
+                    q.write(key, value)
+                    published[key] = value
+            self._published[path] = published
+        except BaseException:
+            log.exception("Failure publishing %s", path)
+            self._disconnect()
+            self._published.pop(path, None)
+            raise
+
+    def publish_list(self, path: str, values: list[str]) -> None:
+        """
+        publish_list makes the keys path/<index> hold values, as read by
+        read_list(), writing only those that changed, and removing the rest.
+        """
+        self._publish_keys(
+            path, {"%s/%s" % (path, n): value for n, value in enumerate(values)}
+        )
+
+    def publish_text(self, path: str, text: str) -> None:
+        """
+        publish_text publishes text with publish_list(), split at line ends
+        into pieces short enough for qubesdb to keep.  Lines are assumed to
+        be short enough themselves.
+        """
+        pieces: list[str] = []
+        piece = ""
+        for line in text.splitlines(keepends=True):
+            if piece and len((piece + line).encode("utf-8")) > QDB_MAX_DATA:
+                pieces.append(piece)
+                piece = ""
+            piece += line
+        if piece:
+            pieces.append(piece)
+        self.publish_list(path, pieces)
+
+    def _publish_keys(self, path: str, wanted: dict[str, str]) -> None:
+        try:
+            published = self._published.get(path)
+            if published is None:
+                published = self._read_edges(path)
+            q = self._connection()
+            for key in published.keys() - wanted.keys():
+                q.rm(key)
+            for key, value in wanted.items():
+                if published.get(key) != value:
+                    q.write(key, value)
+            self._published[path] = wanted
+        except BaseException:
+            log.exception("Failure publishing %s", path)
+            # What save() persisted is not affected.
+            self._disconnect()
+            self._published.pop(path, None)
+            raise
+
+    def record_intents(
+        self, work: dict[Edge, tuple[list[tuple[str, Parameters]], str | None]]
+    ) -> None:
+        """
+        record_intents journals, for each edge in work, the steps about to
+        be carried out on it and the ID of its VIF beforehand.
+        """
+        try:
+            q = self._connection()
+            for (backend, frontend), (steps, vifid) in work.items():
+                q.write(
+                    edge_key(self.JOURNAL_PATH, backend, frontend),
+                    json.dumps(
+                        {
+                            "backend": backend,
+                            "frontend": frontend,
+                            "steps": [[a, str(c)] for a, c in steps],
+                            "vifid": vifid,
+                        }
+                    ),
+                )
+        except BaseException:
+            log.exception("Failure recording intents")
+            self._reset()
+            raise
+
+    def confirm_intent(self, backend: str, frontend: str, done: Outcome) -> None:
+        """
+        confirm_intent journals the outcome of the steps on an edge.
+        """
+        try:
+            self._connection().write(
+                edge_key(self.JOURNAL_PATH, backend, frontend),
+                json.dumps(
+                    {
+                        "backend": backend,
+                        "frontend": frontend,
+                        "done": [[a, str(c), v] for a, c, v in done],
+                    }
+                ),
+            )
+        except BaseException:
+            log.exception("Failure confirming intent")
+            self._reset()
+            raise
+
+    def intents(self) -> dict[Edge, Outcome | None]:
+        """
+        intents returns the journal: for each edge, the outcome of its
+        steps, or None if they were still in flight.  It raises ValueError
+        if an entry is malformed, since the edge it was about is unknown.
+        """
+        try:
+            entries = self._read_edges(self.JOURNAL_PATH)
+        except BaseException:
+            log.exception("Failure reading intents")
+            self._reset()
+            raise
+        intents: dict[Edge, Outcome | None] = {}
+        for key, value in entries.items():
+            try:
+                entry = json.loads(value)
+                done = entry.get("done")
+                intents[(entry["backend"], entry["frontend"])] = (
+                    None
+                    if done is None
+                    else [(a, Parameters.from_string(c), v) for a, c, v in done]
+                )
+            except (ValueError, TypeError, AttributeError, KeyError) as e:
+                raise ValueError("malformed intent key %s" % key) from e
+        return intents
+
+    def clear_intents(self, keep: typing.Collection[Edge] = ()) -> None:
+        """
+        clear_intents empties the journal, but for the entries of the edges
+        in keep.
+        """
+        try:
+            q = self._connection()
+            if not keep:
+                q.rm(self.JOURNAL_PATH + "/")
+                return
+            kept = {edge_key(self.JOURNAL_PATH, b, f) for b, f in keep}
+            for key in self._read_edges(self.JOURNAL_PATH):
+                if key not in kept:
+                    q.rm(key)
+        except BaseException:
+            log.exception("Failure clearing intents")
+            self._reset()
             raise
-        finally:
-            q.close()
 
     def save(self, o: ConjoinTracker) -> None:
-        to_be_saved = o.to_serializable()
-        q = qubesdb.QubesDB()
+        wanted = {
+            edge_key(self.PATH, backend, frontend): json.dumps(
+                [backend, frontend, str(v.config), v.frontend_network_id]
+            )
+            for (backend, frontend), v in o.items()
+        }
         try:
-            oj = json.dumps(to_be_saved)
-            q.write(self.PATH, oj)
+            if self._persisted is None:
+                self._persisted = self._read_edges()
+            q = self._connection()
+            gone = self._persisted.keys() - wanted.keys()
+            # Edges mostly go away in bulk, as when VMs shut down, so the
+            # keys of a backend that has none left go in a single removal,
+            # as do all keys when no edge is left.
+            if gone and not wanted:
+                q.rm(self.PATH + "/")
+            else:
+                kept = {key.rsplit("/", 1)[0] for key in wanted}
+                emptied = {key.rsplit("/", 1)[0] for key in gone} - kept
+                for prefix in sorted(emptied):
+                    q.rm(prefix + "/")
+                for key in gone:
+                    if key.rsplit("/", 1)[0] not in emptied:
+                        q.rm(key)
+            for key, value in wanted.items():
+                if self._persisted.get(key) != value:
+                    q.write(key, value)
+            self._persisted = wanted
         except BaseException:
             log.exception("Failure persisting conjoin store")
+            self._reset()
             raise
-        finally:
-            q.close()
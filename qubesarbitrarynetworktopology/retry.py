@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import random
+import time
+import typing
+
+
+from qubesarbitrarynetworktopology.metrics import RETRIES
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 300.0
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_MAX_PER_BACKEND = 32
+
+# (backend, frontend, VIF ID to detach, or None to attach)
+RetryKey = tuple[str, str, str | None]
+
+
+class RetryEntry(object):
+    """
+    RetryEntry is an operation on an edge that failed and is to be tried
+    again: attaching it if vifid is None, else detaching VIF vifid.
+    """
+
+    def __init__(
+        self,
+        backend: str,
+        frontend: str,
+        vifid: str | None = None,
+        attempts: int = 0,
+        gave_up: bool = False,
+    ) -> None:
+        self.backend = backend
+        self.frontend = frontend
+        self.vifid = vifid
+        self.attempts = attempts
+        self.gave_up = gave_up
+        # Wall clock time of the next attempt.
+        self.not_before: float | None = None
+        self._timer: asyncio.TimerHandle | None = None
+
+    @property
+    def key(self) -> RetryKey:
+        return (self.backend, self.frontend, self.vifid)
+
+    @property
+    def kind(self) -> str:
+        return "attach" if self.vifid is None else "detach"
+
+    def __str__(self) -> str:
+        return "<RetryEntry %s backend %s frontend %s VIF %s attempts %s>" % (
+            self.kind,
+            self.backend,
+            self.frontend,
+            self.vifid,
+            self.attempts,
+        )
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def to_serializable(self) -> dict[str, typing.Any]:
+        return {
+            "backend": self.backend,
+            "frontend": self.frontend,
+            "vifid": self.vifid,
+            "attempts": self.attempts,
+            "gave_up": self.gave_up,
+            "not_before": self.not_before,
+        }
+
+
+class RetryQueue(object):
+    """
+    RetryQueue calls callback with each failed operation again after a
+    delay that doubles with each attempt, up to max_delay, with jitter so
+    that operations that failed together are not retried together.
+
+    Every call counts as an attempt, and the next one is scheduled right
+    away; the owner discards the entry once the operation succeeds or
+    becomes moot.  After max_attempts the entry is kept, marked as given
+    up, for status() to show, and failures of the same operation are
+    ignored until it is discarded or reset().  No more than
+    max_per_backend operations are retried per backend at once.
+
+    on_change is called whenever entries change, for them to be persisted.
+    """
+
+    def __init__(
+        self,
+        callback: typing.Callable[[RetryEntry], None],
+        on_change: typing.Callable[[list[RetryEntry]], None] = lambda _: None,
+        base_delay: float = DEFAULT_BASE_DELAY,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        max_per_backend: int = DEFAULT_MAX_PER_BACKEND,
+    ) -> None:
+        self.callback = callback
+        self.on_change = on_change
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.max_per_backend = max_per_backend
+        self._entries: dict[RetryKey, RetryEntry] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def delay(self, attempts: int) -> float:
+        """
+        delay returns how long to wait before the attempt after the given
+        number of attempts: half the backoff, plus up to another half.
+        """
+        backoff: float = min(self.max_delay, self.base_delay * 2**attempts)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def _arm(self, entry: RetryEntry) -> None:
+        delay = self.delay(entry.attempts)
+        entry.not_before = time.time() + delay
+        entry._timer = asyncio.get_event_loop().call_later(delay, self._fire, entry)
+
+    def _fire(self, entry: RetryEntry) -> None:
+        entry._timer = None
+        entry.attempts += 1
+        if entry.attempts >= self.max_attempts:
+            log.warning("Giving up on %s", entry)
+            entry.gave_up = True
+            entry.not_before = None
+        else:
+            self._arm(entry)
+        self._changed()
+        RETRIES.inc(kind=entry.kind)
+        try:
+            self.callback(entry)
+        except Exception:
+            log.exception("Could not retry %s", entry)
+
+    def _changed(self) -> None:
+        try:
+            self.on_change(list(self._entries.values()))
+        except Exception:
+            log.exception("Could not persist retries")
+
+    def add(self, backend: str, frontend: str, vifid: str | None = None) -> None:
+        """
+        add queues a failed operation, unless it is already being retried
+        or was given up on.  Either way, its attempts keep counting.
+        """
+        if (backend, frontend, vifid) in self._entries:
+            return
+        if (
+            sum(
+                1
+                for e in self._entries.values()
+                if e.backend == backend and not e.gave_up
+            )
+            >= self.max_per_backend
+        ):
+            log.warning(
+                "Not retrying operation on backend %s and frontend %s:"
+                " too many retries pending for the backend",
+                backend,
+                frontend,
+            )
+            return
+        entry = RetryEntry(backend, frontend, vifid)
+        self._entries[entry.key] = entry
+        log.info("Will retry %s", entry)
+        self._arm(entry)
+        self._changed()
+
+    def discard(self, backend: str, frontend: str, vifid: str | None = None) -> None:
+        """
+        discard forgets an operation, because it succeeded or became moot.
+        """
+        entry = self._entries.pop((backend, frontend, vifid), None)
+        if entry is None:
+            return
+        if entry._timer is not None:
+            entry._timer.cancel()
+        self._changed()
+
+    def reset(self, vm: str, frontend: str | None = None) -> None:
+        """
+        reset forgets the operations given up on the edges of vm, or only
+        on its edge to frontend if given, since what made them fail may
+        have changed: should they fail again, they are retried afresh.
+        """
+        keys = [
+            key
+            for key, e in self._entries.items()
+            if e.gave_up
+            and (
+                vm in (e.backend, e.frontend)
+                if frontend is None
+                else (e.backend, e.frontend) == (vm, frontend)
+            )
+        ]
+        for key in keys:
+            del self._entries[key]
+        if keys:
+            self._changed()
+
+    def restore(self, entries: list[dict[str, typing.Any]]) -> None:
+        """
+        restore queues entries persisted earlier (as by to_serializable),
+        keeping their attempt counts.
+        """
+        for e in entries:
+            entry = RetryEntry(
+                e["backend"], e["frontend"], e["vifid"], e["attempts"], e["gave_up"]
+            )
+            if entry.key in self._entries:
+                continue
+            self._entries[entry.key] = entry
+            if not entry.gave_up:
+                self._arm(entry)
+        self._changed()
+
+    def status(self) -> list[dict[str, typing.Any]]:
+        """
+        status returns each entry as by RetryEntry.to_serializable, plus
+        its kind.
+        """
+        return [
+            {"kind": e.kind, **e.to_serializable()}
+            for e in sorted(
+                self._entries.values(),
+                key=lambda e: (e.backend, e.frontend, e.vifid or ""),
+            )
+        ]
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import typing
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+DEFAULT_DELAY = 0.25
+
+
+class ReconcileBatch(object):
+    """
+    ReconcileBatch holds the VMs collected by the scheduler during one
+    window: those whose links must be torn down (disjoin), and those whose
+    links must be brought in line with the configuration (conjoin).  Both
+    keep the order in which VMs were first marked.  If resync is set, the
+    whole active topology must be checked against reality first.
+    """
+
+    def __init__(self) -> None:
+        self.disjoin: dict[str, None] = {}
+        self.conjoin: dict[str, None] = {}
+        self.resync = False
+
+    def __bool__(self) -> bool:
+        return bool(self.disjoin or self.conjoin or self.resync)
+
+    def __str__(self) -> str:
+        return "<ReconcileBatch disjoin %s conjoin %s%s>" % (
+            list(self.disjoin),
+            list(self.conjoin),
+            " resync" if self.resync else "",
+        )
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def vms(self) -> list[str]:
+        return list({**self.disjoin, **self.conjoin})
+
+
+class ReconcileScheduler(object):
+    """
+    ReconcileScheduler coalesces reconciliation requests.  The first VM
+    marked opens a window of delay seconds, during which further marks
+    are collected into the same batch; when the window closes, callback
+    is awaited once with the whole batch.
+
+    Marks that become moot are dropped: a VM marked for conjoin and then
+    for disjoin within the window is only disjoined.  A VM marked for
+    disjoin and then for conjoin (a restart) is disjoined, then conjoined.
+
+    While held, marks keep being collected but no batch is reconciled;
+    everything collected becomes one batch once released, or once the hold
+    lapses.
+    """
+
+    def __init__(
+        self,
+        callback: typing.Callable[[ReconcileBatch], typing.Awaitable[None]],
+        delay: float = DEFAULT_DELAY,
+    ) -> None:
+        self.callback = callback
+        self.delay = delay
+        self._pending = ReconcileBatch()
+        self._collecting = False
+        self._held = False
+        self._lapse: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def conjoin(self, vm: str) -> None:
+        self._pending.conjoin[vm] = None
+        self._arm()
+
+    def disjoin(self, vm: str) -> None:
+        self._pending.conjoin.pop(vm, None)
+        self._pending.disjoin[vm] = None
+        self._arm()
+
+    def resync(self) -> None:
+        self._pending.resync = True
+        self._arm()
+
+    def hold(self, duration: float | None = None) -> None:
+        """
+        hold holds reconciliation until release(), or until duration
+        seconds have elapsed if given.
+        """
+        self._held = True
+        self._cancel_lapse()
+        if duration is not None:
+            self._lapse = asyncio.get_event_loop().call_later(duration, self.release)
+
+    def release(self) -> None:
+        self._held = False
+        self._cancel_lapse()
+        if self._pending:
+            self._arm()
+
+    def _cancel_lapse(self) -> None:
+        if self._lapse is not None:
+            self._lapse.cancel()
+            self._lapse = None
+
+    def _arm(self) -> None:
+        if self._collecting or self._held:
+            return
+        self._collecting = True
+        task = asyncio.ensure_future(self._run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self) -> None:
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self._collecting = False
+        if self._held:
+            # release() arms again.
+            return
+        batch, self._pending = self._pending, ReconcileBatch()
+        if not batch:
+            return
+        try:
+            await self.callback(batch)
+        except Exception:
+            log.exception("Could not reconcile %s", batch)
+
+    async def drain(self) -> None:
+        """
+        drain waits until every batch collected so far has been reconciled.
+        """
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
@@ -0,0 +1,161 @@
+import logging
+import typing
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+# The name libvirt gives to dom0.
+LIBVIRT_DOM0 = "Domain-0"
+
+# Which domains are running, each mapped to whether it is paused.
+PowerStates = dict[str, bool]
+
+
+def poll_power_states(app: typing.Any) -> PowerStates:
+    """
+    poll_power_states asks each domain of app for its power state, which
+    costs a hypervisor query or two per domain.
+    """
+    states: PowerStates = {}
+    for vm in app.domains:
+        if vm.is_running():
+            states[vm.name] = vm.is_paused()
+    return states
+
+
+def libvirt_power_states(app: typing.Any) -> PowerStates:
+    """
+    libvirt_power_states lists the running and the paused domains of app
+    in two libvirt queries, however many domains there are.
+    """
+    import libvirt
+
+    conn = app.vmm.libvirt_conn
+    active = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+    paused = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_PAUSED)
+    names = {LIBVIRT_DOM0: "dom0"}
+    states: PowerStates = {"dom0": False}
+    for d in active:
+        name = names.get(d.name(), d.name())
+        if name in app.domains:
+            states[name] = False
+    for d in paused:
+        name = names.get(d.name(), d.name())
+        if name in states:
+            states[name] = True
+    return states
+
+
+def query_power_states(app: typing.Any) -> PowerStates:
+    """
+    query_power_states lists the power states of all domains of app in
+    bulk, or failing that by polling each domain.
+    """
+    try:
+        return libvirt_power_states(app)
+    except Exception:
+        log.exception("Could not list domain states in bulk, polling each domain")
+        return poll_power_states(app)
+
+
+class DomainStates(object):
+    """
+    DomainStates is a snapshot of which domains are running and which of
+    those are paused.  It is taken in bulk with query when first needed,
+    or again after invalidate(), and otherwise kept current by the owner
+    as domains start, pause, unpause and shut down, rather than asking
+    the hypervisor about each domain every time.  generation changes
+    whenever the states may have, and changed_since() tells of which
+    domains.
+    """
+
+    def __init__(
+        self,
+        query: typing.Callable[[typing.Any], PowerStates] = query_power_states,
+    ) -> None:
+        self._query = query
+        self._states: PowerStates | None = None
+        self.generation = 0
+        # The generation at which the states of all domains last changed,
+        # and those at which each domain changed since, in order.
+        self._all = 0
+        self._changed: dict[str, int] = {}
+
+    def _bump(self, vm: str | None = None) -> None:
+        self.generation += 1
+        if vm is None:
+            self._all = self.generation
+            self._changed.clear()
+        else:
+            self._changed.pop(vm, None)
+            self._changed[vm] = self.generation
+
+    def changed_since(self, generation: int) -> list[str] | None:
+        """
+        changed_since returns the domains whose states may have changed
+        after the given generation, or None if all of them may have.
+        """
+        if generation < self._all:
+            return None
+        changed: list[str] = []
+        for vm, g in reversed(self._changed.items()):
+            if g <= generation:
+                break
+            changed.append(vm)
+        return changed
+
+    def invalidate(self) -> None:
+        self._states = None
+        self._bump()
+
+    def snapshot(self, app: typing.Any) -> PowerStates:
+        """
+        snapshot returns the states, querying them unless known already.
+        """
+        if self._states is None:
+            self._states = self._query(app)
+            self._bump()
+            log.debug("Took snapshot of %s running domains", len(self._states))
+        return self._states
+
+    def started(self, vm: str) -> None:
+        if self._states is not None:
+            self._states[vm] = False
+            self._bump(vm)
+
+    def paused(self, vm: str) -> None:
+        if self._states is not None and vm in self._states:
+            self._states[vm] = True
+            self._bump(vm)
+
+    def unpaused(self, vm: str) -> None:
+        if self._states is not None:
+            self._states[vm] = False
+            self._bump(vm)
+
+    def stopped(self, vm: str) -> None:
+        if self._states is not None:
+            self._states.pop(vm, None)
+            self._bump(vm)
+
+    def running(self, app: typing.Any) -> list[str]:
+        """
+        running returns the names of the running domains, paused or not.
+        """
+        return list(self.snapshot(app))
+
+    def actionable(
+        self, app: typing.Any, edges: typing.Iterable[tuple[str, str]]
+    ) -> list[tuple[str, str]]:
+        """
+        actionable returns those of edges whose ends are both running and
+        not paused, so that a link between them can be attached.
+        """
+        states = self.snapshot(app)
+        return [
+            edge
+            for edge in edges
+            if states.get(edge[0]) is False and states.get(edge[1]) is False
+        ]
@@ -0,0 +1,341 @@
+import contextlib
+import io
+import json
+import threading
+import time
+import typing
+import unittest
+
+
+from qubesarbitrarynetworktopology import (
+    DESIRED_PATH,
+    HOLD_FEATURE,
+    LINK_ATTACHED,
+    LINK_DETACHED,
+    PENDING_PATH,
+)
+from qubesarbitrarynetworktopology.cli import (
+    apply,
+    feature_value,
+    format_link_event,
+    format_retries,
+    format_topology,
+    parse_topology,
+    read_topology,
+    start,
+)
+from qubesarbitrarynetworktopology.conjoin import ConjoinTracker
+from qubesarbitrarynetworktopology.persistence import ConjoinStore, edge_key
+from qubesarbitrarynetworktopology.testing import FakeQubesDB
+
+
+class FakeFeatures(dict[str, str]):
+    # As in qubesd, where the extension refuses attach-network-to features
+    # that would make the topology invalid.
+    def __init__(self, vm: "FakeVM") -> None:
+        super().__init__()
+        self.vm = vm
+
+    def __setitem__(self, key: str, value: str) -> None:
+        if key == "attach-network-to":
+            domains = self.vm.app.domains
+            ConjoinTracker.from_vm_table(
+                {vm.name: vm.features.get(key) for vm in domains}
+            ).validate_frontends(self.vm.name, value, lambda vm: vm in domains)
+        super().__setitem__(key, value)
+
+
+class FakeVM(object):
+    def __init__(
+        self,
+        app: "FakeApp",
+        name: str,
+        feature: str | None = None,
+        running: bool = False,
+    ) -> None:
+        self.app = app
+        self.name = name
+        self.features = FakeFeatures(self)
+        if feature is not None:
+            # Not validated, since the other VMs may not be there yet.
+            dict.__setitem__(self.features, "attach-network-to", feature)
+        self.running = running
+
+    def is_running(self) -> bool:
+        return self.running
+
+    def start(self) -> None:
+        with self.app.lock:
+            if self.name in self.app.broken:
+                raise RuntimeError("cannot start")
+            lease = self.app.domains["dom0"].features.get(HOLD_FEATURE)
+            held = float(lease or 0) > time.time()
+            self.app.started.append((self.name, held))
+            self.running = True
+
+
+class FakeDomains(dict[str, FakeVM]):
+    # Like qubesadmin, iterating yields VMs, and lookups are by name.
+    def __iter__(self) -> typing.Iterator[FakeVM]:  # type: ignore
+        return iter(list(self.values()))
+
+
+class FakeApp(object):
+    def __init__(
+        self, table: dict[str, str | None], running: typing.Collection[str] = ()
+    ) -> None:
+        self.lock = threading.Lock()
+        self.started: list[tuple[str, bool]] = []
+        self.broken: set[str] = set()
+        self.domains = FakeDomains(dom0=FakeVM(self, "dom0", running=True))
+        for name, feature in table.items():
+            self.domains[name] = FakeVM(self, name, feature, name in running)
+
+
+class TestStart(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = FakeApp(
+            {"router": "a\nb", "a": "c", "b": "c", "c": None}, running=["b"]
+        )
+        self.out = io.StringIO()
+
+    def test_start_in_waves(self) -> None:
+        failed = start(self.app, ["c", "b", "a", "router"], out=self.out)
+        self.assertEqual(failed, 0)
+        self.assertEqual(
+            self.out.getvalue(), "Wave 1: router\nWave 2: a b\nWave 3: c\n"
+        )
+        # b was running already, and every start happened under a hold.
+        self.assertListEqual(
+            self.app.started, [("router", True), ("a", True), ("c", True)]
+        )
+        self.assertNotIn(HOLD_FEATURE, self.app.domains["dom0"].features)
+
+    def test_dry_run(self) -> None:
+        start(self.app, ["a", "router"], dry_run=True, out=self.out)
+        self.assertEqual(self.out.getvalue(), "Wave 1: router\nWave 2: a\n")
+        self.assertListEqual(self.app.started, [])
+
+    def test_failures_are_counted_and_release_hold(self) -> None:
+        self.app.broken.add("a")
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            failed = start(self.app, ["a", "c", "router"], out=self.out)
+        self.assertEqual(err.getvalue(), "Could not start a: cannot start\n")
+        self.assertEqual(failed, 1)
+        self.assertListEqual(self.app.started, [("router", True), ("c", True)])
+        self.assertNotIn(HOLD_FEATURE, self.app.domains["dom0"].features)
+
+    def test_existing_hold_is_left_alone(self) -> None:
+        lease = "%.0f" % (time.time() + 60)
+        self.app.domains["dom0"].features[HOLD_FEATURE] = lease
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            start(self.app, ["router"], out=self.out)
+        self.assertIn("qvm-features --unset dom0 " + HOLD_FEATURE, err.getvalue())
+        self.assertEqual(self.app.domains["dom0"].features[HOLD_FEATURE], lease)
+
+    def test_lapsed_hold_is_replaced(self) -> None:
+        # As left behind by a run that died.
+        self.app.domains["dom0"].features[HOLD_FEATURE] = "%.0f" % (time.time() - 60)
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            start(self.app, ["router"], out=self.out)
+        self.assertEqual(err.getvalue(), "Replacing a lapsed hold on reconciliation\n")
+        self.assertListEqual(self.app.started, [("router", True)])
+        self.assertNotIn(HOLD_FEATURE, self.app.domains["dom0"].features)
+
+
+class TestApply(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = FakeApp(
+            {
+                "router": "a\nb frontend_mac=12:12:12:12:12:12",
+                "a": "c",
+                "b": None,
+                "c": None,
+            }
+        )
+        self.out = io.StringIO()
+
+    def features(self) -> dict[str, str]:
+        return {
+            vm.name: vm.features["attach-network-to"]
+            for vm in self.app.domains
+            if vm.features.get("attach-network-to")
+        }
+
+    def test_parse_topology(self) -> None:
+        t = parse_topology(
+            "# The router.\n"
+            "router  a\n"
+            "\n"
+            "router b   frontend_mac=12:12:12:12:12:12\n"
+            "a c\n"
+        )
+        self.assertListEqual(t.frontends("router"), ["a", "b"])
+        self.assertEqual(
+            str(t.config("router", "b")), "frontend_mac=12:12:12:12:12:12"
+        )
+        self.assertEqual(
+            feature_value(t, "router"), "a\nb frontend_mac=12:12:12:12:12:12"
+        )
+        self.assertRaises(ValueError, lambda: parse_topology("router\n"))
+        self.assertRaises(
+            ValueError, lambda: parse_topology("router a frontend_mac=1\n")
+        )
+
+    def test_apply_changes_only_what_differs(self) -> None:
+        desired = parse_topology(
+            "router b frontend_mac=12:12:12:12:12:12\n"
+            "router a\n"
+            "b c frontend_mac=34:34:34:34:34:34\n"
+        )
+        changed = apply(self.app, desired, out=self.out)
+        # The router feature is reordered but equivalent, so left alone.
+        self.assertListEqual(changed, ["a", "b"])
+        self.assertEqual(
+            self.out.getvalue(), "- a c\n+ b c frontend_mac=34:34:34:34:34:34\n"
+        )
+        self.assertDictEqual(
+            self.features(),
+            {
+                "router": "a\nb frontend_mac=12:12:12:12:12:12",
+                "b": "c frontend_mac=34:34:34:34:34:34",
+            },
+        )
+        self.assertNotIn(HOLD_FEATURE, self.app.domains["dom0"].features)
+        self.assertListEqual(apply(self.app, desired, out=io.StringIO()), [])
+
+    def test_apply_replaces_config(self) -> None:
+        desired = parse_topology("router a\nrouter b\na c\n")
+        self.assertListEqual(apply(self.app, desired, out=self.out), ["router"])
+        self.assertEqual(self.out.getvalue(), "~ router b\n")
+        self.assertEqual(self.features()["router"], "a\nb")
+
+    def test_apply_moves_mac(self) -> None:
+        # The MAC address moves to a link of a, which sorts before router.
+        desired = parse_topology(
+            "router a\nrouter b\na c frontend_mac=12:12:12:12:12:12\n"
+        )
+        self.assertListEqual(apply(self.app, desired, out=self.out), ["a", "router"])
+        self.assertDictEqual(
+            self.features(),
+            {"router": "a\nb", "a": "c frontend_mac=12:12:12:12:12:12"},
+        )
+
+    def test_apply_refuses_invalid_topology(self) -> None:
+        before = self.features()
+        for text in [
+            "router a frontend_mac=12:12:12:12:12:12\n"
+            "a c frontend_mac=12:12:12:12:12:12\n",
+            "router a\nrouter d\n",
+        ]:
+            desired = parse_topology(text)
+            self.assertRaises(ValueError, apply, self.app, desired, out=self.out)
+            self.assertDictEqual(self.features(), before)
+        self.assertNotIn(HOLD_FEATURE, self.app.domains["dom0"].features)
+
+    def test_dry_run(self) -> None:
+        before = self.features()
+        changed = apply(self.app, ConjoinTracker(), dry_run=True, out=self.out)
+        self.assertListEqual(changed, ["a", "router"])
+        self.assertEqual(self.out.getvalue(), "- a c\n- router a\n- router b\n")
+        self.assertDictEqual(self.features(), before)
+
+
+class TestRetries(unittest.TestCase):
+    def test_format_retries(self) -> None:
+        entries: list[dict[str, typing.Any]] = [
+            {
+                "backend": "b",
+                "frontend": "f",
+                "vifid": None,
+                "attempts": 2,
+                "gave_up": False,
+                "not_before": 112.4,
+            },
+            {
+                "backend": "b",
+                "frontend": "g",
+                "vifid": "3",
+                "attempts": 10,
+                "gave_up": True,
+                "not_before": None,
+            },
+        ]
+        self.assertEqual(
+            format_retries(entries, 100.0),
+            "BACKEND FRONTEND KIND ATTEMPTS NEXT\n"
+            "b f attach 2 12s\n"
+            "b g detach:3 10 gave-up\n",
+        )
+
+
+class TestShow(unittest.TestCase):
+    def setUp(self) -> None:
+        mac = "frontend_mac=12:12:12:12:12:12"
+        # VM names can be up to 31 characters long.
+        router = "router-with-a-31-character-name"
+        self.db = FakeQubesDB(
+            {
+                edge_key(path, b, f): json.dumps([b, f, *fields]).encode("utf-8")
+                for path, b, f, fields in [
+                    (DESIRED_PATH, router, "a", [""]),
+                    (DESIRED_PATH, router, "b", [mac]),
+                    (DESIRED_PATH, "a", "c", [""]),
+                    (ConjoinStore.PATH, router, "a", ["", "0"]),
+                    (ConjoinStore.PATH, router, "b", ["", "1"]),
+                    (ConjoinStore.PATH, "b", "c", ["", "2"]),
+                    (PENDING_PATH, router, "b", ["replace", mac]),
+                    (PENDING_PATH, "a", "c", ["attach", ""]),
+                    (PENDING_PATH, "b", "c", ["detach", ""]),
+                ]
+            }
+        )
+        for key in self.db.data:
+            self.assertLess(len(key), 64)
+
+    def test_read_topology(self) -> None:
+        t = read_topology(self.db)
+        self.assertListEqual(
+            [(e["backend"], e["frontend"], e["vifid"]) for e in t["active"]],
+            [
+                ("b", "c", "2"),
+                ("router-with-a-31-character-name", "a", "0"),
+                ("router-with-a-31-character-name", "b", "1"),
+            ],
+        )
+        self.assertListEqual(
+            [e["config"] for e in t["desired"]],
+            ["", "", "frontend_mac=12:12:12:12:12:12"],
+        )
+        self.assertListEqual(
+            [e["action"] for e in t["pending"]], ["attach", "detach", "replace"]
+        )
+
+    def test_format_topology(self) -> None:
+        self.assertEqual(
+            format_topology(read_topology(self.db)),
+            "BACKEND FRONTEND STATE VIF CONFIG\n"
+            "a c pending-attach -\n"
+            "b c pending-detach 2\n"
+            "router-with-a-31-character-name a attached 0\n"
+            "router-with-a-31-character-name b pending-replace 1"
+            " frontend_mac=12:12:12:12:12:12\n",
+        )
+
+    def test_format_link_event(self) -> None:
+        self.assertEqual(
+            format_link_event(
+                "router", LINK_ATTACHED, frontend="a", vifid="0", config=""
+            ),
+            "+ router a 0",
+        )
+        self.assertEqual(
+            format_link_event(
+                "router",
+                LINK_DETACHED,
+                frontend="b",
+                vifid="1",
+                config="frontend_mac=12:12:12:12:12:12",
+            ),
+            "- router b 1 frontend_mac=12:12:12:12:12:12",
+        )
@@ -1,7 +1,13 @@
 import unittest
 
 
-from qubesarbitrarynetworktopology.conjoin import ConjoinTracker, Parameters
+from qubesarbitrarynetworktopology.conjoin import (
+    ConjoinTracker,
+    MacAddress,
+    Parameters,
+    VifAttachment,
+    parse_feature,
+)
 
 
 class TestConjoiners(unittest.TestCase):
@@ -58,6 +64,15 @@ class TestConjoiners(unittest.TestCase):
             ],
         )
 
+    def test_addressing(self) -> None:
+        p = Parameters.from_string("backend_ip=10.0.0.1 routes=10.0.1.0/24,fd00::/64")
+        self.assertEqual(p.backend_ip, "10.0.0.1")
+        self.assertTupleEqual(p.routes, ("10.0.1.0/24", "fd00::/64"))
+        self.assertEqual(Parameters.from_string(str(p)), p)
+        self.assertNotEqual(Parameters.from_string("backend_ip=10.0.0.1"), p)
+        self.assertRaises(ValueError, lambda: Parameters.from_string("backend_ip=x"))
+        self.assertRaises(ValueError, lambda: Parameters.from_string("routes=1.2/99"))
+
     def test_diff_limit_to_vm(self) -> None:
         config = ConjoinTracker()
         reality = ConjoinTracker.from_vm_table({"a": "b\nc"})
@@ -90,3 +105,191 @@ class TestConjoiners(unittest.TestCase):
         self.assertRaises(
             ValueError, lambda: Parameters.from_string("frontend_mac=12:12:12:12:12")
         )
+
+    def test_connections(self) -> None:
+        c = ConjoinTracker.from_vm_table({"a": "b\nc", "b": "c", "d": "a"})
+        self.assertListEqual(c.connections("a"), [("d", "a"), ("a", "b"), ("a", "c")])
+        self.assertListEqual(c.connections("c"), [("a", "c"), ("b", "c")])
+        c.disjoin("a", "c")
+        c.disjoin("b", "c")
+        self.assertListEqual(c.connections("c"), [])
+        self.assertNotIn(("a", "c"), c)
+        self.assertEqual(len(c), 2)
+
+    def test_diff_limit_to_vm_ignores_others(self) -> None:
+        config = ConjoinTracker.from_vm_table({"a": "b", "x": "y\nz"})
+        reality = ConjoinTracker.from_vm_table({"a": "c", "y": "z"})
+        self.assertListEqual(
+            config.diff(reality, limit_to_vm="a"),
+            [("-", "a", "c", Parameters()), ("+", "a", "b", Parameters())],
+        )
+
+    def test_serializable_roundtrip(self) -> None:
+        c = ConjoinTracker()
+        c.conjoin(
+            "a", "b", Parameters.from_string("frontend_mac=12:12:12:12:12:12"), "3"
+        )
+        c.conjoin("a", "c", Parameters(), None)
+        s = c.to_serializable()
+        self.assertDictEqual(
+            s,
+            {"a b": ("frontend_mac=12:12:12:12:12:12", "3"), "a c": ("", None)},
+        )
+        d = ConjoinTracker.from_deserializable(s)
+        self.assertListEqual(d.frontends("a"), ["b", "c"])
+        self.assertEqual(d.frontend_network_id("a", "b"), "3")
+        self.assertEqual(
+            d.config("a", "b"), Parameters.from_string("frontend_mac=12:12:12:12:12:12")
+        )
+
+    def test_replace_frontends(self) -> None:
+        c = ConjoinTracker.from_vm_table({"a": "b\nc", "d": "a"})
+        c.replace_frontends("a", "c frontend_mac=12:12:12:12:12:12\ne")
+        self.assertListEqual(c.frontends("a"), ["c", "e"])
+        self.assertListEqual(c.backends("a"), ["d"])
+        self.assertEqual(
+            c.config("a", "c"), Parameters.from_string("frontend_mac=12:12:12:12:12:12")
+        )
+        c.replace_frontends("a", None)
+        self.assertListEqual(c.connections("a"), [("d", "a")])
+
+    def test_replace_frontends_bad_config_leaves_tracker_alone(self) -> None:
+        c = ConjoinTracker.from_vm_table({"a": "b"})
+        self.assertRaises(
+            ValueError, lambda: c.replace_frontends("a", "c frontend_mac=12")
+        )
+        self.assertListEqual(c.frontends("a"), ["b"])
+
+    def test_parse_feature_is_memoized(self) -> None:
+        feature = "b frontend_mac=12:12:12:12:12:12\nc"
+        self.assertIs(parse_feature(feature), parse_feature(feature))
+
+    def test_plan(self) -> None:
+        mac = Parameters.from_string("frontend_mac=12:12:12:12:12:12")
+        config = ConjoinTracker.from_vm_table(
+            {"z": "a", "a": "c\nb frontend_mac=12:12:12:12:12:12"}
+        )
+        reality = ConjoinTracker.from_vm_table({"a": "d\nb", "x": "y"})
+        plan = config.plan(reality)
+        self.assertTrue(plan)
+        self.assertListEqual(
+            plan.adds, [("a", "c", Parameters()), ("z", "a", Parameters())]
+        )
+        self.assertListEqual(
+            plan.removes, [("a", "d", Parameters()), ("x", "y", Parameters())]
+        )
+        self.assertListEqual(plan.replaces, [("a", "b", Parameters(), mac)])
+        self.assertListEqual(
+            config.plan(reality, limit_to_vm="b").actions(),
+            [("-", "a", "b", Parameters()), ("+", "a", "b", mac)],
+        )
+        self.assertFalse(config.plan(reality, limit_to_vm="nonexistent"))
+        self.assertFalse(config.plan(config))
+
+    def test_start_waves(self) -> None:
+        c = ConjoinTracker.from_vm_table(
+            {"router": "a\nb", "a": "c", "b": "c\nd", "outside": "a"}
+        )
+        self.assertListEqual(
+            c.start_waves(["d", "c", "b", "a", "router"]),
+            [["router"], ["a", "b"], ["c", "d"]],
+        )
+        # Backends not being started do not hold anything back.
+        self.assertListEqual(c.start_waves(["c", "a"]), [["a"], ["c"]])
+
+    def test_start_waves_cycle(self) -> None:
+        c = ConjoinTracker.from_vm_table({"a": "b\na", "b": "c", "c": "b\nd"})
+        self.assertListEqual(
+            c.start_waves(["a", "b", "c", "d"]), [["a"], ["b", "c", "d"]]
+        )
+
+    def test_mac_index(self) -> None:
+        mac = MacAddress.from_string("12:12:12:12:12:12")
+        c = ConjoinTracker.from_vm_table({"a": "b frontend_mac=%s\nc" % mac})
+        self.assertListEqual(c.using_mac(mac), [("a", "b")])
+        c.conjoin("a", "b", Parameters(), None)
+        self.assertListEqual(c.using_mac(mac), [])
+        c.replace_frontends("a", "c frontend_mac=%s" % mac)
+        self.assertListEqual(c.using_mac(mac), [("a", "c")])
+        c.disjoin("a", "c")
+        self.assertListEqual(c.using_mac(mac), [])
+
+    def test_validate_frontends(self) -> None:
+        c = ConjoinTracker.from_vm_table(
+            {"a": "b frontend_mac=12:12:12:12:12:12\nc", "d": "c"}
+        )
+        exists = {"a", "b", "c", "d"}.__contains__
+        c.validate_frontends("a", "c frontend_mac=12:12:12:12:12:12\nb", exists)
+        c.validate_frontends("d", None, exists)
+        for backend, feature in [
+            ("a", "a"),
+            ("a", "b\nc\nb"),
+            ("a", "e"),
+            ("a", "b frontend_mac=1"),
+            ("a", "b frontend_mac=34:34:34:34:34:34\nc frontend_mac=34:34:34:34:34:34"),
+            ("d", "b frontend_mac=12:12:12:12:12:12"),
+        ]:
+            with self.assertRaises(ValueError, msg=feature):
+                c.validate_frontends(backend, feature, exists)
+
+    def test_values(self) -> None:
+        mac = MacAddress.from_string("12:34:56:78:9a:bc")
+        self.assertEqual(mac, 0x123456789ABC)
+        self.assertEqual(str(mac), "12:34:56:78:9a:bc")
+        self.assertEqual(str(MacAddress(0)), "00:00:00:00:00:00")
+        self.assertRaises(ValueError, lambda: MacAddress(1 << 48))
+        self.assertRaises(ValueError, lambda: MacAddress.from_string("12:34"))
+        s = "frontend_mac=00:00:00:00:00:00 backend_ip=10.0.0.1 routes=10.1.0.0/16"
+        p = Parameters.from_string(s)
+        self.assertEqual(str(p), s)
+        self.assertIs(p, Parameters.from_string(s))
+        self.assertIs(Parameters(), Parameters.from_string(""))
+        self.assertEqual(len({p, Parameters.from_string(s), Parameters()}), 2)
+        with self.assertRaises(AttributeError):
+            p.backend_ip = "10.0.0.2"
+        a = VifAttachment(p, "1")
+        self.assertEqual(a, VifAttachment(Parameters.from_string(s), "1"))
+        self.assertNotEqual(a, VifAttachment(p, "2"))
+        with self.assertRaises(AttributeError):
+            a.frontend_network_id = "2"  # type: ignore
+
+    def test_generations(self) -> None:
+        c = ConjoinTracker.from_vm_table({"a": "b\nc"})
+        other = ConjoinTracker.from_vm_table({"a": "b\nc"})
+        self.assertNotEqual(c.generation, other.generation)
+        self.assertNotEqual(c.vm_generation("d"), other.vm_generation("d"))
+        g, a, b, c_, d = (
+            c.generation,
+            c.vm_generation("a"),
+            c.vm_generation("b"),
+            c.vm_generation("c"),
+            c.vm_generation("d"),
+        )
+        # Setting an edge to what it already is changes nothing.
+        c.conjoin("a", "b", Parameters(), None)
+        self.assertEqual(c.generation, g)
+        c.disjoin("a", "b")
+        self.assertGreater(c.generation, g)
+        self.assertEqual(c.vm_generation("a"), c.generation)
+        self.assertEqual(c.vm_generation("b"), c.generation)
+        self.assertNotEqual(c.vm_generation("a"), a)
+        self.assertNotEqual(c.vm_generation("b"), b)
+        self.assertEqual(c.vm_generation("c"), c_)
+        self.assertEqual(c.vm_generation("d"), d)
+        g = c.generation
+        c.conjoin("a", "c", Parameters(), "1")
+        self.assertGreater(c.generation, g)
+        self.assertEqual(c.vm_generation("b"), g)
+
+    def test_changed_since(self) -> None:
+        c = ConjoinTracker.from_vm_table({"a": "b\nc"})
+        g = c.generation
+        self.assertIsNone(c.changed_since(g))
+        c.track_changes()
+        self.assertEqual(c.changed_since(g), [])
+        c.disjoin("a", "b")
+        c.conjoin("a", "c", Parameters(), "1")
+        self.assertEqual(c.changed_since(c.generation), [])
+        # Removed edges are included, with the latest changes first.
+        self.assertEqual(c.changed_since(g), [("a", "c"), ("a", "b")])
+        self.assertIsNone(c.changed_since(g - 1))
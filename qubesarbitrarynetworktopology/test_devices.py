@@ -0,0 +1,149 @@
+import asyncio
+import unittest
+import unittest.mock
+
+
+from qubesarbitrarynetworktopology import devices
+from qubesarbitrarynetworktopology.conjoin import MacAddress
+
+
+class FakeXenstore(object):
+    def __init__(self, data: dict[str, str]) -> None:
+        self.data = data
+
+    def ls(self, unused_transaction: str, path: str) -> list[str] | None:
+        prefix = path + "/"
+        children = {
+            k[len(prefix) :].split("/")[0] for k in self.data if k.startswith(prefix)
+        }
+        return sorted(children) or None
+
+    def read(self, unused_transaction: str, path: str) -> bytes | None:
+        v = self.data.get(path)
+        return v.encode("utf-8") if v is not None else None
+
+
+class TestXenstoreDeviceBackend(unittest.IsolatedAsyncioTestCase):
+    async def test_attach_picks_next_devid(self) -> None:
+        xs = FakeXenstore(
+            {
+                "/local/domain/0/name": "Domain-0",
+                "/local/domain/3/name": "b",
+                "/local/domain/5/name": "f",
+                "/local/domain/5/device/vif/0/state": "4",
+                "/local/domain/5/device/vif/2/state": "4",
+            }
+        )
+        backend = devices.XenstoreDeviceBackend(xs)
+        with unittest.mock.patch.object(devices, "_run") as run:
+            vifid = await backend.attach(
+                "b", "f", MacAddress.from_string("12:12:12:12:12:12")
+            )
+        self.assertEqual(vifid, "3")
+        run.assert_called_once_with(
+            [
+                "xl",
+                "network-attach",
+                "f",
+                "mac=12:12:12:12:12:12",
+                "devid=3",
+                "backend=b",
+                "vifname=f",
+                "script=vif-route-nexus",
+            ]
+        )
+
+    async def test_attach_to_stopped_domain_fails(self) -> None:
+        backend = devices.XenstoreDeviceBackend(FakeXenstore({}))
+        with unittest.mock.patch.object(devices, "_run"):
+            with self.assertRaises(devices.DeviceError):
+                await backend.attach("b", "f")
+
+
+class TestXlDeviceBackend(unittest.IsolatedAsyncioTestCase):
+    async def test_attaches_to_same_frontend_do_not_overlap(self) -> None:
+        # The VIF IDs of f, as xl network-list would list them.
+        vifids = ["0"]
+
+        async def run(cmd: list[str], capture: bool = False) -> str:
+            await asyncio.sleep(0)
+            if cmd[1] == "network-attach":
+                vifids.append(str(len(vifids)))
+                return ""
+            return "Idx BE Mac Addr.\n" + "".join(
+                "%s 3 00:16:3e:5e:6c:0%s\n" % (v, v) for v in vifids
+            )
+
+        backend = devices.XlDeviceBackend()
+        with unittest.mock.patch.object(devices, "_run", run):
+            results = await asyncio.gather(
+                backend.attach("b", "f"), backend.attach("c", "f")
+            )
+        self.assertListEqual(list(results), ["1", "2"])
+
+
+XENSTORE = {
+    "/local/domain/0/name": "Domain-0",
+    "/local/domain/3/name": "b",
+    "/local/domain/5/name": "f",
+    # The VIF Qubes attaches to f, served by its netvm b.
+    "/local/domain/3/backend/vif/5/0/script": "/etc/xen/scripts/vif-route-qubes",
+    "/local/domain/3/backend/vif/5/0/mac": "00:16:3e:5e:6c:00",
+    # Two VIFs of the topology.
+    "/local/domain/3/backend/vif/5/1/script": "/etc/xen/scripts/vif-route-nexus",
+    "/local/domain/3/backend/vif/5/1/mac": "12:12:12:12:12:12",
+    "/local/domain/5/backend/vif/3/0/script": "/etc/xen/scripts/vif-route-nexus",
+    # A VIF of a domain that is going away.
+    "/local/domain/3/backend/vif/9/0/script": "/etc/xen/scripts/vif-route-nexus",
+    # The frontend side of each VIF.
+    "/local/domain/5/device/vif/0/backend-id": "3",
+    "/local/domain/5/device/vif/1/backend-id": "3",
+    "/local/domain/3/device/vif/0/backend-id": "5",
+}
+
+INVENTORY = [
+    ("b", "f", "1", MacAddress.from_string("12:12:12:12:12:12")),
+    ("f", "b", "0", None),
+]
+
+
+class TestInventory(unittest.IsolatedAsyncioTestCase):
+    async def test_xenstore(self) -> None:
+        backend = devices.XenstoreDeviceBackend(FakeXenstore(XENSTORE))
+        self.assertListEqual(await backend.inventory(), INVENTORY)
+        self.assertListEqual(await backend.inventory(["f"]), INVENTORY[:1])
+        self.assertListEqual(await backend.inventory(["b", "gone"]), INVENTORY[1:])
+        self.assertListEqual(await backend.inventory([]), [])
+
+    async def test_xl(self) -> None:
+        paths = set(XENSTORE)
+        for path in XENSTORE:
+            while path.count("/") > 1:
+                path = path.rsplit("/", 1)[0]
+                paths.add(path)
+        listing = "".join(
+            '%s = "%s"\n' % (path, XENSTORE.get(path, "")) for path in sorted(paths)
+        )
+        backend = devices.XlDeviceBackend()
+        with unittest.mock.patch.object(devices, "_run", return_value=listing) as run:
+            self.assertListEqual(await backend.inventory(), INVENTORY)
+        run.assert_called_once_with(
+            ["xenstore-ls", "-f", "/local/domain"], capture=True
+        )
+
+
+class TestFakeDeviceBackend(unittest.IsolatedAsyncioTestCase):
+    async def test_attach_detach(self) -> None:
+        backend = devices.FakeDeviceBackend()
+        self.assertEqual(await backend.attach("b", "f"), "0")
+        self.assertEqual(await backend.attach("c", "f"), "1")
+        await backend.detach("f", "0")
+        self.assertDictEqual(backend.vifs, {"f": {"1": ("c", None)}})
+        with self.assertRaises(devices.DeviceError):
+            await backend.detach("f", "0")
+        backend.fail.add(("b", "f"))
+        with self.assertRaises(devices.DeviceError):
+            await backend.attach("b", "f")
+        self.assertDictEqual(backend.calls, {"attach": 3, "detach": 2})
+        self.assertListEqual(await backend.inventory(), [("c", "f", "1", None)])
+        self.assertListEqual(await backend.inventory(["c"]), [])
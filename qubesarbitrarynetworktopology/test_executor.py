@@ -0,0 +1,83 @@
+import asyncio
+import typing
+import unittest
+
+
+from qubesarbitrarynetworktopology.executor import EdgeExecutor
+
+
+class TestEdgeExecutor(unittest.IsolatedAsyncioTestCase):
+    async def _run(
+        self,
+        executor: EdgeExecutor,
+        backends: list[str],
+        frontends: list[str] | None = None,
+    ) -> tuple[list[int | BaseException], dict[str, int]]:
+        running = {"all": 0}
+        peaks = {"all": 0}
+
+        def job(
+            backend: str, frontend: str, result: int
+        ) -> typing.Callable[[], typing.Awaitable[int]]:
+            async def f() -> int:
+                running["all"] += 1
+                for key in (backend, "frontend " + frontend):
+                    running[key] = running.get(key, 0) + 1
+                    peaks[key] = max(peaks.get(key, 0), running[key])
+                peaks["all"] = max(peaks["all"], running["all"])
+                await asyncio.sleep(0.01)
+                running["all"] -= 1
+                running[backend] -= 1
+                running["frontend " + frontend] -= 1
+                return result
+
+            return f
+
+        if frontends is None:
+            frontends = [str(n) for n in range(len(backends))]
+        results = await executor.run(
+            [
+                (b, f, job(b, f, n))
+                for n, (b, f) in enumerate(zip(backends, frontends))
+            ]
+        )
+        return results, peaks
+
+    async def test_results_in_order(self) -> None:
+        results, _ = await self._run(EdgeExecutor(), ["a", "b", "a", "c"])
+        self.assertListEqual(results, [0, 1, 2, 3])
+
+    async def test_per_backend_limit(self) -> None:
+        _, peaks = await self._run(
+            EdgeExecutor(max_concurrency=10, max_per_backend=2), ["a"] * 6 + ["b"]
+        )
+        self.assertEqual(peaks["a"], 2)
+        self.assertEqual(peaks["all"], 3)
+
+    async def test_overall_limit(self) -> None:
+        _, peaks = await self._run(
+            EdgeExecutor(max_concurrency=3, max_per_backend=3),
+            ["a", "b", "c", "d"] * 2,
+        )
+        self.assertEqual(peaks["all"], 3)
+
+    async def test_per_frontend_serialized(self) -> None:
+        _, peaks = await self._run(
+            EdgeExecutor(), ["a", "b", "c", "d"], ["x", "x", "x", "y"]
+        )
+        self.assertEqual(peaks["frontend x"], 1)
+        self.assertEqual(peaks["all"], 2)
+
+    async def test_exceptions_returned(self) -> None:
+        async def fail() -> int:
+            raise RuntimeError("boom")
+
+        async def succeed() -> int:
+            return 1
+
+        results = await EdgeExecutor().run([("a", "x", fail), ("a", "y", succeed)])
+        self.assertIsInstance(results[0], RuntimeError)
+        self.assertEqual(results[1], 1)
+
+    def test_bad_limits_raise_valueerror(self) -> None:
+        self.assertRaises(ValueError, lambda: EdgeExecutor(max_concurrency=0))
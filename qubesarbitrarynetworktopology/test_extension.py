@@ -0,0 +1,535 @@
+import asyncio
+import time
+import typing
+import unittest
+import unittest.mock
+
+
+from qubesarbitrarynetworktopology import (
+    DESIRED_PATH,
+    HOLD_FEATURE,
+    LINK_ATTACHED,
+    PENDING_PATH,
+    RETRIES_PATH,
+    QubesArbitraryNetworkTopologyExtension,
+)
+from qubesarbitrarynetworktopology.conjoin import ConjoinTracker, MacAddress, Parameters
+from qubesarbitrarynetworktopology.devices import FakeDeviceBackend, Vif
+from qubesarbitrarynetworktopology.metrics import SKIPPED_VMS
+from qubesarbitrarynetworktopology.persistence import (
+    ConjoinStore,
+    edge_key,
+    read_tree,
+)
+from qubesarbitrarynetworktopology.retry import RetryQueue
+from qubesarbitrarynetworktopology.scheduler import ReconcileBatch
+from qubesarbitrarynetworktopology.states import DomainStates, poll_power_states
+from qubesarbitrarynetworktopology.testing import FakeApp, FakeQubesDB
+
+
+class RecordingDeviceBackend(FakeDeviceBackend):
+    def __init__(self) -> None:
+        super().__init__()
+        self.inventories: list[set[str] | None] = []
+        # Attaches wait while this is clear.
+        self.attaching = asyncio.Event()
+        self.attaching.set()
+
+    async def attach(
+        self, backend: str, frontend: str, frontend_mac: MacAddress | None = None
+    ) -> str:
+        await self.attaching.wait()
+        return await super().attach(backend, frontend, frontend_mac)
+
+    async def inventory(
+        self, frontends: typing.Collection[str] | None = None
+    ) -> list[Vif]:
+        self.inventories.append(None if frontends is None else set(frontends))
+        return await super().inventory(frontends)
+
+
+class ExtensionTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.app = FakeApp({"router": "a\nb", "a": "c", "b": None, "c": None})
+        # Reconciliation is only ever carried out by the tests themselves.
+        dom0 = self.app.domains["dom0"]
+        dom0.features[HOLD_FEATURE] = "%.0f" % (time.time() + 3600)
+        self.db = FakeQubesDB()
+        self.devices = RecordingDeviceBackend()
+        self.ext = QubesArbitraryNetworkTopologyExtension()
+        # The extension is a singleton, which may have been loaded already.
+        self.ext.__dict__.pop("config", None)
+        self.ext.__dict__.pop("active", None)
+        self.ext.devices = self.devices
+        self.ext.store = ConjoinStore(self.db)
+        self.ext.states = DomainStates(poll_power_states)
+        self.ext._app = self.app
+
+    def links(self) -> dict[tuple[str, str], str | None]:
+        return {edge: v.frontend_network_id for edge, v in self.ext.active.items()}
+
+    def vifs(self) -> dict[str, dict[str, str]]:
+        return {
+            frontend: {vifid: backend for vifid, (backend, _) in vifs.items()}
+            for frontend, vifs in self.devices.vifs.items()
+            if vifs
+        }
+
+    # What every test ends up with: the configured links, all up.
+    CONVERGED = {("router", "a"): "0", ("router", "b"): "0", ("a", "c"): "0"}
+
+
+class TestDomainStates(ExtensionTestCase):
+    def test_kept_current_by_handlers(self) -> None:
+        queries = []
+
+        def query(app: typing.Any) -> dict[str, bool]:
+            queries.append(app)
+            return poll_power_states(app)
+
+        self.ext.states = DomainStates(query)
+        vms = self.app.domains
+        self.assertListEqual(
+            self.ext.states.running(self.app), ["dom0", "router", "a", "b", "c"]
+        )
+        vms["a"].paused = True
+        self.ext.on_domain_paused(vms["a"], "domain-paused")
+        vms["c"].running = False
+        self.ext.on_domain_shutdown(vms["c"], "domain-shutdown")
+        self.assertDictEqual(
+            self.ext.states.snapshot(self.app),
+            {"dom0": False, "router": False, "a": True, "b": False},
+        )
+        self.assertListEqual(
+            self.ext.states.actionable(self.app, [("router", "a"), ("router", "b")]),
+            [("router", "b")],
+        )
+        vms["a"].paused = False
+        self.ext.on_domain_unpaused(vms["a"], "domain-unpaused")
+        vms["c"].running = True
+        self.ext.on_domain_started(vms["c"], "domain-start")
+        self.ext.on_domain_deleted(self.app, "domain-delete", vm=vms["b"])
+        self.assertDictEqual(
+            self.ext.states.snapshot(self.app),
+            {"dom0": False, "router": False, "a": False, "c": False},
+        )
+        self.assertEqual(len(queries), 1)
+
+
+class TestConfig(ExtensionTestCase):
+    def test_deleted_vm_edges_dropped(self) -> None:
+        self.ext._delayed_graphs_loader(app=self.app)
+        vms = self.app.domains
+        self.ext.on_domain_deleted(self.app, "domain-delete", vm=vms.pop("a"))
+        # router still names a in its feature.
+        self.assertListEqual(list(self.ext.config), [("router", "b")])
+
+
+class TestBackground(ExtensionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # Reconciliation is left to the handlers here.
+        del self.app.domains["dom0"].features[HOLD_FEATURE]
+
+    async def test_handlers_do_not_wait(self) -> None:
+        vms = self.app.domains
+        self.devices.attaching.clear()
+        self.ext.on_domain_started(vms["router"], "domain-start")
+        # The handler returned while xl is still at work.
+        self.assertEqual(len(self.ext.active), 0)
+        self.assertListEqual(vms["router"].events, [])
+        self.devices.attaching.set()
+        await self.ext.scheduler.drain()
+        # The first pass resynchronized the whole topology.
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertEqual(vms["router"].events[-1], ("topology-reconciled", {}))
+
+    async def test_failed_pass_is_logged(self) -> None:
+        vms = self.app.domains
+        with unittest.mock.patch.object(self.ext.store, "save", side_effect=OSError()):
+            with self.assertLogs("qubesarbitrarynetworktopology", "ERROR"):
+                self.ext.on_domain_started(vms["router"], "domain-start")
+                await self.ext.scheduler.drain()
+        self.assertNotIn(("topology-reconciled", {}), vms["router"].events)
+
+
+class TestHold(ExtensionTestCase):
+    async def asyncSetUp(self) -> None:
+        # As when qubesd starts, with the hold of setUp() in place.
+        self.ext._delayed_graphs_loader(app=self.app)
+        self.ext.scheduler.delay = 0.0
+
+    def set_hold(self, value: str) -> None:
+        dom0 = self.app.domains["dom0"]
+        dom0.features[HOLD_FEATURE] = value
+        self.ext.on_setting_changed(
+            dom0, "domain-feature-set:" + HOLD_FEATURE, value=value
+        )
+
+    async def reconciled(self) -> bool:
+        self.ext.scheduler.conjoin("router")
+        await self.ext.scheduler.drain()
+        return self.links() == self.CONVERGED
+
+    async def test_held_until_lapsed(self) -> None:
+        self.assertFalse(await self.reconciled())
+        self.set_hold("%f" % (time.time() + 0.05))
+        self.assertFalse(await self.reconciled())
+        await asyncio.sleep(0.1)
+        self.assertTrue(await self.reconciled())
+
+    async def test_lapsed_hold_is_ignored(self) -> None:
+        # As left behind by a qvm-network-topology that died.
+        with self.assertLogs("qubesarbitrarynetworktopology", "WARNING"):
+            self.set_hold("%.0f" % (time.time() - 60))
+        self.assertTrue(await self.reconciled())
+
+    async def test_invalid_hold_is_ignored(self) -> None:
+        with self.assertLogs("qubesarbitrarynetworktopology", "WARNING"):
+            self.set_hold("1 day")
+        self.assertTrue(await self.reconciled())
+
+
+class TestRecover(ExtensionTestCase):
+    async def test_replays_journal(self) -> None:
+        store = self.ext.store
+        store.record_intents(
+            {
+                ("router", "a"): ([("+", Parameters())], None),
+                ("router", "b"): ([("+", Parameters())], None),
+                ("a", "c"): ([("+", Parameters())], None),
+            }
+        )
+        # qubesd died after attaching the VIFs of b and c, having only
+        # confirmed the one of b, and before attaching the one of a.
+        store.confirm_intent("router", "b", [("+", Parameters(), "0")])
+        self.devices.vifs = {"b": {"0": ("router", None)}, "c": {"0": ("a", None)}}
+        await self.ext.recover(app=self.app)
+        # Only the frontends of the edges in flight were looked at.
+        self.assertListEqual(self.devices.inventories, [{"a", "c"}])
+        self.assertDictEqual(self.devices.calls, {"attach": 1, "detach": 0})
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertDictEqual(self.db.multiread(ConjoinStore.JOURNAL_PATH + "/"), {})
+        self.assertEqual(ConjoinStore(self.db).load(), self.ext.active)
+
+    async def test_unreadable_journal(self) -> None:
+        self.db.data[ConjoinStore.JOURNAL_PATH + "/x/y"] = b"garbage"
+        self.devices.vifs = {"b": {"0": ("router", None)}}
+        await self.ext.recover(app=self.app)
+        self.assertListEqual(self.devices.inventories, [None])
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertDictEqual(self.db.multiread(ConjoinStore.JOURNAL_PATH + "/"), {})
+
+    async def test_unknown_outcome_kept(self) -> None:
+        attach = self.devices.attach
+
+        async def attach_then_fail(
+            backend: str, frontend: str, frontend_mac: MacAddress | None = None
+        ) -> str:
+            vifid = await attach(backend, frontend, frontend_mac)
+            if (backend, frontend) == ("router", "b"):
+                raise RuntimeError("lost track of %s" % vifid)
+            return vifid
+
+        with unittest.mock.patch.object(self.devices, "attach", attach_then_fail):
+            with self.assertLogs("qubesarbitrarynetworktopology", "ERROR"):
+                await self.ext.recover(app=self.app)
+        # Unlike the others, the intent on the edge to b is kept.
+        self.assertListEqual(
+            list(self.db.multiread(ConjoinStore.JOURNAL_PATH + "/")),
+            [edge_key(ConjoinStore.JOURNAL_PATH, "router", "b")],
+        )
+        self.assertNotIn(("router", "b"), self.ext.active)
+        # The next pass finds out that the VIF got attached after all.
+        await self.ext._reconcile_batch(ReconcileBatch())
+        self.assertListEqual(self.devices.inventories, [{"b"}])
+        self.assertDictEqual(self.devices.calls, {"attach": 3, "detach": 0})
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertDictEqual(self.db.multiread(ConjoinStore.JOURNAL_PATH + "/"), {})
+
+
+class TestShutdown(ExtensionTestCase):
+    async def asyncSetUp(self) -> None:
+        await self.ext.resync(app=self.app)
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.devices.calls = {"attach": 0, "detach": 0}
+
+    async def shut_down_router_before_a(self, grace: float) -> None:
+        vms = self.app.domains
+        vms["a"].shutdown_timeout = grace
+        # As with qvm-shutdown --all, a is told to shut down too.
+        self.ext.on_domain_pre_shutdown(vms["a"], "domain-pre-shutdown")
+        vms["router"].running = False
+        self.ext.on_domain_shutdown(vms["router"], "domain-shutdown")
+        await self.ext.reconcile(disjoin=["router"], app=self.app)
+        # The VIF in b is detached, the one in a left to go away with a.
+        self.assertDictEqual(self.devices.calls, {"attach": 0, "detach": 1})
+        self.assertDictEqual(self.links(), {("a", "c"): "0"})
+        self.assertDictEqual(self.vifs(), {"a": {"0": "router"}, "c": {"0": "a"}})
+        self.assertDictEqual(self.ext._deferred, {"a": [("router", "0")]})
+
+    async def test_detach_skipped_if_frontend_goes_down(self) -> None:
+        await self.shut_down_router_before_a(0.1)
+        vms = self.app.domains
+        vms["a"].running = False
+        self.ext.on_domain_shutdown(vms["a"], "domain-shutdown")
+        self.assertDictEqual(self.ext._deferred_timers, {})
+        await asyncio.sleep(0.2)
+        self.assertDictEqual(self.devices.calls, {"attach": 0, "detach": 1})
+
+    async def test_deferred_detach_if_frontend_stays_up(self) -> None:
+        await self.shut_down_router_before_a(0.1)
+        await asyncio.sleep(0.2)
+        await asyncio.gather(*self.ext._retry_tasks)
+        self.assertDictEqual(self.devices.calls, {"attach": 0, "detach": 2})
+        self.assertDictEqual(self.vifs(), {"c": {"0": "a"}})
+        # Should a go down later after all, its links are torn down anew.
+        self.assertNotIn("a", self.ext._stopping)
+
+    async def test_deferred_detach_if_frontend_shutdown_fails(self) -> None:
+        await self.shut_down_router_before_a(60)
+        self.ext.on_domain_shutdown_failed(
+            self.app.domains["a"], "domain-shutdown-failed"
+        )
+        self.assertDictEqual(self.ext._deferred_timers, {})
+        await asyncio.gather(*self.ext._retry_tasks)
+        self.assertDictEqual(self.devices.calls, {"attach": 0, "detach": 2})
+        self.assertDictEqual(self.vifs(), {"c": {"0": "a"}})
+        self.assertNotIn("a", self.ext._stopping)
+
+    async def test_frontend_not_stopping_once_unpaused(self) -> None:
+        vms = self.app.domains
+        self.ext.on_domain_pre_shutdown(vms["a"], "domain-pre-shutdown")
+        self.ext.on_domain_unpaused(vms["a"], "domain-unpaused")
+        self.assertNotIn("a", self.ext._stopping)
+
+    async def test_frontend_not_stopping_past_its_shutdown_timeout(self) -> None:
+        vms = self.app.domains
+        vms["a"].shutdown_timeout = 0.01
+        # The shutdown of a is vetoed, with no further event.
+        self.ext.on_domain_pre_shutdown(vms["a"], "domain-pre-shutdown")
+        await asyncio.sleep(0.05)
+        vms["router"].running = False
+        self.ext.on_domain_shutdown(vms["router"], "domain-shutdown")
+        await self.ext.reconcile(disjoin=["router"], app=self.app)
+        self.assertDictEqual(self.devices.calls, {"attach": 0, "detach": 2})
+        self.assertDictEqual(self.ext._deferred, {})
+        self.assertNotIn("a", self.ext._stopping)
+
+
+class TestResync(ExtensionTestCase):
+    async def test_adopts_attached_vifs(self) -> None:
+        # Attached while qubesd was not running.
+        self.devices.vifs = {"a": {"0": ("router", None)}, "c": {"0": ("a", None)}}
+        await self.ext.resync(app=self.app)
+        self.assertDictEqual(self.devices.calls, {"attach": 1, "detach": 0})
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertIn(
+            (LINK_ATTACHED, {"frontend": "a", "vifid": "0", "config": ""}),
+            self.app.domains["router"].events,
+        )
+
+    async def test_reconciles_stale_links(self) -> None:
+        active = ConjoinTracker()
+        for backend, frontend in [("router", "a"), ("router", "b"), ("a", "c")]:
+            active.conjoin(backend, frontend, Parameters(), "0")
+        self.ext.store.save(active)
+        # The VIF of a went away, b got a duplicate, and c a VIF of b that
+        # is not configured.
+        self.devices.vifs = {
+            "b": {"0": ("router", None), "1": ("router", None)},
+            "c": {"0": ("a", None), "1": ("b", None)},
+        }
+        await self.ext.resync(app=self.app)
+        self.assertDictEqual(self.devices.calls, {"attach": 1, "detach": 2})
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertDictEqual(
+            self.vifs(), {"a": {"0": "router"}, "b": {"0": "router"}, "c": {"0": "a"}}
+        )
+
+
+class TestPublish(ExtensionTestCase):
+    async def asyncSetUp(self) -> None:
+        await self.ext.resync(app=self.app)
+        self.ext._publish_topology()
+
+    def published(self) -> list[str]:
+        # The keys written since last called, after checking the trees.
+        self.assertDictEqual(
+            read_tree(self.db, DESIRED_PATH),
+            {e: [str(v.config)] for e, v in self.ext.config.items()},
+        )
+        self.assertDictEqual(
+            read_tree(self.db, PENDING_PATH),
+            {
+                (e["backend"], e["frontend"]): [e["action"], e["config"]]
+                for e in self.ext.pending()
+            },
+        )
+        written = [
+            k for k in self.db.writes if k.startswith((DESIRED_PATH, PENDING_PATH))
+        ]
+        self.db.writes.clear()
+        return written
+
+    def set_feature(self, vm: str, value: str) -> None:
+        self.app.domains[vm].features["attach-network-to"] = value
+        self.ext.on_attach_network_to_changed(
+            self.app.domains[vm], "domain-feature-set:attach-network-to", value=value
+        )
+        self.ext._publish_topology()
+
+    async def test_publishes_what_changed(self) -> None:
+        self.assertEqual(len(self.published()), 3)
+        mac = "frontend_mac=12:12:12:12:12:12"
+        self.set_feature("a", "c " + mac)
+        self.assertEqual(len(self.published()), 2)
+        # c being paused takes the replace off the pending changes.
+        self.ext.on_domain_paused(self.app.domains["c"], "domain-paused")
+        self.ext._publish_topology()
+        self.assertListEqual(self.published(), [])
+        self.assertDictEqual(read_tree(self.db, PENDING_PATH), {})
+        self.ext.on_domain_unpaused(self.app.domains["c"], "domain-unpaused")
+        self.ext._publish_topology()
+        self.assertEqual(len(self.published()), 1)
+        self.set_feature("a", "")
+        self.assertEqual(len(self.published()), 1)
+        self.assertNotIn(("a", "c"), read_tree(self.db, DESIRED_PATH))
+        # Nothing changed since.
+        self.ext._publish_topology()
+        self.assertListEqual(self.published(), [])
+
+
+class TestSkipConverged(ExtensionTestCase):
+    ALL = ["router", "a", "b", "c"]
+
+    async def asyncSetUp(self) -> None:
+        await self.ext.resync(app=self.app)
+        # VMs are found converged on the first pass that has nothing to do.
+        await self.ext.reconcile(conjoin=self.ALL, app=self.app)
+        self.devices.calls = {"attach": 0, "detach": 0}
+
+    async def skipped(self, vms: list[str]) -> float:
+        # How many of vms a pass bringing up their links skipped.
+        before = SKIPPED_VMS.values.get((), 0)
+        await self.ext.reconcile(conjoin=vms, app=self.app)
+        return SKIPPED_VMS.values.get((), 0) - before
+
+    async def test_unchanged(self) -> None:
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertEqual(await self.skipped(self.ALL), 4)
+        self.assertDictEqual(self.devices.calls, {"attach": 0, "detach": 0})
+
+    async def test_feature_changed(self) -> None:
+        vm = self.app.domains["a"]
+        vm.features["attach-network-to"] = "c\nb"
+        self.ext.on_attach_network_to_changed(
+            vm, "domain-feature-set:attach-network-to", value="c\nb"
+        )
+        # The links of a were all replaced, so only router is skipped.
+        self.assertEqual(await self.skipped(self.ALL), 1)
+        self.assertDictEqual(self.devices.calls, {"attach": 1, "detach": 0})
+        self.assertDictEqual(self.links(), {**self.CONVERGED, ("a", "b"): "1"})
+        self.assertEqual(await self.skipped(self.ALL), 2)
+        self.assertEqual(await self.skipped(self.ALL), 4)
+
+    async def test_power_state_changed(self) -> None:
+        vms = self.app.domains
+        vms["router"].running = False
+        self.ext.on_domain_shutdown(vms["router"], "domain-shutdown")
+        await self.ext.reconcile(disjoin=["router"], app=self.app)
+        vms["b"].paused = True
+        self.ext.on_domain_paused(vms["b"], "domain-paused")
+        vms["router"].running = True
+        self.ext.on_domain_started(vms["router"], "domain-start")
+        self.assertEqual(await self.skipped(["router"]), 0)
+        self.assertDictEqual(self.devices.calls, {"attach": 1, "detach": 2})
+        # The link to b is missing while b is paused, so neither router nor
+        # b are skipped, however many passes there are.
+        for skipped in (1, 2, 2):
+            self.assertEqual(await self.skipped(self.ALL), skipped)
+        vms["b"].paused = False
+        self.ext.on_domain_unpaused(vms["b"], "domain-unpaused")
+        self.assertEqual(await self.skipped(["b"]), 0)
+        self.assertDictEqual(self.devices.calls, {"attach": 2, "detach": 2})
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertEqual(await self.skipped(self.ALL), 2)
+        self.assertEqual(await self.skipped(self.ALL), 4)
+
+    async def test_active_changed(self) -> None:
+        # The link went away behind the back of the scheduler, as when its
+        # VIF is found missing.
+        self.ext.active.disjoin("router", "a")
+        del self.devices.vifs["a"]["0"]
+        self.assertEqual(await self.skipped(self.ALL), 2)
+        self.assertDictEqual(self.devices.calls, {"attach": 1, "detach": 0})
+        self.assertDictEqual(self.links(), self.CONVERGED)
+        self.assertEqual(await self.skipped(self.ALL), 2)
+        self.assertEqual(await self.skipped(self.ALL), 4)
+
+
+class TestRetries(ExtensionTestCase):
+    async def test_persisted_per_edge(self) -> None:
+        self.ext.retries.max_per_backend = 1000
+        for n in range(50):
+            self.ext.retries.add("router", "vm-with-a-long-name-%s" % n)
+        self.ext.retries.add("router", "vm-with-a-long-name-0", "3")
+        tree = read_tree(self.db, RETRIES_PATH)
+        self.assertEqual(len(tree), 50)
+        self.assertEqual(len(tree[("router", "vm-with-a-long-name-0")]), 2)
+        before = self.ext.retries
+        self.ext.retries = RetryQueue(self.ext._retry, self.ext._persist_retries)
+        self.ext._restore_retries()
+        # Failed detaches are left for resync() to find.
+        self.assertEqual(len(self.ext.retries), 50)
+        self.assertNotIn(("router", "vm-with-a-long-name-0", "3"), self.ext.retries)
+        for queue in (before, self.ext.retries):
+            for entry in queue.status():
+                queue.discard(entry["backend"], entry["frontend"], entry["vifid"])
+
+    async def test_given_up_until_changed(self) -> None:
+        vms = self.app.domains
+        del vms["dom0"].features[HOLD_FEATURE]
+        self.ext._delayed_graphs_loader(app=self.app)
+        self.ext.scheduler.delay = 0.0
+        self.ext.retries = RetryQueue(
+            self.ext._retry,
+            self.ext._persist_retries,
+            base_delay=0.01,
+            max_delay=0.02,
+            max_attempts=3,
+        )
+        self.devices.fail.add(("router", "a"))
+
+        async def settle() -> list[dict[str, typing.Any]]:
+            await asyncio.sleep(0.3)
+            await self.ext.scheduler.drain()
+            return self.ext.retries.status()
+
+        with self.assertLogs("qubesarbitrarynetworktopology", "WARNING"):
+            self.ext.scheduler.conjoin("router")
+            (entry,) = await settle()
+        # Passes driven by the retries failed too, without starting over.
+        self.assertTrue(entry["gave_up"])
+        self.assertEqual(entry["attempts"], 3)
+        attaches = self.devices.calls["attach"]
+        with self.assertLogs("qubesarbitrarynetworktopology", "ERROR"):
+            self.ext.scheduler.conjoin("router")
+            self.assertEqual(await settle(), [entry])
+        self.assertEqual(self.devices.calls["attach"], attaches + 1)
+        # Until either VM changes state.
+        self.ext.on_domain_paused(vms["a"], "domain-paused")
+        self.assertListEqual(self.ext.retries.status(), [])
+        self.ext.on_domain_unpaused(vms["a"], "domain-unpaused")
+        with self.assertLogs("qubesarbitrarynetworktopology", "WARNING"):
+            (entry,) = await settle()
+        self.assertTrue(entry["gave_up"])
+        # Or the edge gets configured anew.
+        mac = "a frontend_mac=12:12:12:12:12:12\nb"
+        vms["router"].features["attach-network-to"] = mac
+        self.devices.fail.clear()
+        self.ext.on_attach_network_to_changed(
+            vms["router"], "domain-feature-set:attach-network-to", value=mac
+        )
+        self.assertListEqual(await settle(), [])
+        self.assertEqual(self.links()[("router", "a")], "0")
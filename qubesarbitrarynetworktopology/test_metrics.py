@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+
+from qubesarbitrarynetworktopology.metrics import (
+    PREFIX,
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self) -> None:
+        c = Counter("things_total", "Things.")
+        c.inc(result="success")
+        c.inc(2, result="success")
+        c.inc(result="failure")
+        self.assertEqual(
+            c.render(),
+            "# HELP %sthings_total Things.\n"
+            "# TYPE %sthings_total counter\n"
+            '%sthings_total{result="failure"} 1.0\n'
+            '%sthings_total{result="success"} 3.0\n' % ((PREFIX,) * 4),
+        )
+
+    def test_gauge(self) -> None:
+        g = Gauge("pending", "Pending.")
+        g.inc(5)
+        g.inc(-2)
+        self.assertEqual(g.values, {(): 3})
+        g.set(7)
+        self.assertEqual(g.values, {(): 7})
+
+    def test_histogram(self) -> None:
+        h = Histogram("seconds", "Seconds.", buckets=(0.1, 1.0))
+        h.observe(0.05, phase="save")
+        h.observe(0.5, phase="save")
+        h.observe(5, phase="save")
+        samples = list(h.samples())
+        expected = [
+            '%sseconds_bucket{phase="save",le="0.1"} 1.0',
+            '%sseconds_bucket{phase="save",le="1.0"} 2.0',
+            '%sseconds_bucket{phase="save",le="+Inf"} 3.0',
+            '%sseconds_sum{phase="save"} 5.55',
+            '%sseconds_count{phase="save"} 3.0',
+        ]
+        self.assertListEqual(samples, [e % PREFIX for e in expected])
+
+    def test_histogram_times_failures(self) -> None:
+        h = Histogram("seconds", "Seconds.")
+        with self.assertRaises(ValueError):
+            with h.time(phase="execute"):
+                raise ValueError()
+        self.assertEqual(h.values[(("phase", "execute"),)][0][-1], 1)
+
+    def test_write_textfile(self) -> None:
+        r = Registry()
+        c = Counter("things_total", "Things.")
+        r.register(c)
+        c.inc()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "metrics.prom")
+            r.write_textfile(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), r.render())
+            self.assertListEqual(os.listdir(d), ["metrics.prom"])
@@ -0,0 +1,188 @@
+import json
+import typing
+import unittest
+
+
+from qubesarbitrarynetworktopology.conjoin import ConjoinTracker, Parameters
+from qubesarbitrarynetworktopology.persistence import (
+    ConjoinStore,
+    edge_key,
+    read_list,
+    read_tree,
+)
+from qubesarbitrarynetworktopology.testing import FakeQubesDB
+
+
+P = ConjoinStore.PATH
+MAC = "frontend_mac=12:12:12:12:12:12"
+J = ConjoinStore.JOURNAL_PATH
+
+
+def K(backend: str, frontend: str) -> str:
+    return edge_key(P, backend, frontend)
+
+
+def V(*fields: typing.Any) -> bytes:
+    return json.dumps(fields).encode("utf-8")
+
+
+class TestConjoinStore(unittest.TestCase):
+    def test_load_per_edge(self) -> None:
+        db = FakeQubesDB(
+            {
+                K("a", "b"): V("a", "b", MAC, "1"),
+                K("a", "c"): V("a", "c", "", None),
+                P + "/x/y": b"garbage",
+            }
+        )
+        t = ConjoinStore(db).load()
+        self.assertListEqual(t.frontends("a"), ["b", "c"])
+        self.assertEqual(t.frontend_network_id("a", "b"), "1")
+        self.assertEqual(t.config("a", "b"), Parameters.from_string(MAC))
+        self.assertListEqual(db.writes, [])
+
+    def test_long_names(self) -> None:
+        # VM names can be up to 31 characters long.
+        a, b = "a" * 31, "b" * 31
+        db = FakeQubesDB({})
+        store = ConjoinStore(db)
+        t = store.load()
+        t.conjoin(a, b, Parameters.from_string(MAC), "1")
+        store.save(t)
+        self.assertEqual(db.connections, 1)
+        loaded = ConjoinStore(db).load()
+        self.assertEqual(loaded.frontend_network_id(a, b), "1")
+        self.assertEqual(loaded.config(a, b), Parameters.from_string(MAC))
+
+    def test_migrate_legacy(self) -> None:
+        legacy = {
+            "a b": [MAC, "1"],
+            "a c": {"config": True, "frontend_network_id": "2"},
+        }
+        db = FakeQubesDB({P: json.dumps(legacy).encode("utf-8")})
+        t = ConjoinStore(db).load()
+        self.assertEqual(t.frontend_network_id("a", "c"), "2")
+        self.assertNotIn(P, db.data)
+        self.assertEqual(json.loads(db.data[K("a", "b")]), ["a", "b", MAC, "1"])
+        self.assertEqual(json.loads(db.data[K("a", "c")]), ["a", "c", "", "2"])
+
+    def test_save_only_writes_changes(self) -> None:
+        db = FakeQubesDB({})
+        store = ConjoinStore(db)
+        t = store.load()
+        t.conjoin("a", "b", Parameters(), "1")
+        t.conjoin("a", "c", Parameters(), "2")
+        store.save(t)
+        self.assertListEqual(sorted(db.writes), sorted([K("a", "b"), K("a", "c")]))
+        db.writes.clear()
+        t.disjoin("a", "b")
+        t.conjoin("a", "c", Parameters(), "3")
+        t.conjoin("d", "a", Parameters(), "4")
+        store.save(t)
+        self.assertListEqual(sorted(db.writes), sorted([K("a", "c"), K("d", "a")]))
+        self.assertListEqual(db.removals, [K("a", "b")])
+        db.writes.clear()
+        store.save(t)
+        self.assertListEqual(db.writes, [])
+        self.assertEqual(db.connections, 1)
+
+    def test_publish_tree(self) -> None:
+        a, b = "a" * 31, "b" * 31
+        ab, ac = edge_key("/t", a, b), edge_key("/t", a, "c")
+        db = FakeQubesDB({"/t/x/y": b"stale", ab: V(a, b, "1")})
+        store = ConjoinStore(db)
+        store.publish_tree("/t", {(a, b): ["1"], (a, "c"): ["2", None]})
+        self.assertListEqual(db.writes, [ac])
+        self.assertListEqual(db.removals, ["/t/x/y"])
+        db.writes.clear()
+        store.publish_tree("/t", {(a, b): ["3"]})
+        store.publish_tree("/t", {(a, b): ["3"]})
+        self.assertListEqual(db.writes, [ab])
+        self.assertListEqual(db.removals, ["/t/x/y", ac])
+        self.assertDictEqual(read_tree(db, "/t"), {(a, b): ["3"]})
+
+    def test_update_tree(self) -> None:
+        ab, ac = edge_key("/t", "a", "b"), edge_key("/t", "a", "c")
+        db = FakeQubesDB({ab: V("a", "b", "1"), ac: V("a", "c", "2")})
+        store = ConjoinStore(db)
+        store.update_tree("/t", {("a", "b"): ["1"], ("a", "c"): None})
+        store.update_tree("/t", {("a", "c"): None, ("b", "c"): ["3"]})
+        self.assertListEqual(db.writes, [edge_key("/t", "b", "c")])
+        self.assertListEqual(db.removals, [ac])
+        self.assertEqual(db.multireads, 1)
+        self.assertDictEqual(
+            read_tree(db, "/t"), {("a", "b"): ["1"], ("b", "c"): ["3"]}
+        )
+
+    def test_publish_text(self) -> None:
+        db = FakeQubesDB({})
+        store = ConjoinStore(db)
+        text = "".join("line %s %s\n" % (n, "x" * 100) for n in range(100))
+        store.publish_text("/m", text)
+        self.assertGreater(len(db.writes), 1)
+        self.assertEqual("".join(read_list(db, "/m")), text)
+        store.publish_text("/m", "short\n")
+        self.assertListEqual(read_list(db, "/m"), ["short\n"])
+
+    def test_failed_publish_keeps_persisted(self) -> None:
+        db = FakeQubesDB({})
+        store = ConjoinStore(db)
+        t = store.load()
+        t.conjoin("a", "b", Parameters(), "1")
+        store.save(t)
+        self.assertRaises(ValueError, lambda: store.publish_list("/m", ["x" * 4000]))
+        multireads, db.writes = db.multireads, []
+        store.save(t)
+        self.assertEqual(db.multireads, multireads)
+        self.assertListEqual(db.writes, [])
+        self.assertEqual(db.connections, 2)
+
+    def test_journal(self) -> None:
+        db = FakeQubesDB({})
+        store = ConjoinStore(db)
+        mac = Parameters.from_string(MAC)
+        store.record_intents(
+            {
+                ("a", "b"): ([("+", mac)], None),
+                ("a", "c"): ([("-", Parameters()), ("+", mac)], "1"),
+            }
+        )
+        store.confirm_intent("a", "b", [("+", mac, "4")])
+        self.assertDictEqual(
+            store.intents(), {("a", "b"): [("+", mac, "4")], ("a", "c"): None}
+        )
+        db.data[J + "/x/y"] = b"garbage"
+        self.assertRaises(ValueError, store.intents)
+        store.clear_intents(keep=[("a", "c")])
+        self.assertDictEqual(store.intents(), {("a", "c"): None})
+        store.clear_intents()
+        self.assertDictEqual(store.intents(), {})
+        self.assertEqual(db.connections, 1)
+
+    def test_journal_long_names(self) -> None:
+        a, b = "a" * 31, "b" * 31
+        store = ConjoinStore(FakeQubesDB({}))
+        store.record_intents({(a, b): ([("+", Parameters())], None)})
+        self.assertDictEqual(store.intents(), {(a, b): None})
+        store.confirm_intent(a, b, [("+", Parameters(), "0")])
+        self.assertDictEqual(store.intents(), {(a, b): [("+", Parameters(), "0")]})
+
+    def test_save_removes_in_bulk(self) -> None:
+        db = FakeQubesDB({})
+        store = ConjoinStore(db)
+        t = store.load()
+        for backend, frontend in [("a", "b"), ("a", "c"), ("b", "c"), ("c", "a")]:
+            t.conjoin(backend, frontend, Parameters(), "1")
+        store.save(t)
+        t.disjoin("a", "b")
+        t.disjoin("a", "c")
+        t.disjoin("b", "c")
+        store.save(t)
+        self.assertListEqual(
+            sorted(db.removals),
+            sorted(K(backend, "x").rsplit("/", 1)[0] + "/" for backend in "ab"),
+        )
+        t.disjoin("c", "a")
+        store.save(t)
+        self.assertListEqual(db.removals[2:], [P + "/"])
+        self.assertDictEqual(db.multiread(P + "/"), {})
@@ -0,0 +1,91 @@
+import asyncio
+import unittest
+
+
+from qubesarbitrarynetworktopology.retry import RetryKey, RetryQueue
+
+
+class TestRetryQueue(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.calls: list[tuple[RetryKey, int]] = []
+        self.persisted: list[list[RetryKey]] = []
+        self.queue = RetryQueue(
+            lambda e: self.calls.append((e.key, e.attempts)),
+            lambda entries: self.persisted.append([e.key for e in entries]),
+            base_delay=0.01,
+            max_delay=0.04,
+            max_attempts=3,
+            max_per_backend=2,
+        )
+
+    def test_delay_backs_off_with_jitter(self) -> None:
+        queue = RetryQueue(lambda e: None, base_delay=1, max_delay=60)
+        for attempts, backoff in [(0, 1), (1, 2), (3, 8), (10, 60)]:
+            for _ in range(20):
+                self.assertGreaterEqual(queue.delay(attempts), backoff / 2)
+                self.assertLessEqual(queue.delay(attempts), backoff)
+
+    async def test_retries_until_discarded(self) -> None:
+        self.queue.add("b", "f")
+        self.queue.add("b", "f")
+        await asyncio.sleep(0.05)
+        self.queue.discard("b", "f")
+        await asyncio.sleep(0.1)
+        self.assertGreaterEqual(len(self.calls), 1)
+        self.assertListEqual(
+            self.calls, [(("b", "f", None), n + 1) for n in range(len(self.calls))]
+        )
+        self.assertListEqual(self.queue.status(), [])
+        self.assertListEqual(self.persisted[-1], [])
+
+    async def test_gives_up(self) -> None:
+        self.queue.add("b", "f", "3")
+        with self.assertLogs("qubesarbitrarynetworktopology.retry", "WARNING"):
+            await asyncio.sleep(0.3)
+        self.assertEqual(len(self.calls), 3)
+        (status,) = self.queue.status()
+        self.assertEqual(status["kind"], "detach")
+        self.assertTrue(status["gave_up"])
+        self.assertEqual(status["attempts"], 3)
+        # Further failures are ignored, until the edge is reset.
+        self.queue.add("b", "f", "3")
+        self.assertTrue(self.queue.status()[0]["gave_up"])
+        self.queue.reset("f", "b")
+        self.queue.reset("b", "g")
+        self.assertEqual(len(self.queue), 1)
+        self.queue.reset("f")
+        self.assertListEqual(self.queue.status(), [])
+        self.queue.add("b", "f", "3")
+        self.assertFalse(self.queue.status()[0]["gave_up"])
+        self.assertEqual(self.queue.status()[0]["attempts"], 0)
+        self.queue.discard("b", "f", "3")
+
+    async def test_bounded_per_backend(self) -> None:
+        with self.assertLogs("qubesarbitrarynetworktopology.retry", "WARNING"):
+            for frontend in ["f", "g", "h"]:
+                self.queue.add("b", frontend)
+        self.queue.add("c", "f")
+        self.assertListEqual(
+            [(e["backend"], e["frontend"]) for e in self.queue.status()],
+            [("b", "f"), ("b", "g"), ("c", "f")],
+        )
+        for backend, frontend in [("b", "f"), ("b", "g"), ("c", "f")]:
+            self.queue.discard(backend, frontend)
+
+    async def test_restore(self) -> None:
+        self.queue.restore(
+            [
+                {
+                    "backend": "b",
+                    "frontend": "f",
+                    "vifid": None,
+                    "attempts": 2,
+                    "gave_up": False,
+                    "not_before": None,
+                }
+            ]
+        )
+        with self.assertLogs("qubesarbitrarynetworktopology.retry", "WARNING"):
+            await asyncio.sleep(0.1)
+        self.assertListEqual(self.calls, [(("b", "f", None), 3)])
+        self.assertTrue(self.queue.status()[0]["gave_up"])
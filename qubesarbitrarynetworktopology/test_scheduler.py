@@ -0,0 +1,94 @@
+import asyncio
+import unittest
+
+
+from qubesarbitrarynetworktopology.scheduler import ReconcileBatch, ReconcileScheduler
+
+
+class TestReconcileScheduler(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.batches: list[tuple[list[str], list[str]]] = []
+
+        async def callback(batch: ReconcileBatch) -> None:
+            self.batches.append((list(batch.disjoin), list(batch.conjoin)))
+
+        self.scheduler = ReconcileScheduler(callback, delay=0.01)
+
+    async def test_coalesces(self) -> None:
+        for vm in ["a", "b", "c"]:
+            self.scheduler.conjoin(vm)
+        self.scheduler.disjoin("d")
+        self.scheduler.conjoin("a")
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [(["d"], ["a", "b", "c"])])
+
+    async def test_start_then_shutdown_is_moot(self) -> None:
+        self.scheduler.conjoin("a")
+        self.scheduler.disjoin("a")
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [(["a"], [])])
+
+    async def test_restart(self) -> None:
+        self.scheduler.disjoin("a")
+        self.scheduler.conjoin("a")
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [(["a"], ["a"])])
+
+    async def test_separate_windows(self) -> None:
+        self.scheduler.conjoin("a")
+        await self.scheduler.drain()
+        self.scheduler.conjoin("b")
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [([], ["a"]), ([], ["b"])])
+
+    async def test_failing_callback_does_not_stop_scheduler(self) -> None:
+        async def callback(batch: ReconcileBatch) -> None:
+            raise RuntimeError("boom")
+
+        self.scheduler.callback = callback
+        self.scheduler.conjoin("a")
+        with self.assertLogs("qubesarbitrarynetworktopology.scheduler"):
+            await self.scheduler.drain()
+
+    async def test_hold_collects_until_released(self) -> None:
+        self.scheduler.hold()
+        self.scheduler.conjoin("a")
+        await asyncio.sleep(0.05)
+        self.scheduler.conjoin("b")
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [])
+        self.scheduler.release()
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [([], ["a", "b"])])
+
+    async def test_hold_lapses(self) -> None:
+        self.scheduler.hold(0.05)
+        self.scheduler.conjoin("a")
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [])
+        await asyncio.sleep(0.1)
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [([], ["a"])])
+
+    async def test_hold_within_window(self) -> None:
+        self.scheduler.conjoin("a")
+        self.scheduler.hold()
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [])
+        self.scheduler.release()
+        await self.scheduler.drain()
+        self.assertListEqual(self.batches, [([], ["a"])])
+
+    async def test_resync(self) -> None:
+        resyncs: list[tuple[bool, list[str]]] = []
+
+        async def callback(batch: ReconcileBatch) -> None:
+            resyncs.append((batch.resync, list(batch.conjoin)))
+
+        self.scheduler.callback = callback
+        self.scheduler.resync()
+        self.scheduler.conjoin("a")
+        await self.scheduler.drain()
+        self.scheduler.conjoin("b")
+        await self.scheduler.drain()
+        self.assertListEqual(resyncs, [(True, ["a"]), (False, ["b"])])
@@ -0,0 +1,98 @@
+import typing
+import unittest
+
+
+from qubesarbitrarynetworktopology.states import (
+    DomainStates,
+    PowerStates,
+    poll_power_states,
+)
+
+
+class FakeVM(object):
+    def __init__(self, name: str, running: bool = True, paused: bool = False) -> None:
+        self.name = name
+        self.running = running
+        self._paused = paused
+
+    def is_running(self) -> bool:
+        return self.running
+
+    def is_paused(self) -> bool:
+        return self._paused
+
+
+class FakeApp(object):
+    def __init__(self, *vms: FakeVM) -> None:
+        self.domains = list(vms)
+
+
+class TestDomainStates(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = FakeApp(
+            FakeVM("dom0"),
+            FakeVM("a"),
+            FakeVM("b", paused=True),
+            FakeVM("c", running=False),
+        )
+        self.queries = 0
+
+        def query(app: typing.Any) -> PowerStates:
+            self.queries += 1
+            return poll_power_states(app)
+
+        self.states = DomainStates(query)
+
+    def test_poll(self) -> None:
+        self.assertDictEqual(
+            poll_power_states(self.app), {"dom0": False, "a": False, "b": True}
+        )
+
+    def test_actionable_edges(self) -> None:
+        edges = [("a", "b"), ("a", "c"), ("dom0", "a"), ("a", "gone")]
+        self.assertListEqual(self.states.actionable(self.app, edges), [("dom0", "a")])
+        self.assertListEqual(self.states.running(self.app), ["dom0", "a", "b"])
+        self.assertEqual(self.queries, 1)
+
+    def test_kept_current_by_events(self) -> None:
+        self.states.snapshot(self.app)
+        self.states.unpaused("b")
+        self.states.started("c")
+        self.states.paused("a")
+        self.states.paused("gone")
+        self.states.stopped("dom0")
+        self.assertDictEqual(
+            self.states.snapshot(self.app), {"a": True, "b": False, "c": False}
+        )
+        self.assertEqual(self.queries, 1)
+        self.states.invalidate()
+        self.assertListEqual(self.states.running(self.app), ["dom0", "a", "b"])
+        self.assertEqual(self.queries, 2)
+
+    def test_events_before_snapshot_are_ignored(self) -> None:
+        # The snapshot, when taken, reflects them already.
+        self.states.started("c")
+        self.states.stopped("a")
+        self.assertListEqual(self.states.running(self.app), ["dom0", "a", "b"])
+        self.assertEqual(self.queries, 1)
+
+    def test_generation(self) -> None:
+        g = self.states.generation
+        self.states.paused("a")
+        self.assertEqual(self.states.generation, g)
+        self.states.snapshot(self.app)
+        self.assertGreater(self.states.generation, g)
+        g = self.states.generation
+        self.states.snapshot(self.app)
+        self.assertEqual(self.states.generation, g)
+        for change in ("paused", "unpaused", "started", "stopped"):
+            getattr(self.states, change)("a")
+            self.assertGreater(self.states.generation, g, msg=change)
+            g = self.states.generation
+        self.assertEqual(self.states.changed_since(g - 2), ["a"])
+        self.assertIsNone(self.states.changed_since(0))
+        self.states.stopped("b")
+        self.assertEqual(self.states.changed_since(g), ["b"])
+        self.states.invalidate()
+        self.assertGreater(self.states.generation, g)
+        self.assertIsNone(self.states.changed_since(g))
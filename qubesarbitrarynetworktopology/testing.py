@@ -0,0 +1,119 @@
+"""
+In-memory stand-ins for qubesdb and the Qubes domain collection, shared by
+the tests and the load harness.
+"""
+
+import typing
+
+
+from qubesarbitrarynetworktopology.persistence import QDB_MAX_DATA
+
+
+class FakeQubesDB(object):
+    """
+    FakeQubesDB keeps keys in memory, with the limits qubesdb puts on paths
+    and values.  writes and removals list the paths written and removed,
+    and bytes_written counts the size of the paths and values written.
+    Calling it stands for connecting to qubesdb, and returns itself.
+    """
+
+    def __init__(self, data: dict[str, bytes] | None = None) -> None:
+        self.data: dict[str, bytes] = {} if data is None else data
+        self.writes: list[str] = []
+        self.removals: list[str] = []
+        self.bytes_written = 0
+        self.connections = 0
+        self.multireads = 0
+
+    def __call__(self) -> "FakeQubesDB":
+        self.connections += 1
+        return self
+
+    def read(self, path: str) -> bytes | None:
+        return self.data.get(path)
+
+    def multiread(self, prefix: str) -> dict[str, bytes]:
+        self.multireads += 1
+        return {k: v for k, v in self.data.items() if k.startswith(prefix)}
+
+    def list(self, prefix: str) -> list[str]:
+        return [k for k in self.data if k.startswith(prefix)]
+
+    def write(self, path: str, value: str) -> None:
+        # As qubesdb, which keeps paths to QDB_MAX_PATH bytes with the NUL.
+        if len(path.encode("utf-8")) >= 64:
+            raise ValueError("path too long: %s" % path)
+        if len(value.encode("utf-8")) > QDB_MAX_DATA:
+            raise ValueError("value too long for %s" % path)
+        self.writes.append(path)
+        self.bytes_written += len(path) + len(value)
+        self.data[path] = value.encode("utf-8")
+
+    def rm(self, path: str) -> None:
+        self.removals.append(path)
+        for k in list(self.data):
+            if k == path or (path.endswith("/") and k.startswith(path)):
+                del self.data[k]
+
+    def close(self) -> None:
+        pass
+
+
+class FakeVM(object):
+    """
+    FakeVM stands for a Qubes VM.  events lists the events fired on it, and
+    the app counts the power state queries made.
+    """
+
+    def __init__(
+        self,
+        app: "FakeApp",
+        name: str,
+        qid: int,
+        feature: str | None = None,
+        running: bool = True,
+    ) -> None:
+        self.app = app
+        self.name = name
+        self.qid = qid
+        self.features: dict[str, str] = {}
+        if feature is not None:
+            self.features["attach-network-to"] = feature
+        self.running = running
+        self.paused = False
+        self.shutdown_timeout: float = 60
+        self.untrusted_qdb = FakeQubesDB()
+        self.events: list[tuple[str, dict[str, typing.Any]]] = []
+
+    def __str__(self) -> str:
+        return self.name
+
+    def is_running(self) -> bool:
+        self.app.state_queries += 1
+        return self.running
+
+    def is_paused(self) -> bool:
+        self.app.state_queries += 1
+        return self.paused
+
+    def fire_event(self, event: str, **kwargs: typing.Any) -> None:
+        self.events.append((event, kwargs))
+
+
+class FakeDomains(dict[str, FakeVM]):
+    # Like qubes, iterating yields VMs, and lookups are by name.
+    def __iter__(self) -> typing.Iterator[FakeVM]:  # type: ignore
+        return iter(list(self.values()))
+
+
+class FakeApp(object):
+    """
+    FakeApp stands for the Qubes collection, with dom0 and a VM for each
+    entry of table, mapping its name to its attach-network-to feature.
+    """
+
+    def __init__(self, table: dict[str, str | None], running: bool = True) -> None:
+        self.state_queries = 0
+        self.domains = FakeDomains(dom0=FakeVM(self, "dom0", 0))
+        for qid, (name, feature) in enumerate(table.items(), 1):
+            self.domains[name] = FakeVM(self, name, qid, feature, running)
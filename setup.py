@@ -20,5 +20,8 @@ if __name__ == '__main__':
             'qubes.ext': [
                 'qubesarbitrarynetworktopology = qubesarbitrarynetworktopology:QubesArbitraryNetworkTopologyExtension',
             ],
+            'console_scripts': [
+                'qvm-network-topology = qubesarbitrarynetworktopology.cli:main',
+            ],
         }
     )